@@ -4,6 +4,7 @@
 import os
 import argparse
 import json
+import binascii
 
 import decimal
 D = decimal.Decimal
@@ -24,7 +25,7 @@ import logging
 import configparser
 
 # Units
-from lib import (config, api, util, exceptions, bitcoin, blocks)
+from lib import (config, api, util, exceptions, bitcoin, blocks, verify, export, profiler)
 from lib import (send, order, btcpay, issuance, broadcast, bet, dividend, burn, cancel, callback)
 if os.name == 'nt':
     from lib import util_windows
@@ -54,7 +55,7 @@ def cli(method, params, unsigned):
 
 def set_options (data_dir=None, bitcoind_rpc_connect=None, bitcoind_rpc_port=None,
                  bitcoind_rpc_user=None, bitcoind_rpc_password=None, rpc_host=None, rpc_port=None,
-                 rpc_user=None, rpc_password=None, log_file=None, database_file=None, testnet=False, testcoin=False, unittest=False):
+                 rpc_user=None, rpc_password=None, log_file=None, database_file=None, testnet=False, testcoin=False, compact=False, undo_blocks=None, unittest=False):
 
     # Unittests always run on testnet.
     if unittest and not testnet:
@@ -90,6 +91,22 @@ def set_options (data_dir=None, bitcoind_rpc_connect=None, bitcoind_rpc_port=Non
     else:
         config.TESTCOIN = False
 
+    # compact (only takes effect when the database is created or fully reparsed)
+    if compact:
+        config.COMPACT = compact
+    elif has_config and 'compact' in configfile['Default']:
+        config.COMPACT = configfile['Default'].getboolean('compact')
+    else:
+        config.COMPACT = False
+
+    # undo blocks (the last blocks whose changes are logged, for `reparse --from-block`)
+    if undo_blocks is not None:
+        config.UNDO_BLOCKS = undo_blocks
+    elif has_config and 'undo-blocks' in configfile['Default']:
+        config.UNDO_BLOCKS = configfile['Default'].getint('undo-blocks')
+    else:
+        config.UNDO_BLOCKS = 1000
+
     # Bitcoind RPC host
     if bitcoind_rpc_connect:
         config.BITCOIND_RPC_CONNECT = bitcoind_rpc_connect
@@ -229,6 +246,7 @@ def set_options (data_dir=None, bitcoind_rpc_connect=None, bitcoind_rpc_port=Non
             config.BURN_START = 278310
             config.BURN_END = 283810
             config.UNSPENDABLE = '1CounterpartyXXXXXXXXXXXXXXXUWLpVr'
+    config.UNSPENDABLE_PUBKEYHASH = binascii.hexlify(bitcoin.base58_decode(config.UNSPENDABLE, config.ADDRESSVERSION)).decode('utf-8')
 
 def balances (address):
     def get_btc_balance(address):
@@ -240,7 +258,7 @@ def balances (address):
         except:
             return "???"
 
-    address_data = util.get_address(db, address=address)
+    address_data = util.get_address(db, address=address, sections=['balances'])
 
     # Balances.
     balances = address_data['balances']
@@ -265,9 +283,13 @@ if __name__ == '__main__':
 
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='sets log level to DEBUG instead of WARNING')
     parser.add_argument('--force', action='store_true', help='don\'t check whether Bitcoind is caught up')
+    parser.add_argument('--profile', action='store_true', help='record parse statistics, for `get_parse_stats`')
+    parser.add_argument('--profile-blocks', metavar='FIRST-LAST', help='record parse statistics, and write cProfile output for the parsing of the blocks in the range to the data directory')
     parser.add_argument('--testnet', action='store_true', help='use Bitcoin testnet addresses and block numbers')
     parser.add_argument('--testcoin', action='store_true', help='use the test Counterparty network on every blockchain')
     parser.add_argument('--unsigned', action='store_true', default=False, help='print out unsigned hex of transaction; do not sign or broadcast')
+    parser.add_argument('--compact', action='store_true', help='intern addresses and assets in debits, credits and balances (when creating the database, or on a full reparse or rollback; otherwise its storage is kept)')
+    parser.add_argument('--undo-blocks', type=int, help='the number of most recent blocks whose changes are logged, so that `reparse --from-block` can undo them (default: 1000; 0 to log none)')
 
     parser.add_argument('--data-dir', help='the directory in which to keep the database, config file and log file, by default')
     parser.add_argument('--database-file', help='the location of the SQLite3 database')
@@ -289,6 +311,7 @@ if __name__ == '__main__':
     parser_server = subparsers.add_parser('server', help='run the server (WARNING: not thread‐safe)')
 
     parser_potentials = subparsers.add_parser('potentials', help='get potential transactions (WARNING: not thread‐safe)')
+    parser_potentials.add_argument('--processes', type=int, help='the number of worker processes to use (default: one per CPU)')
 
     parser_send = subparsers.add_parser('send', help='create and broadcast a *send* message')
     parser_send.add_argument('--source', required=True, help='the source address')
@@ -365,9 +388,19 @@ if __name__ == '__main__':
     parser_pending= subparsers.add_parser('pending', help='list pending order matches awaiting BTCpayment from you')
 
     parser_reparse = subparsers.add_parser('reparse', help='reparse all transactions in the database (WARNING: not thread‐safe)')
+    parser_reparse.add_argument('--chunk-size', type=int, help='the number of blocks to reparse per transaction (default: {})'.format(config.REPARSE_CHUNK_SIZE))
+    parser_reparse.add_argument('--from-block', type=int, help='reparse only the blocks from this one on, undoing the changes made by parsing them')
 
     parser_rollback = subparsers.add_parser('rollback', help='rollback database (WARNING: not thread‐safe)')
     parser_rollback.add_argument('block_index', type=int, help='the index of the last known good block')
+    parser_rollback.add_argument('--chunk-size', type=int, help='the number of blocks to reparse per transaction (default: {})'.format(config.REPARSE_CHUNK_SIZE))
+
+    parser_verify = subparsers.add_parser('verify', help='check balances, order and bet remainings, and the XCP supply for consistency')
+    parser_verify.add_argument('--processes', type=int, help='the number of worker processes to use (default: one per CPU)')
+
+    parser_export = subparsers.add_parser('export', help='append the message journal to compressed segment files')
+    parser_export.add_argument('directory', help='the directory to which to write the segments')
+    parser_export.add_argument('--prune', action='store_true', help='delete exported messages from the database')
 
     """
     parser_checksum = subparsers.add_parser('checksum', help='create an asset name from a base string')
@@ -379,7 +412,7 @@ if __name__ == '__main__':
     # Configuration
     set_options(data_dir=args.data_dir, bitcoind_rpc_connect=args.bitcoind_rpc_connect, bitcoind_rpc_port=args.bitcoind_rpc_port,
                  bitcoind_rpc_user=args.bitcoind_rpc_user, bitcoind_rpc_password=args.bitcoind_rpc_password, rpc_host=args.rpc_host, rpc_port=args.rpc_port,
-                 rpc_user=args.rpc_user, rpc_password=args.rpc_password, log_file=args.log_file, database_file=args.database_file, testnet=args.testnet, testcoin=args.testcoin, unittest=False)
+                 rpc_user=args.rpc_user, rpc_password=args.rpc_password, log_file=args.log_file, database_file=args.database_file, testnet=args.testnet, testcoin=args.testcoin, compact=args.compact, undo_blocks=args.undo_blocks, unittest=False)
 
     # Database
     db = util.connect_to_db()
@@ -409,6 +442,16 @@ if __name__ == '__main__':
 
     if args.action == None: args.action = 'server'
 
+    # Profiling
+    if args.profile_blocks:
+        try:
+            first_block, last_block = (int(block_index) for block_index in args.profile_blocks.split('-'))
+        except ValueError:
+            parser.error('invalid block range: {}'.format(args.profile_blocks))
+        profiler.enable(first_block, last_block)
+    elif args.profile:
+        profiler.enable()
+
 
     # TODO
     # Check versions.
@@ -417,7 +460,7 @@ if __name__ == '__main__':
     # Check that the database has caught up with bitcoind.
     if not args.force:
         bitcoin.bitcoind_check(db)
-        if args.action not in ('server', 'reparse', 'rollback', 'potentials'):
+        if args.action not in ('server', 'reparse', 'rollback', 'potentials', 'verify', 'export'):
             util.database_check(db, bitcoin.rpc('getblockcount', []))
     # TODO
 
@@ -551,30 +594,30 @@ if __name__ == '__main__':
         totals = {}
 
         print()
-        for group in bitcoin.rpc('listaddressgroupings', []):
-            for bunch in group:
-                address, btc_balance = bunch[:2]
-                get_address = util.get_address(db, address=address)
-                balances = get_address['balances']
-                table = PrettyTable(['Asset', 'Balance'])
-                empty = True
-                if btc_balance:
-                    table.add_row(['BTC', btc_balance])  # BTC
-                    if 'BTC' in totals.keys(): totals['BTC'] += btc_balance
-                    else: totals['BTC'] = btc_balance
+        bunches = [bunch for group in bitcoin.rpc('listaddressgroupings', []) for bunch in group]
+        get_addresses = util.get_addresses(db, addresses=[bunch[0] for bunch in bunches], sections=['balances'])
+        for bunch in bunches:
+            address, btc_balance = bunch[:2]
+            balances = get_addresses[address]['balances']
+            table = PrettyTable(['Asset', 'Balance'])
+            empty = True
+            if btc_balance:
+                table.add_row(['BTC', btc_balance])  # BTC
+                if 'BTC' in totals.keys(): totals['BTC'] += btc_balance
+                else: totals['BTC'] = btc_balance
+                empty = False
+            for balance in balances:
+                asset = balance['asset']
+                balance = D(util.devise(db, balance['amount'], balance['asset'], 'output'))
+                if balance:
+                    if asset in totals.keys(): totals[asset] += balance
+                    else: totals[asset] = balance
+                    table.add_row([asset, balance])
                     empty = False
-                for balance in balances:
-                    asset = balance['asset']
-                    balance = D(util.devise(db, balance['amount'], balance['asset'], 'output'))
-                    if balance:
-                        if asset in totals.keys(): totals[asset] += balance
-                        else: totals[asset] = balance
-                        table.add_row([asset, balance])
-                        empty = False
-                if not empty:
-                    print(address)
-                    print(table.get_string())
-                    print()
+            if not empty:
+                print(address)
+                print(table.get_string())
+                print()
         for asset in totals.keys():
             balance = totals[asset]
             total_table.add_row([asset, round(balance, 8)])
@@ -593,19 +636,41 @@ if __name__ == '__main__':
 
     # PARSING
     elif args.action == 'reparse':
-        blocks.reparse(db)
+        if args.from_block != None:
+            blocks.reparse_from(db, args.from_block, chunk_size=args.chunk_size)
+        else:
+            blocks.reparse(db, chunk_size=args.chunk_size)
 
     elif args.action == 'rollback':
-        blocks.reparse(db, block_index=args.block_index)
+        blocks.reparse(db, block_index=args.block_index, chunk_size=args.chunk_size)
+
+    elif args.action == 'verify':
+        problems = verify.verify(db, processes=args.processes)
+        if problems:
+            table = PrettyTable(['Table', 'Key', 'Field', 'Expected', 'Actual'])
+            for problem in problems:
+                table.add_row([problem['table'], problem['key'], problem['field'], problem['expected'], problem['actual']])
+            print(table)
+            sys.exit(1)
+        print('No inconsistencies found.')
+
+    elif args.action == 'export':
+        export.export(db, args.directory, prune=args.prune)
 
     elif args.action == 'server':
         api_server = api.APIServer()
         api_server.daemon = True
         api_server.start()
-        blocks.follow(db)
+        while True:
+            try:
+                blocks.follow(db)
+            except exceptions.BitcoindUnavailableError as e:
+                # Every block is parsed atomically, so following can resume from the last one.
+                logging.warning('Status: {} Pausing.'.format(e))
+                time.sleep(max(0, bitcoin.breaker_open_until - time.time()))
 
     elif args.action == 'potentials':
-        blocks.get_potentials(db)
+        blocks.get_potentials(db, processes=args.processes)
 
 
     else:
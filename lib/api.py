@@ -7,6 +7,8 @@ import decimal
 import time
 import json
 import logging
+import concurrent.futures
+import functools
 from logging import handlers as logging_handlers
 D = decimal.Decimal
 
@@ -14,26 +16,68 @@ import apsw
 import cherrypy
 from cherrypy import wsgiserver
 from jsonrpc import JSONRPCResponseManager, dispatcher
+from jsonrpc.exceptions import JSONRPCInvalidRequest
+from jsonrpc.jsonrpc2 import (JSONRPC20Response, JSONRPC20BatchResponse)
 
-from . import (config, bitcoin, exceptions, util, bitcoin)
+from . import (config, bitcoin, exceptions, util, bitcoin, profiler, metrics)
 from . import (send, order, btcpay, issuance, broadcast, bet, dividend, burn, cancel)
 
+class ReadConnection(object):
+    """Stands in for a read‐only connection to the database, of which each
+    thread serving the API has its own.
+    """
+    def __getattr__ (self, name):
+        return getattr(util.get_read_connection(config.DATABASE), name)
+
+def get_snapshot (db):
+    """Return the last block and message that db can see."""
+    cursor = db.cursor()
+    cursor.execute('''SELECT (SELECT MAX(block_index) FROM blocks) AS block_index, \
+                             (SELECT MAX(message_index) FROM messages) AS message_index''')
+    snapshot = cursor.fetchall()[0]
+    cursor.close()
+    return (snapshot['block_index'], snapshot['message_index'])
+
+def timed (method_name, method):
+    """Wrap method so that each call to it is timed (and failures counted)
+    in the metrics registry.
+    """
+    @functools.wraps(method)
+    def timed_method (*args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            metrics.inc('counterpartyd_api_errors_total', method=method_name)
+            raise
+        finally:
+            metrics.observe('counterpartyd_api_request_seconds', time.time() - start, method=method_name)
+    return timed_method
+
 class APIServer(threading.Thread):
 
     def __init__ (self):
         threading.Thread.__init__(self)
 
     def run (self):
-        db = util.connect_to_db(flags='SQLITE_OPEN_READONLY')
+        db = ReadConnection()
+        batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=util.READ_THREADS)
 
         ######################
         #READ API
         # TODO: Move all of these functions from util.py here (and use native SQLite queries internally).
 
         @dispatcher.add_method
-        def get_address(address, start_block=None, end_block=None):
+        def get_address(address, start_block=None, end_block=None, sections=None):
+            try:
+                return util.get_address(db, address=address, start_block=start_block, end_block=end_block, sections=sections)
+            except exceptions.InvalidAddressError:
+                return None
+
+        @dispatcher.add_method
+        def get_addresses(addresses, start_block=None, end_block=None, sections=None):
             try:
-                return util.get_address(db, address=address, start_block=start_block, end_block=end_block)
+                return util.get_addresses(db, addresses=addresses, start_block=start_block, end_block=end_block, sections=sections)
             except exceptions.InvalidAddressError:
                 return None
 
@@ -192,10 +236,23 @@ class APIServer(threading.Thread):
             cursor.close()
             return messages
 
+        @dispatcher.add_method
+        def get_messages_range(start_message_index, limit=config.API_FEED_LIMIT):
+            limit = min(int(limit), config.API_FEED_LIMIT)
+            cursor = db.cursor()
+            cursor.execute('select * from messages where message_index >= ? order by message_index asc limit ?', (start_message_index, limit))
+            messages = cursor.fetchall()
+            cursor.close()
+            return messages
+
         @dispatcher.add_method
         def xcp_supply():
             return util.xcp_supply(db)
 
+        @dispatcher.add_method
+        def get_supply(asset):
+            return util.get_supply(db, asset)
+
         @dispatcher.add_method
         def get_asset_info(asset):
             if asset in ['BTC', 'XCP']:
@@ -211,19 +268,19 @@ class APIServer(threading.Thread):
                     'issuer': None
                 }
             
-            #gets some useful info for the given asset
-            issuances = util.get_issuances(db,
-                filters={'field': 'asset', 'op': '==', 'value': asset},
-                validity='valid',
-                order_by='block_index',
-                order_dir='asc')
-            if not issuances: return None #asset not found, most likely
-            else: last_issuance = issuances[-1]
-
             #get the last issurance message for this asset, which should reflect the current owner and if
             # its divisible (and if it was locked, for that matter)
+            cursor = db.cursor()
+            cursor.execute('''SELECT * FROM issuances \
+                              WHERE (validity = ? AND asset = ?) \
+                              ORDER BY tx_index DESC LIMIT 1''', ('valid', asset))
+            issuances = cursor.fetchall()
+            cursor.close()
+            if not issuances: return None #asset not found, most likely
+            else: last_issuance = issuances[0]
+
             locked = not last_issuance['amount'] and not last_issuance['transfer']
-            total_issued = sum([e['amount'] for e in issuances])
+            total_issued = util.get_supply(db, asset)['issued']
             return {'owner': last_issuance['issuer'],
                     'divisible': bool(last_issuance['divisible']),
                     'locked': locked,
@@ -272,6 +329,14 @@ class APIServer(threading.Thread):
                 'db_version_minor': config.DB_VERSION_MINOR,
             }
 
+        @dispatcher.add_method
+        def get_rpc_stats():
+            return bitcoin.get_rpc_stats()
+
+        @dispatcher.add_method
+        def get_parse_stats():
+            return profiler.get_parse_stats()
+
         @dispatcher.add_method
         def get_asset_names():
             cursor = db.cursor()
@@ -286,7 +351,7 @@ class APIServer(threading.Thread):
             for element in ['transactions', 'blocks', 'debits', 'credits', 'balances', 'sends', 'orders',
                 'order_matches', 'btcpays', 'issuances', 'broadcasts', 'bets', 'bet_matches', 'dividends',
                 'burns', 'cancels', 'callbacks', 'order_expirations', 'bet_expirations', 'order_match_expirations',
-                'bet_match_expirations', 'messages']:
+                'bet_match_expirations', 'supplies', 'messages']:
                 cursor.execute("SELECT COUNT(*) AS count FROM %s" % element)
                 counts[element] = cursor.fetchall()[0]['count']
             cursor.close()
@@ -363,7 +428,115 @@ class APIServer(threading.Thread):
         def transmit(unsigned_tx_hex):
             return bitcoin.transmit(unsigned_tx_hex)
 
+        # Time every call.
+        for method_name, method in list(dispatcher.method_map.items()):
+            dispatcher[method_name] = timed(method_name, method)
+
+        def handle_in_transaction (calls):
+            """Handle calls in one read transaction, returning the snapshot of
+            the database which they saw along with their responses.
+            """
+            cursor = db.cursor()
+            cursor.execute('''BEGIN''')
+            try:
+                snapshot = get_snapshot(db)
+                responses = [JSONRPCResponseManager.handle(json.dumps(call), dispatcher) for call in calls]
+            finally:
+                cursor.execute('''COMMIT''')
+                cursor.close()
+            return snapshot, responses
+
+        def handle_batch (calls):
+            if len(calls) > config.API_BATCH_LIMIT:
+                return JSONRPC20Response(error=JSONRPCInvalidRequest(
+                    data='Batch of {} calls exceeds the limit of {}.'.format(len(calls), config.API_BATCH_LIMIT))._data)
+
+            # Create and transmit calls are handled one after another, in order.
+            if not all(isinstance(call, dict) and str(call.get('method')).startswith('get_') for call in calls):
+                return JSONRPCResponseManager.handle(json.dumps(calls), dispatcher)
+
+            # Read calls are handled concurrently, each on a connection of its
+            # own. If the database changed in the meantime (so that they did not
+            # all see the same snapshot), they are handled again in one read
+            # transaction.
+            futures = [batch_executor.submit(handle_in_transaction, [call]) for call in calls]
+            results = [future.result() for future in futures]
+            if len(set(snapshot for snapshot, responses in results)) == 1:
+                responses = [responses[0] for snapshot, responses in results]
+            else:
+                snapshot, responses = handle_in_transaction(calls)
+
+            responses = [response for response in responses if response is not None]
+            if not responses: return None   # Notifications only.
+            return JSONRPC20BatchResponse(*responses)
+
+        # Each request waiting for new messages holds a thread of the server,
+        # so there may only be so many at once (see `messages()`).
+        feed_waiters = threading.BoundedSemaphore(config.API_FEED_WAITERS)
+
+        def get_message_feed (message_index, rollback_index, timeout):
+            """Return the messages after message_index, waiting up to timeout
+            seconds for there to be any. If messages up to message_index have
+            been rolled back since rollback_index, say so instead.
+            """
+            deadline = time.time() + timeout
+            cursor = db.cursor()
+            while True:
+                with util.messages_condition:
+                    generation = util.messages_generation
+
+                cursor.execute('''BEGIN''')
+                try:
+                    cursor.execute('''SELECT MAX(rollback_index) AS rollback_index FROM rollbacks''')
+                    last_rollback_index = cursor.fetchall()[0]['rollback_index'] or 0
+                    cursor.execute('''SELECT MIN(message_index) AS message_index FROM rollbacks \
+                                      WHERE (rollback_index > ? AND message_index < ?)''', (rollback_index, message_index))
+                    rollback_message_index = cursor.fetchall()[0]['message_index']
+                    cursor.execute('''SELECT * FROM messages WHERE message_index > ? ORDER BY message_index LIMIT ?''',
+                                   (message_index, config.API_FEED_LIMIT))
+                    messages = cursor.fetchall()
+                    # The messages of an unfinished reparse may yet be rolled back.
+                    if util.get_reparse(db): messages = []
+                finally:
+                    cursor.execute('''COMMIT''')
+
+                if rollback_message_index != None:
+                    cursor.close()
+                    return {'rollback_index': last_rollback_index, 'rollback': {'message_index': rollback_message_index}, 'messages': []}
+                remaining = deadline - time.time()
+                if messages or remaining <= 0:
+                    cursor.close()
+                    return {'rollback_index': last_rollback_index, 'rollback': None, 'messages': messages}
+
+                with util.messages_condition:
+                    util.messages_condition.wait_for(lambda: util.messages_generation != generation, remaining)
+
         class API(object):
+            @cherrypy.expose
+            def messages(self, message_index=-1, rollback_index=None, timeout=30):
+                """Long‐poll for messages (see `get_message_feed()`)."""
+                cherrypy.response.headers["Content-Type"] = "application/json"
+                cherrypy.response.headers["Access-Control-Allow-Origin"] = '*'
+                try:
+                    message_index = int(message_index)
+                    timeout = min(max(float(timeout), 0), config.API_FEED_TIMEOUT)
+                    if rollback_index == None:
+                        # Rollbacks from before the first request are of no concern.
+                        rollback_index = config.MAX_INT
+                    rollback_index = int(rollback_index)
+                except ValueError:
+                    raise cherrypy.HTTPError(400, 'Invalid parameter')
+                if not timeout:
+                    feed = get_message_feed(message_index, rollback_index, timeout)
+                elif feed_waiters.acquire(blocking=False):
+                    try:
+                        feed = get_message_feed(message_index, rollback_index, timeout)
+                    finally:
+                        feed_waiters.release()
+                else:
+                    raise cherrypy.HTTPError(503, 'Too many requests are waiting for new messages; try again later')
+                return json.dumps(feed).encode()
+
             @cherrypy.expose
             def index(self):
                 cherrypy.response.headers["Content-Type"] = "application/json"
@@ -378,9 +551,27 @@ class APIServer(threading.Thread):
                     data = cherrypy.request.body.read().decode('utf-8')
                 except ValueError:
                     raise cherrypy.HTTPError(400, 'Invalid JSON document')
-                response = JSONRPCResponseManager.handle(data, dispatcher)
+                try:
+                    calls = json.loads(data)
+                except ValueError:
+                    calls = None
+                if isinstance(calls, list) and calls:
+                    response = handle_batch(calls)
+                else:
+                    response = JSONRPCResponseManager.handle(data, dispatcher)
+                if response is None: return b''  # Notifications get no response.
                 return response.json.encode()
 
+        class Metrics(object):
+            @cherrypy.expose
+            def index(self):
+                cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+                try:
+                    metrics.set_value('counterpartyd_database_bytes', os.path.getsize(config.DATABASE))
+                except OSError:
+                    pass
+                return metrics.render().encode()
+
         cherrypy.config.update({
             'log.screen': False,
             "environment": "embedded",
@@ -399,6 +590,7 @@ class APIServer(threading.Thread):
             },
         }
         application = cherrypy.Application(API(), script_name="/jsonrpc/", config=app_config)
+        metrics_application = cherrypy.Application(Metrics(), script_name="/metrics", config=app_config)
 
         #disable logging of the access and error logs to the screen
         application.log.access_log.propagate = False
@@ -425,8 +617,11 @@ class APIServer(threading.Thread):
             application.log.access_log.addHandler(h)
 
         #start up the API listener/handler
+        # (With threads to spare when the message feed has all the waiters it may.)
         server = wsgiserver.CherryPyWSGIServer(
-            (config.RPC_HOST, int(config.RPC_PORT)), application)
+            (config.RPC_HOST, int(config.RPC_PORT)),
+            wsgiserver.WSGIPathInfoDispatcher({'/jsonrpc': application, '/metrics': metrics_application}),
+            numthreads=config.API_THREADS + config.API_FEED_WAITERS)
         #logging.debug("Initializing API interface…")
         try:
             server.start()
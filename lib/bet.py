@@ -109,9 +109,6 @@ def parse (db, tx, message):
         feed_address = tx['destination']
         fee_fraction = get_fee_fraction(db, feed_address)
 
-        try: odds = D(wager_amount) / D(counterwager_amount)
-        except: pass
-
         problems = validate(db, tx['source'], feed_address, bet_type, deadline, wager_amount,
                             counterwager_amount, target_value, leverage, expiration)
         if problems: validity = 'invalid: ' + ';'.join(problems)
@@ -121,8 +118,15 @@ def parse (db, tx, message):
         balances = util.get_balances(db, address=tx['source'], asset='XCP')
         if not balances: wager_amount = 0
         elif balances[0]['amount']/(1 + fee_fraction) < wager_amount:
+            original_wager_amount = wager_amount
             wager_amount = min(round(balances[0]['amount']/(1 + fee_fraction)), wager_amount)
-            counterwager_amount = int(D(wager_amount) / odds)
+            amount = util.exact_floor(wager_amount * counterwager_amount, original_wager_amount,
+                                      util.decimal_exact(original_wager_amount, counterwager_amount))
+            if amount == None:
+                try: odds = D(original_wager_amount) / D(counterwager_amount)
+                except: pass
+                amount = int(D(wager_amount) / odds)
+            counterwager_amount = amount
 
     # Debit amount wagered and fee.
     if validity == 'valid':
@@ -158,6 +162,50 @@ def parse (db, tx, message):
 
     bet_parse_cursor.close()
 
+def get_match_amounts_decimal (block_index, tx0, tx1, tx1_wager_remaining):
+    tx0_odds = util.price(tx0['wager_amount'], tx0['counterwager_amount'])
+    tx0_inverse_odds = util.price(tx0['counterwager_amount'], tx0['wager_amount'])
+    tx1_odds = util.price(tx1['wager_amount'], tx1['counterwager_amount'])
+
+    # NOTE: Old protocol.
+    if block_index < 286000: tx0_inverse_odds = D(1) / tx0_odds
+
+    if tx0_inverse_odds <= tx1_odds:
+        forward_amount = int(min(D(tx0['wager_remaining']), D(tx1_wager_remaining) / tx1_odds))
+        backward_amount = round(D(forward_amount) / tx0_odds)
+        return forward_amount, backward_amount
+    return None
+
+def get_match_amounts (block_index, tx0, tx1, tx1_wager_remaining):
+    """Return the amounts that tx0 and tx1 wager (forward and backward), if
+    their odds agree, computed with integers where that gives the same result
+    as `get_match_amounts_decimal()` (see `util.exact_compare()`).
+    """
+    tx0_wager, tx0_counterwager, tx1_wager, tx1_counterwager = tx0['wager_amount'], tx0['counterwager_amount'], tx1['wager_amount'], tx1['counterwager_amount']
+    tx0_wager_remaining = tx0['wager_remaining']
+    if not (type(tx0_wager) == type(tx0_counterwager) == type(tx1_wager) == type(tx1_counterwager) == type(tx0_wager_remaining) == type(tx1_wager_remaining) == int
+            and min(tx0_wager, tx0_counterwager, tx1_wager, tx1_counterwager) > 0 and min(tx0_wager_remaining, tx1_wager_remaining) >= 0):
+        return get_match_amounts_decimal(block_index, tx0, tx1, tx1_wager_remaining)
+
+    # The inverse of tx0’s odds must be no greater than tx1’s. (Under the old
+    # protocol, that inverse is rounded twice, so exactly equal odds might not
+    # compare as equal, unless both are exact.)
+    comparison = util.exact_compare(tx0_counterwager, tx0_wager, tx1_wager, tx1_counterwager)
+    if comparison == None or (comparison == 0 and block_index < 286000 and
+                              not (util.decimal_exact(tx0_wager, tx0_counterwager) and util.decimal_exact(tx1_wager, tx1_counterwager))):
+        return get_match_amounts_decimal(block_index, tx0, tx1, tx1_wager_remaining)
+    if comparison > 0: return None
+
+    # Where either amount can’t be computed exactly, fall back on Decimal for it alone.
+    forward_amount = util.exact_min_floor(tx0_wager_remaining, tx1_wager_remaining * tx1_counterwager, tx1_wager,
+                                          util.decimal_exact(tx1_wager, tx1_counterwager))
+    if forward_amount == None:
+        forward_amount = int(min(D(tx0_wager_remaining), D(tx1_wager_remaining) / util.price(tx1_wager, tx1_counterwager)))
+    backward_amount = util.exact_round(forward_amount * tx0_counterwager, tx0_wager, util.decimal_exact(tx0_wager, tx0_counterwager))
+    if backward_amount == None:
+        backward_amount = round(D(forward_amount) / util.price(tx0_wager, tx0_counterwager))
+    return forward_amount, backward_amount
+
 def match (db, tx):
     cursor = db.cursor()
 
@@ -211,16 +259,9 @@ def match (db, tx):
 
         # If the odds agree, make the trade. The found order sets the odds,
         # and they trade as much as they can.
-        tx0_odds = util.price(tx0['wager_amount'], tx0['counterwager_amount'])
-        tx0_inverse_odds = util.price(tx0['counterwager_amount'], tx0['wager_amount'])
-        tx1_odds = util.price(tx1['wager_amount'], tx1['counterwager_amount'])
-
-        # NOTE: Old protocol.
-        if tx['block_index'] < 286000: tx0_inverse_odds = D(1) / tx0_odds
-
-        if tx0_inverse_odds <= tx1_odds:
-            forward_amount = int(min(D(tx0['wager_remaining']), D(tx1_wager_remaining) / tx1_odds))
-            backward_amount = round(D(forward_amount) / tx0_odds)
+        amounts = get_match_amounts(tx['block_index'], tx0, tx1, tx1_wager_remaining)
+        if amounts:
+            forward_amount, backward_amount = amounts
 
             if not forward_amount: continue
             if tx1['block_index'] >= 286500:    # Protocol change.
@@ -12,12 +12,16 @@ import requests
 import re
 import time
 import getpass
+import random
+import logging
+import threading
+import concurrent.futures
 
 from pycoin.ecdsa import generator_secp256k1, public_pair_for_secret_exponent
 from pycoin.encoding import wif_to_tuple_of_secret_exponent_compressed, public_pair_to_sec
 from pycoin.scripts import bitcoin_utils
 
-from . import (config, exceptions)
+from . import (config, exceptions, metrics)
 
 # Constants
 OP_RETURN = b'\x6a'
@@ -33,7 +37,27 @@ b58_digits = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
 dhash = lambda x: hashlib.sha256(hashlib.sha256(x).digest()).digest()
 
-request_session = None
+RPC_THREADS = 8     # Requests to Bitcoind in flight at once.
+RPC_TIMEOUT = 60    # Seconds to wait for each response.
+RPC_TRIES = 8
+RPC_BACKOFF = 1     # Seconds before the first retry, doubled for each retry after it, up to RPC_BACKOFF_MAX.
+RPC_BACKOFF_MAX = 32
+BREAKER_COOLDOWN = 60   # Seconds during which calls fail at once, after Bitcoind could not be reached.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)    # Seconds.
+
+request_sessions = threading.local()    # Sessions keep their connections alive, but are not thread‐safe.
+rpc_executor = None
+
+# Circuit breaker. Once a call has failed all of its tries, it and the calls
+# after it fail at once (with BitcoindUnavailableError) until
+# breaker_open_until; after that, a call gets only one try until one succeeds
+# again.
+breaker_lock = threading.Lock()
+breaker_open_until = 0
+breaker_tripped = False
+
+rpc_stats = {}
+rpc_stats_lock = threading.Lock()
 
 def bitcoind_check (db):
     """Checks blocktime of last block to see if Bitcoind is running behind."""
@@ -44,19 +68,70 @@ def bitcoind_check (db):
     if time_behind > 60 * 60 * 2:   # Two hours.
         raise exceptions.BitcoindError('Bitcoind is running about {} seconds behind.'.format(round(time_behind)))
 
+def record_rpc (method, seconds, error=False):
+    with rpc_stats_lock:
+        if method not in rpc_stats:
+            rpc_stats[method] = {'count': 0, 'errors': 0, 'seconds': 0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+        stats = rpc_stats[method]
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        if error: stats['errors'] += 1
+        stats['buckets'][sum(seconds > bound for bound in LATENCY_BUCKETS)] += 1
+    metrics.observe('counterpartyd_bitcoind_rpc_seconds', seconds, method=method)
+    if error: metrics.inc('counterpartyd_bitcoind_rpc_errors_total', method=method)
+
+def get_rpc_stats ():
+    """Return, for each RPC method, the number of requests made to Bitcoind,
+    how many of them failed, and how long they took (in total, and as a
+    cumulative histogram). Batch requests are counted separately from single
+    ones.
+    """
+    methods = {}
+    with rpc_stats_lock:
+        for method, stats in sorted(rpc_stats.items()):
+            cumulative = 0
+            histogram = []
+            for bound, count in zip(LATENCY_BUCKETS + (None,), stats['buckets']):
+                cumulative += count
+                histogram.append({'le': bound, 'count': cumulative})
+            methods[method] = {'count': stats['count'], 'errors': stats['errors'],
+                               'seconds': stats['seconds'], 'histogram': histogram}
+    return {'methods': methods, 'circuit_open': time.time() < breaker_open_until}
+
 def connect (host, payload, headers):
-    global request_session
-    if not request_session: request_session = requests.Session()
-    TRIES = 12
-    for i in range(TRIES):
+    global breaker_open_until, breaker_tripped
+    if isinstance(payload, list): method = payload[0]['method'] + ' (batch)'
+    else: method = payload['method']
+
+    with breaker_lock:
+        if time.time() < breaker_open_until:
+            raise exceptions.BitcoindUnavailableError('Bitcoind was unreachable; not retrying for {} seconds.'.format(round(breaker_open_until - time.time())))
+        tries = 1 if breaker_tripped else RPC_TRIES
+
+    if not hasattr(request_sessions, 'session'):
+        request_sessions.session = requests.Session()
+    for i in range(tries):
+        start = time.time()
         try:
-            response = request_session.post(host, data=json.dumps(payload), headers=headers)
-            if i > 0: print('Successfully connected.', file=sys.stderr)
+            response = request_sessions.session.post(host, data=json.dumps(payload), headers=headers, timeout=RPC_TIMEOUT)
+            record_rpc(method, time.time() - start)
+            if i > 0: logging.info('Successfully connected.')
+            with breaker_lock: breaker_tripped = False
             return response
-        except requests.exceptions.ConnectionError:
-            print('Could not connect to Bitcoind. Sleeping for five seconds. (Try {}/{})'.format(i+1, TRIES), file=sys.stderr)
-            time.sleep(5)
-    return None
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            record_rpc(method, time.time() - start, error=True)
+            if i == tries - 1: break
+            # Exponential backoff, with full jitter (so that concurrent calls do not retry in step).
+            delay = random.uniform(0, min(RPC_BACKOFF_MAX, RPC_BACKOFF * 2 ** i))
+            logging.warning('Could not connect to Bitcoind. Sleeping for {:.1f} seconds. (Try {}/{})'.format(delay, i+1, tries))
+            time.sleep(delay)
+
+    with breaker_lock:
+        breaker_tripped = True
+        breaker_open_until = time.time() + BREAKER_COOLDOWN
+    if config.TESTNET: network = 'testnet'
+    else: network = 'mainnet'
+    raise exceptions.BitcoindUnavailableError('Cannot communicate with Bitcoind. (counterpartyd is set to run on {}, is Bitcoind?)'.format(network))
 
 def wallet_unlock ():
     getinfo = rpc('getinfo', [])
@@ -70,6 +145,28 @@ def wallet_unlock ():
         print('Unlocking wallet for 60 seconds.')
         rpc('walletpassphrase', [passphrase, 60])
 
+def check_response (response):
+    if response.status_code not in (200, 500):
+        raise exceptions.BitcoindRPCError(str(response.status_code) + ' ' + response.reason)
+
+def get_result (response_json, params):
+    # Return result, with error handling.
+    if 'error' not in response_json.keys() or response_json['error'] == None:
+        return response_json['result']
+    elif response_json['error']['code'] == -5:   # RPC_INVALID_ADDRESS_OR_KEY
+        raise exceptions.BitcoindError('{} Is txindex enabled in Bitcoind?'.format(response_json['error']))
+    elif response_json['error']['code'] == -4:   # Unknown private key (locked wallet?)
+        # If address in wallet, attempt to unlock.
+        address = params[0]
+        if rpc('validateaddress', [address])['ismine']:
+            raise exceptions.BitcoindError('Wallet is locked.')
+        else:   # When will this happen?
+            raise exceptions.BitcoindError('Source address not in wallet.')
+    # elif config.PREFIX == config.UNITTEST_PREFIX:
+    #     print(method)
+    else:
+        raise exceptions.BitcoindError('{}'.format(response_json['error']))
+
 def rpc (method, params):
     headers = {'content-type': 'application/json'}
     payload = {
@@ -88,12 +185,7 @@ def rpc (method, params):
     '''
 
     response = connect(config.BITCOIND_RPC, payload, headers)
-    if response == None:
-        if config.TESTNET: network = 'testnet'
-        else: network = 'mainnet'
-        raise exceptions.BitcoindRPCError('Cannot communicate with Bitcoind. (counterpartyd is set to run on {}, is Bitcoind?)'.format(network))
-    elif response.status_code not in (200, 500):
-        raise exceptions.BitcoindRPCError(str(response.status_code) + ' ' + response.reason)
+    check_response(response)
 
     '''
     if config.PREFIX == config.UNITTEST_PREFIX:
@@ -101,23 +193,46 @@ def rpc (method, params):
         f.close()
     '''
 
-    # Return result, with error handling.
-    response_json = response.json()
-    if 'error' not in response_json.keys() or response_json['error'] == None:
-        return response_json['result']
-    elif response_json['error']['code'] == -5:   # RPC_INVALID_ADDRESS_OR_KEY
-        raise exceptions.BitcoindError('{} Is txindex enabled in Bitcoind?'.format(response_json['error']))
-    elif response_json['error']['code'] == -4:   # Unknown private key (locked wallet?)
-        # If address in wallet, attempt to unlock.
-        address = params[0]
-        if rpc('validateaddress', [address])['ismine']:
-            raise exceptions.BitcoindError('Wallet is locked.')
-        else:   # When will this happen?
-            raise exceptions.BitcoindError('Source address not in wallet.')
-    # elif config.PREFIX == config.UNITTEST_PREFIX:
-    #     print(method)
-    else:
-        raise exceptions.BitcoindError('{}'.format(response_json['error']))
+    return get_result(response.json(), params)
+
+def rpc_batch (method, params_list):
+    """Call method once for each of params_list, in a single request, and
+    return the results in order.
+    """
+    if not params_list: return []
+    headers = {'content-type': 'application/json'}
+    payload = [{
+        "method": method,
+        "params": params,
+        "jsonrpc": "2.0",
+        "id": i,
+    } for i, params in enumerate(params_list)]
+
+    response = connect(config.BITCOIND_RPC, payload, headers)
+    check_response(response)
+    responses = response.json()
+    # A batch which is rejected as a whole (e.g. for being malformed or too
+    # large) gets a single error object back.
+    if not isinstance(responses, list):
+        error = responses.get('error') if isinstance(responses, dict) else responses
+        raise exceptions.BitcoindRPCError('Batch of {} {} calls failed: {}'.format(len(params_list), method, error))
+    responses = sorted(responses, key=lambda response_json: response_json['id'])
+    return [get_result(response_json, params) for response_json, params in zip(responses, params_list)]
+
+def get_rpc_executor ():
+    """Return the pool of threads for making requests to Bitcoind in the
+    background.
+    """
+    global rpc_executor
+    if not rpc_executor:
+        rpc_executor = concurrent.futures.ThreadPoolExecutor(max_workers=RPC_THREADS)
+    return rpc_executor
+
+# Base58 digits are encoded two at a time, from chunks of B58_CHUNK_BASE, so that
+# most of the arithmetic is on small integers.
+b58_values = {c: i for i, c in enumerate(b58_digits)}
+b58_pairs = [a + b for a in b58_digits for b in b58_digits]
+B58_CHUNK_BASE = 58 ** 10
 
 def base58_check_encode(b, version):
     b = binascii.unhexlify(bytes(b, 'utf-8'))
@@ -126,13 +241,20 @@ def base58_check_encode(b, version):
     address_hex = d + dhash(d)[:4]
 
     # Convert big‐endian bytes to integer
-    n = int('0x0' + binascii.hexlify(address_hex).decode('utf8'), 16)
+    n = int.from_bytes(address_hex, 'big')
 
     # Divide that integer into base58
     res = []
-    while n > 0:
-        n, r = divmod (n, 58)
-        res.append(b58_digits[r])
+    while n >= B58_CHUNK_BASE:
+        n, chunk = divmod(n, B58_CHUNK_BASE)
+        for i in range(5):
+            chunk, r = divmod(chunk, 58 * 58)
+            res.append(b58_pairs[r])
+    while n >= 58 * 58:
+        n, r = divmod(n, 58 * 58)
+        res.append(b58_pairs[r])
+    if n >= 58: res.append(b58_pairs[n])
+    elif n > 0: res.append(b58_digits[n])
     res = ''.join(res[::-1])
 
     # Encode leading zeros as base58 zeros
@@ -146,18 +268,14 @@ def base58_check_encode(b, version):
 def base58_decode (s, version):
     # Convert the string to an integer
     n = 0
-    for c in s:
-        n *= 58
-        if c not in b58_digits:
-            raise exceptions.InvalidBase58Error('Not a valid base58 character:', c)
-        digit = b58_digits.index(c)
-        n += digit
+    try:
+        for c in s:
+            n = n * 58 + b58_values[c]
+    except KeyError:
+        raise exceptions.InvalidBase58Error('Not a valid base58 character:', c)
 
     # Convert the integer to bytes
-    h = '%x' % n
-    if len(h) % 2:
-        h = '0' + h
-    res = binascii.unhexlify(h.encode('utf8'))
+    res = n.to_bytes(max(1, (n.bit_length() + 7) // 8), 'big')
 
     # Add padding back.
     pad = 0
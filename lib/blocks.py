@@ -11,10 +11,34 @@ import struct
 import decimal
 D = decimal.Decimal
 import logging
+import hashlib
+import functools
+import threading
+import multiprocessing
+import apsw
 
-from . import (config, exceptions, util, bitcoin)
+from . import (config, exceptions, util, bitcoin, profiler, metrics)
 from . import (send, order, btcpay, issuance, broadcast, bet, dividend, burn, cancel, callback)
 
+PREFETCH_BLOCKS = 10            # Blocks fetched from Bitcoind ahead of the one being parsed.
+ADDRESS_CACHE_SIZE = 65536      # Addresses, by pubkeyhash.
+POTENTIALS_CHUNK_SIZE = 100     # Blocks per task, when scanning for potentials.
+
+# The results of parsing: dropped on reparse, and logged for undoing (see
+# `initialise_undolog()`).
+DERIVED_TABLES = ('debits', 'credits', 'balances', 'sends', 'orders', 'order_matches', 'btcpays', 'issuances', 'broadcasts',
+                  'bets', 'bet_matches', 'dividends', 'burns', 'cancels', 'callbacks', 'order_expirations', 'bet_expirations',
+                  'order_match_expirations', 'bet_match_expirations', 'supplies', 'messages')
+
+MESSAGE_TYPES = {send.ID: 'send', order.ID: 'order', btcpay.ID: 'btcpay', issuance.ID: 'issuance', broadcast.ID: 'broadcast',
+                 bet.ID: 'bet', dividend.ID: 'dividend', cancel.ID: 'cancel', callback.ID: 'callback'}
+
+def get_message_type (tx):
+    if tx['destination'] == config.UNSPENDABLE: return 'burn'
+    try: message_type_id = struct.unpack(config.TXTYPE_FORMAT, tx['data'][:4])[0]
+    except struct.error: return 'unsupported'
+    return MESSAGE_TYPES.get(message_type_id, 'unsupported')
+
 def parse_tx (db, tx):
     parse_tx_cursor = db.cursor()
     # Burns.
@@ -63,21 +87,69 @@ def parse_block (db, block_index, block_time):
     (but not data identification), then just restart `counterparty.py follow`.
 
     """
-    parse_block_cursor = db.cursor()
-
-    # Expire orders and bets.
-    order.expire(db, block_index)
-    bet.expire(db, block_index, block_time)
-
-    # Parse transactions, sorting them by type.
-    parse_block_cursor.execute('''SELECT * FROM transactions \
-                                  WHERE block_index=? ORDER BY tx_index''',
-                               (block_index,))
-    transactions = parse_block_cursor.fetchall()
-    for tx in transactions:
-        parse_tx(db, tx)
+    try:
+        with profiler.measure_block(db, block_index):
+            parse_block_cursor = db.cursor()
+
+            # Log how to undo the changes made by parsing this block, if it is one
+            # of the last config.UNDO_BLOCKS, and forget how to undo those of the
+            # blocks before them.
+            first_block_index = util.last_block(db)['block_index'] - config.UNDO_BLOCKS + 1
+            if block_index >= first_block_index: logged_block_index = block_index
+            else: logged_block_index, first_block_index = None, block_index + 1
+            parse_block_cursor.execute('''UPDATE undolog_state SET block_index = ?, first_block_index = MAX(COALESCE(first_block_index, ?), ?)''',
+                                       (logged_block_index, block_index, first_block_index))
+            parse_block_cursor.execute('''DELETE FROM undolog WHERE block_index < ?''', (first_block_index,))
+
+            # Note where this block’s messages begin.
+            parse_block_cursor.execute('''SELECT MAX(message_index) AS message_index FROM messages''')
+            last_message_index = parse_block_cursor.fetchall()[0]['message_index']
+            if last_message_index == None: last_message_index = -1
+
+            # Expire orders and bets.
+            with profiler.measure(db, 'functions', 'order.expire'):
+                order.expire(db, block_index)
+            with profiler.measure(db, 'functions', 'bet.expire'):
+                bet.expire(db, block_index, block_time)
+
+            # Parse transactions, sorting them by type, as they are read.
+            parse_block_cursor.execute('''SELECT * FROM transactions \
+                                          WHERE block_index=? ORDER BY tx_index''',
+                                       (block_index,))
+            for tx in parse_block_cursor:
+                with profiler.measure(db, 'message_types', get_message_type(tx)):
+                    parse_tx(db, tx)
+
+            # Chain the hash of this block’s messages to that of the previous block.
+            messages_hash = get_messages_hash(db, block_index, last_message_index)
+            parse_block_cursor.execute('''UPDATE blocks SET messages_hash=? WHERE block_index=?''',
+                                       (messages_hash, block_index))
+
+            parse_block_cursor.execute('''UPDATE undolog_state SET block_index = NULL''')
+            parse_block_cursor.close()
+    finally:
+        util.release_cursors(db)
+
+def get_messages_hash (db, block_index, last_message_index):
+    """Hash the messages journalled since last_message_index together with
+    the messages hash of the previous block. The messages of a block are those
+    recorded while parsing it (not those with that block_index, which for
+    updates is not always the block being parsed).
+    """
+    cursor = db.cursor()
+    cursor.execute('''SELECT * FROM blocks WHERE block_index < ? ORDER BY block_index DESC LIMIT 1''', (block_index,))
+    previous_blocks = cursor.fetchall()
+    if previous_blocks and previous_blocks[0]['messages_hash']:
+        previous_hash = previous_blocks[0]['messages_hash']
+    else:
+        previous_hash = ''
 
-    parse_block_cursor.close()
+    hasher = hashlib.sha256(previous_hash.encode('utf-8'))
+    cursor.execute('''SELECT * FROM messages WHERE message_index > ? ORDER BY message_index''', (last_message_index,))
+    for message in cursor:
+        hasher.update('{}|{}|{}\n'.format(message['command'], message['category'], message['bindings']).encode('utf-8'))
+    cursor.close()
+    return hasher.hexdigest()
 
 def initialise(db):
     cursor = db.cursor()
@@ -86,11 +158,16 @@ def initialise(db):
     cursor.execute('''CREATE TABLE IF NOT EXISTS blocks(
                         block_index INTEGER PRIMARY KEY,
                         block_hash TEXT UNIQUE,
-                        block_time INTEGER)
+                        block_time INTEGER,
+                        messages_hash TEXT)
                    ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                       block_index_idx ON blocks (block_index)
                    ''')
+    # Databases created before the messages hash was introduced.
+    columns = [column['name'] for column in cursor.execute('''PRAGMA table_info(blocks)''')]
+    if 'messages_hash' not in columns:
+        cursor.execute('''ALTER TABLE blocks ADD COLUMN messages_hash TEXT''')
 
     # Transactions
     cursor.execute('''CREATE TABLE IF NOT EXISTS transactions(
@@ -106,7 +183,7 @@ def initialise(db):
                         supported BOOL DEFAULT 1)
                     ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                      block_index_idx ON transactions (block_index)
+                      transactions_block_index_idx ON transactions (block_index)
                    ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                       tx_index_idx ON transactions (tx_index)
@@ -120,41 +197,49 @@ def initialise(db):
     cursor.execute('''DELETE FROM transactions WHERE block_index<?''', (config.BLOCK_FIRST,))
 
 
-    # (Valid) debits
-    cursor.execute('''CREATE TABLE IF NOT EXISTS debits(
-                      block_index INTEGER,
-                      address TEXT,
-                      asset TEXT,
-                      amount INTEGER,
-                      action TEXT,
-                      event TEXT)
-                   ''')
-    cursor.execute('''CREATE INDEX IF NOT EXISTS
-                      debits_address_idx ON debits (address)
-                   ''')
-
-    # (Valid) credits
-    cursor.execute('''CREATE TABLE IF NOT EXISTS credits(
-                        block_index INTEGER,
-                        address TEXT,
-                        asset TEXT,
-                        amount INTEGER,
-                        calling_function TEXT,
-                        event TEXT)
-                   ''')
-    cursor.execute('''CREATE INDEX IF NOT EXISTS
-                      address_idx ON credits (address)
-                   ''')
-
-    # Balances
-    cursor.execute('''CREATE TABLE IF NOT EXISTS balances(
-                      address TEXT,
-                      asset TEXT,
-                      amount INTEGER)
-                   ''')
-    cursor.execute('''CREATE INDEX IF NOT EXISTS
-                      asset_idx ON balances (address, asset)
-                   ''')
+    # Compact storage is chosen when debits, credits and balances are created
+    # (i.e. for a new database, or on a full reparse, which drops the
+    # dictionaries too), and kept otherwise.
+    cursor.execute('''SELECT * FROM sqlite_master WHERE name IN (?, ?)''', ('addresses', 'debits'))
+    names = [row['name'] for row in cursor.fetchall()]
+    if 'addresses' in names or (config.COMPACT and 'debits' not in names):
+        initialise_compact(db)
+    else:
+        # (Valid) debits
+        cursor.execute('''CREATE TABLE IF NOT EXISTS debits(
+                          block_index INTEGER,
+                          address TEXT,
+                          asset TEXT,
+                          amount INTEGER,
+                          action TEXT,
+                          event TEXT)
+                       ''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS
+                          debits_address_asset_idx ON debits (address, asset)
+                       ''')
+
+        # (Valid) credits
+        cursor.execute('''CREATE TABLE IF NOT EXISTS credits(
+                            block_index INTEGER,
+                            address TEXT,
+                            asset TEXT,
+                            amount INTEGER,
+                            calling_function TEXT,
+                            event TEXT)
+                       ''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS
+                          credits_address_asset_idx ON credits (address, asset)
+                       ''')
+
+        # Balances
+        cursor.execute('''CREATE TABLE IF NOT EXISTS balances(
+                          address TEXT,
+                          asset TEXT,
+                          amount INTEGER)
+                       ''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS
+                          balances_address_asset_idx ON balances (address, asset)
+                       ''')
 
     # Sends
     cursor.execute('''CREATE TABLE IF NOT EXISTS sends(
@@ -171,7 +256,13 @@ def initialise(db):
                       FOREIGN KEY (block_index) REFERENCES blocks(block_index))
                    ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                      block_index_idx ON sends (block_index)
+                      sends_block_index_idx ON sends (block_index)
+                   ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                      sends_source_idx ON sends (source)
+                   ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                      sends_destination_idx ON sends (destination)
                    ''')
 
     # Orders
@@ -197,14 +288,17 @@ def initialise(db):
                       FOREIGN KEY (block_index) REFERENCES blocks(block_index))
                    ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                      block_index_idx ON orders (block_index)
+                      orders_block_index_idx ON orders (block_index)
                    ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 expire_idx ON orders (validity, expire_index)
+                                 orders_expire_idx ON orders (validity, expire_index)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                                  give_get_valid_idx ON orders (give_asset, get_asset, validity)
                               ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 orders_source_idx ON orders (source)
+                              ''')
 
     # Order Matches
     # TODO: id field is largely unused.
@@ -228,7 +322,19 @@ def initialise(db):
                                  validity TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 match_expire_idx ON order_matches (validity, match_expire_index)
+                                 order_matches_match_expire_idx ON order_matches (validity, match_expire_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_matches_tx0_address_idx ON order_matches (tx0_address)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_matches_tx1_address_idx ON order_matches (tx1_address)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_matches_tx0_hash_idx ON order_matches (tx0_hash)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_matches_tx1_hash_idx ON order_matches (tx1_hash)
                               ''')
 
     # BTCpays
@@ -243,7 +349,13 @@ def initialise(db):
                                  validity TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON btcpays (block_index)
+                                 btcpays_block_index_idx ON btcpays (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 btcpays_source_idx ON btcpays (source)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 btcpays_destination_idx ON btcpays (destination)
                               ''')
 
     cursor.execute('''CREATE TABLE IF NOT EXISTS issuances(
@@ -270,6 +382,9 @@ def initialise(db):
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                         valid_asset_idx ON issuances (validity, asset)
                     ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                        issuances_issuer_idx ON issuances (issuer)
+                    ''')
 
     # Broadcasts
     cursor.execute('''CREATE TABLE IF NOT EXISTS broadcasts(
@@ -285,7 +400,10 @@ def initialise(db):
                                  validity TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON broadcasts (block_index)
+                                 broadcasts_block_index_idx ON broadcasts (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 broadcasts_source_idx ON broadcasts (source)
                               ''')
 
     # Bets.
@@ -309,14 +427,17 @@ def initialise(db):
                                  validity TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON bets (block_index)
+                                 bets_block_index_idx ON bets (block_index)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 expire_idx ON bets (validity, expire_index)
+                                 bets_expire_idx ON bets (validity, expire_index)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                                  feed_valid_bettype_idx ON bets (feed_address, validity, bet_type)
                               ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bets_source_idx ON bets (source)
+                              ''')
 
     # Bet Matches
     # TODO: id field is largely unused.
@@ -346,11 +467,23 @@ def initialise(db):
                                  validity TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 match_expire_idx ON bet_matches (validity, match_expire_index)
+                                 bet_matches_match_expire_idx ON bet_matches (validity, match_expire_index)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                                  valid_feed_idx ON bet_matches (validity, feed_address)
                               ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_matches_tx0_address_idx ON bet_matches (tx0_address)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_matches_tx1_address_idx ON bet_matches (tx1_address)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_matches_tx0_hash_idx ON bet_matches (tx0_hash)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_matches_tx1_hash_idx ON bet_matches (tx1_hash)
+                              ''')
 
     cursor.execute('''CREATE TABLE IF NOT EXISTS dividends(
                         tx_index INTEGER PRIMARY KEY,
@@ -364,6 +497,9 @@ def initialise(db):
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                         dividends_block_index_idx ON dividends (block_index)
                     ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                        dividends_source_idx ON dividends (source)
+                    ''')
 
     cursor.execute('''CREATE TABLE IF NOT EXISTS burns(
                         tx_index INTEGER PRIMARY KEY,
@@ -378,7 +514,7 @@ def initialise(db):
                                  validity_idx ON burns (validity)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 address_idx ON burns (source)
+                                 burns_source_idx ON burns (source)
                               ''')
 
     cursor.execute('''CREATE TABLE IF NOT EXISTS cancels(
@@ -392,6 +528,12 @@ def initialise(db):
     cursor.execute('''CREATE INDEX IF NOT EXISTS
                         cancels_block_index_idx ON cancels (block_index)
                     ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                        cancels_offer_hash_idx ON cancels (offer_hash)
+                    ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                        cancels_source_idx ON cancels (source)
+                    ''')
 
     # Callbacks
     cursor.execute('''CREATE TABLE IF NOT EXISTS callbacks(
@@ -404,7 +546,10 @@ def initialise(db):
                                  validity TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON callbacks (block_index)
+                                 callbacks_block_index_idx ON callbacks (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 callbacks_source_idx ON callbacks (source)
                               ''')
 
     # Order Expirations
@@ -415,7 +560,10 @@ def initialise(db):
                                  block_index INTEGER)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON order_expirations (block_index)
+                                 order_expirations_block_index_idx ON order_expirations (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_expirations_source_idx ON order_expirations (source)
                               ''')
 
     # Bet Expirations
@@ -426,7 +574,10 @@ def initialise(db):
                                  block_index INTEGER)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON bet_expirations (block_index)
+                                 bet_expirations_block_index_idx ON bet_expirations (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_expirations_source_idx ON bet_expirations (source)
                               ''')
 
     # Order Match Expirations
@@ -437,7 +588,13 @@ def initialise(db):
                                  block_index INTEGER)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON order_match_expirations (block_index)
+                                 order_match_expirations_block_index_idx ON order_match_expirations (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_match_expirations_tx0_address_idx ON order_match_expirations (tx0_address)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 order_match_expirations_tx1_address_idx ON order_match_expirations (tx1_address)
                               ''')
 
     # Bet Match Expirations
@@ -448,10 +605,43 @@ def initialise(db):
                                  block_index INTEGER)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON bet_match_expirations (block_index)
+                                 bet_match_expirations_block_index_idx ON bet_match_expirations (block_index)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_match_expirations_tx0_address_idx ON bet_match_expirations (tx0_address)
+                              ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                                 bet_match_expirations_tx1_address_idx ON bet_match_expirations (tx1_address)
+                              ''')
+
+    # Supplies (running totals)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS supplies(
+                                 asset TEXT PRIMARY KEY,
+                                 issued INTEGER,
+                                 burned INTEGER,
+                                 destroyed INTEGER,
+                                 dividends INTEGER,
+                                 called_back INTEGER)
                               ''')
 
     # Messages
+    # Rollbacks (not dropped on reparse): all messages after message_index were
+    # discarded.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rollbacks(
+                      rollback_index INTEGER PRIMARY KEY,
+                      block_index INTEGER,
+                      message_index INTEGER)
+                   ''')
+
+    # Reparses (not dropped on reparse): the progress of an unfinished reparse
+    # (see `reparse()`), in a single row.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS reparses(
+                      block_index INTEGER,
+                      last_block_index INTEGER,
+                      version_minor INTEGER,
+                      message_index INTEGER)
+                   ''')
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS messages(
                                  message_index INTEGER PRIMARY KEY,
                                  block_index INTEGER,
@@ -460,39 +650,213 @@ def initialise(db):
                                  bindings TEXT)
                               ''')
     cursor.execute('''CREATE INDEX IF NOT EXISTS
-                                 block_index_idx ON messages (block_index)
+                                 messages_block_index_idx ON messages (block_index, message_index)
                               ''')
 
+    initialise_undolog(db)
+
     cursor.close()
 
-def get_address (scriptpubkey):
-    asm = scriptpubkey['asm'].split(' ')
-    if asm[0] != 'OP_DUP' or asm[1] != 'OP_HASH160' or asm[3] != 'OP_EQUALVERIFY' or asm[4] != 'OP_CHECKSIG' or len(asm) != 5:
-        return False
+def initialise_undolog (db):
+    """Log, for each block parsed, statements which undo the changes that
+    parsing it made to the results of parsing (see `undo()`), with triggers on
+    each of DERIVED_TABLES (or, in compact storage, on the tables underlying
+    them).
+    """
+    cursor = db.cursor()
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS undolog(
+                      undo_index INTEGER PRIMARY KEY,
+                      block_index INTEGER,
+                      sql TEXT)
+                   ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                      undolog_block_index_idx ON undolog (block_index)
+                   ''')
+
+    # The block being parsed, if any, and the first block whose changes were
+    # all logged.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS undolog_state(
+                      block_index INTEGER,
+                      first_block_index INTEGER)
+                   ''')
+    if not cursor.execute('''SELECT * FROM undolog_state''').fetchall():
+        cursor.execute('''INSERT INTO undolog_state VALUES(NULL, NULL)''')
+
+    log = '''INSERT INTO undolog(block_index, sql) VALUES((SELECT block_index FROM undolog_state), {})'''
+    for table in DERIVED_TABLES:
+        cursor.execute('''SELECT * FROM sqlite_master WHERE name = ?''', (table,))
+        if cursor.fetchall()[0]['type'] == 'view': table = 'compact_' + table
+        columns = [column['name'] for column in cursor.execute('''PRAGMA table_info({})'''.format(table))]
+
+        delete = "'DELETE FROM {} WHERE rowid = ' || new.rowid".format(table)
+        # Only changed columns are restored (floats mightn’t survive quote()).
+        update = "'UPDATE {} SET rowid = rowid' || {} || ' WHERE rowid = ' || old.rowid".format(table, ' || '.join(
+                 "CASE WHEN old.{0} IS new.{0} THEN '' ELSE ', {0} = ' || quote(old.{0}) END".format(column) for column in columns))
+        insert = "'INSERT INTO {}(rowid, {}) VALUES(' || old.rowid || {} || ')'".format(table, ', '.join(columns), ' || '.join(
+                 "', ' || quote(old.{})".format(column) for column in columns))
+        for event, sql in (('INSERT', delete), ('UPDATE', update), ('DELETE', insert)):
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS {0}_{1}_undo AFTER {1} ON {0}
+                              WHEN (SELECT block_index FROM undolog_state) IS NOT NULL
+                              BEGIN {2}; END
+                           '''.format(table, event.lower(), log.format(sql)))
+
+    cursor.close()
+
+def undo (db, block_index):
+    """Undo the changes made by parsing the blocks from block_index on, latest
+    first, and forget them.
+    """
+    cursor = db.cursor()
+    undo_cursor = db.cursor()
+    undo_cursor.setexectrace(lambda cursor, sql, bindings: True)   # Don’t journal (or log) the undoing.
+    cursor.execute('''SELECT * FROM undolog WHERE block_index >= ? ORDER BY undo_index DESC''', (block_index,))
+    for entry in cursor:
+        undo_cursor.execute(entry['sql'])
+    cursor.execute('''DELETE FROM undolog WHERE block_index >= ?''', (block_index,))
+    undo_cursor.close()
+    cursor.close()
+
+def initialise_compact (db):
+    """Store debits, credits and balances with interned addresses and assets,
+    and with events as binary hashes. Views with the original names and
+    columns translate to and from the text representations, so that all
+    reads and writes go through unchanged.
+    """
+    cursor = db.cursor()
+
+    # Dictionaries (dropped only on a full reparse).
+    cursor.execute('''CREATE TABLE IF NOT EXISTS addresses(
+                        address_id INTEGER PRIMARY KEY,
+                        address TEXT UNIQUE)
+                   ''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS assets(
+                        asset_id INTEGER PRIMARY KEY,
+                        asset TEXT UNIQUE)
+                   ''')
 
-    pubkeyhash = asm[2]
-    address = bitcoin.base58_check_encode(pubkeyhash, config.ADDRESSVERSION)
+    # Debits and credits
+    for table, action in (('debits', 'action'), ('credits', 'calling_function')):
+        cursor.execute('''CREATE TABLE IF NOT EXISTS compact_{0}(
+                            block_index INTEGER,
+                            address_id INTEGER,
+                            asset_id INTEGER,
+                            amount INTEGER,
+                            {1} TEXT,
+                            event BLOB)
+                       '''.format(table, action))
+        cursor.execute('''CREATE INDEX IF NOT EXISTS
+                          compact_{0}_address_idx ON compact_{0} (address_id, asset_id)
+                       '''.format(table))
+        cursor.execute('''CREATE VIEW IF NOT EXISTS {0} AS
+                          SELECT block_index, address, asset, amount, {1},
+                          CASE WHEN event IS NULL THEN NULL ELSE lower(hex(event)) END AS event
+                          FROM compact_{0} JOIN addresses USING (address_id) JOIN assets USING (asset_id)
+                       '''.format(table, action))
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS {0}_insert INSTEAD OF INSERT ON {0}
+                          BEGIN
+                            INSERT OR IGNORE INTO addresses(address) VALUES(NEW.address);
+                            INSERT OR IGNORE INTO assets(asset) VALUES(NEW.asset);
+                            INSERT INTO compact_{0} VALUES(NEW.block_index,
+                                (SELECT address_id FROM addresses WHERE address = NEW.address),
+                                (SELECT asset_id FROM assets WHERE asset = NEW.asset),
+                                NEW.amount, NEW.{1}, unhex(NEW.event));
+                          END
+                       '''.format(table, action))
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS {0}_delete INSTEAD OF DELETE ON {0}
+                          BEGIN
+                            DELETE FROM compact_{0} WHERE rowid = (SELECT rowid FROM compact_{0}
+                                WHERE (block_index = OLD.block_index AND amount = OLD.amount
+                                AND address_id = (SELECT address_id FROM addresses WHERE address = OLD.address)
+                                AND asset_id = (SELECT asset_id FROM assets WHERE asset = OLD.asset)) LIMIT 1);
+                          END
+                       '''.format(table))
+
+    # Balances
+    cursor.execute('''CREATE TABLE IF NOT EXISTS compact_balances(
+                        address_id INTEGER,
+                        asset_id INTEGER,
+                        amount INTEGER)
+                   ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS
+                      compact_balances_address_idx ON compact_balances (address_id, asset_id)
+                   ''')
+    cursor.execute('''CREATE VIEW IF NOT EXISTS balances AS
+                      SELECT address, asset, amount
+                      FROM compact_balances JOIN addresses USING (address_id) JOIN assets USING (asset_id)
+                   ''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS balances_insert INSTEAD OF INSERT ON balances
+                      BEGIN
+                        INSERT OR IGNORE INTO addresses(address) VALUES(NEW.address);
+                        INSERT OR IGNORE INTO assets(asset) VALUES(NEW.asset);
+                        INSERT INTO compact_balances VALUES(
+                            (SELECT address_id FROM addresses WHERE address = NEW.address),
+                            (SELECT asset_id FROM assets WHERE asset = NEW.asset),
+                            NEW.amount);
+                      END
+                   ''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS balances_update INSTEAD OF UPDATE ON balances
+                      BEGIN
+                        UPDATE compact_balances SET amount = NEW.amount
+                            WHERE (address_id = (SELECT address_id FROM addresses WHERE address = OLD.address)
+                            AND asset_id = (SELECT asset_id FROM assets WHERE asset = OLD.asset));
+                      END
+                   ''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS balances_delete INSTEAD OF DELETE ON balances
+                      BEGIN
+                        DELETE FROM compact_balances
+                            WHERE (address_id = (SELECT address_id FROM addresses WHERE address = OLD.address)
+                            AND asset_id = (SELECT asset_id FROM assets WHERE asset = OLD.asset));
+                      END
+                   ''')
+
+    cursor.close()
+
+def drop_table (cursor, table):
+    """Drop table, or the view (and underlying table) which replaces it in
+    compact storage.
+    """
+    cursor.execute('''SELECT * FROM sqlite_master WHERE name = ?''', (table,))
+    objects = cursor.fetchall()
+    if objects and objects[0]['type'] == 'view':
+        cursor.execute('''DROP VIEW {}'''.format(table))
+        cursor.execute('''DROP TABLE IF EXISTS compact_{}'''.format(table))
+    else:
+        cursor.execute('''DROP TABLE IF EXISTS {}'''.format(table))
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def pubkeyhash_to_address (pubkeyhash, version):
+    address = bitcoin.base58_check_encode(pubkeyhash, version)
 
     # Test decoding of address.
-    if address != config.UNSPENDABLE and binascii.unhexlify(bytes(pubkeyhash, 'utf-8')) != bitcoin.base58_decode(address, config.ADDRESSVERSION):
+    if address != config.UNSPENDABLE and binascii.unhexlify(bytes(pubkeyhash, 'utf-8')) != bitcoin.base58_decode(address, version):
         return False
 
     return address
 
+def get_pubkeyhash (asm):
+    if asm[0] != 'OP_DUP' or asm[1] != 'OP_HASH160' or asm[3] != 'OP_EQUALVERIFY' or asm[4] != 'OP_CHECKSIG' or len(asm) != 5:
+        return None
+    return asm[2]
+
+def get_address (scriptpubkey):
+    pubkeyhash = get_pubkeyhash(scriptpubkey['asm'].split(' '))
+    if pubkeyhash == None:
+        return False
+
+    return pubkeyhash_to_address(pubkeyhash, config.ADDRESSVERSION)
+
 def get_tx_info (tx):
     """
     The destination, if it exists, always comes before the data output; the
     change, if it exists, always comes after.
     """
 
-    # Fee is the input values minus output values.
-    fee = D(0)
-
-    # Get destination output and data output.
+    # Get destination output and data output. (Addresses, and the fee, are
+    # only computed for Counterparty transactions.)
     destination, btc_amount, data = None, None, b''
+    destination_vout, burn = None, False
     for vout in tx['vout']:
-        fee -= D(vout['value']) * config.UNIT
-
         # Sum data chunks to get data. (Can mix OP_RETURN and multi-sig.)
         asm = vout['scriptPubKey']['asm'].split(' ')
         if len(asm) == 2 and asm[0] == 'OP_RETURN':                                                 # OP_RETURN
@@ -507,14 +871,18 @@ def get_tx_info (tx):
             data += data_chunk
 
         # Destination is the first output before the data.
-        if not destination and not btc_amount and not data:
-            address = get_address(vout['scriptPubKey'])
-            if address:
-                destination = address
-                btc_amount = round(D(vout['value']) * config.UNIT)
+        if not destination_vout and not data:
+            pubkeyhash = get_pubkeyhash(asm)
+            if pubkeyhash != None:
+                destination_vout = vout
+                burn = pubkeyhash == config.UNSPENDABLE_PUBKEYHASH
+
+        # Reject as soon as the data do not start with the prefix (except for burns).
+        if data and not burn and data[:len(config.PREFIX)] != config.PREFIX[:len(data)]:
+            return b'', None, None, None, None
 
     # Check for, and strip away, prefix (except for burns).
-    if destination == config.UNSPENDABLE:
+    if burn:
         pass
     elif data[:len(config.PREFIX)] == config.PREFIX:
         data = data[len(config.PREFIX):]
@@ -522,9 +890,18 @@ def get_tx_info (tx):
         return b'', None, None, None, None
 
     # Only look for source if data were found or destination is UNSPENDABLE, for speed.
-    if not data and destination != config.UNSPENDABLE:
+    if not data and not burn:
         return b'', None, None, None, None
 
+    if destination_vout:
+        destination = get_address(destination_vout['scriptPubKey'])
+        btc_amount = round(D(destination_vout['value']) * config.UNIT)
+
+    # Fee is the input values minus output values.
+    fee = D(0)
+    for vout in tx['vout']:
+        fee -= D(vout['value']) * config.UNIT
+
     # Collect all possible source addresses; ignore coinbase transactions and anything but the simplest Pay‐to‐PubkeyHash inputs.
     source_list = []
     for vin in tx['vin']:                                               # Loop through input transactions.
@@ -551,65 +928,147 @@ def check_potential(tx):
             return True
 
         # Unspendable
-        address = get_address(vout['scriptPubKey'])
-        if address == config.UNSPENDABLE:
+        if get_pubkeyhash(asm) == config.UNSPENDABLE_PUBKEYHASH:
             return True
 
     return False
 
-def reparse (db, block_index=None, quiet=False):
-    """Reparse all transactions (atomically). If block_index is set, rollback
-    to the end of that block.
+def reparse (db, block_index=None, quiet=False, chunk_size=None):
+    """Reparse all transactions, committing every chunk_size blocks (by
+    default, config.REPARSE_CHUNK_SIZE). If block_index is set, rollback to the
+    end of that block. An unfinished reparse (one that was interrupted) is
+    resumed after its last committed chunk.
     """
     # TODO: This is not thread-safe!
-    logging.warning('Status: Reparsing all transactions.')
+    if chunk_size == None: chunk_size = config.REPARSE_CHUNK_SIZE
+    block_index = block_index or None
     cursor = db.cursor()
 
+    progress = util.get_reparse(db)
+    if progress and progress['version_minor'] == config.DB_VERSION_MINOR and (block_index == None or block_index >= progress['last_block_index']):
+        logging.warning('Status: Resuming reparse after block {}.'.format(progress['last_block_index']))
+        last_block_index = progress['last_block_index']
+        with db:
+            if block_index:
+                cursor.execute('''DELETE FROM blocks WHERE block_index > ?''', (block_index,))
+                cursor.execute('''DELETE FROM transactions WHERE block_index > ?''', (block_index,))
+            # A full reparse, either then or now, may change any message.
+            if block_index and progress['block_index']: block_index = min(block_index, progress['block_index'])
+            else: block_index = None
+            cursor.execute('''UPDATE reparses SET block_index = ?''', (block_index,))
+
+    else:
+        logging.warning('Status: Reparsing all transactions.')
+        last_block_index = -1
+        with db:
+            # Delete all of the results of parsing. (With the dictionaries of
+            # compact storage, so that config.COMPACT takes effect again.)
+            for table in DERIVED_TABLES + ('addresses', 'assets', 'undolog', 'undolog_state'):
+                drop_table(cursor, table)
+
+            # For rollbacks, just delete new blocks and then reparse what’s left.
+            # (The results of parsing refer to them.)
+            if block_index:
+                cursor.execute('''DELETE FROM blocks WHERE block_index > ?''', (block_index,))
+                cursor.execute('''DELETE FROM transactions WHERE block_index > ?''', (block_index,))
+
+            initialise(db)
+
+            # Note the reparse, so that it may be resumed.
+            cursor.execute('''DELETE FROM reparses''')
+            cursor.execute('''INSERT INTO reparses VALUES(?, ?, ?, NULL)''', (block_index, last_block_index, config.DB_VERSION_MINOR))
+
+    cursor.close()
+    parse_blocks(db, last_block_index, quiet, chunk_size)
+
+def reparse_from (db, block_index, quiet=False, chunk_size=None):
+    """Reparse the transactions of the blocks from block_index on, committing
+    every chunk_size blocks, having undone the changes made by parsing them
+    before. If the undo log doesn’t reach back that far, reparse all
+    transactions instead.
+    """
+    # TODO: This is not thread-safe!
+    if chunk_size == None: chunk_size = config.REPARSE_CHUNK_SIZE
+    cursor = db.cursor()
+
+    first_block_index = cursor.execute('''SELECT * FROM undolog_state''').fetchall()[0]['first_block_index']
+    if first_block_index == None or block_index < first_block_index:
+        logging.warning('Status: Changes are logged for undoing from block {} only.'.format(first_block_index))
+        cursor.close()
+        return reparse(db, quiet=quiet, chunk_size=chunk_size)
+
+    logging.warning('Status: Reparsing transactions from block {}.'.format(block_index))
+    progress = util.get_reparse(db)
     with db:
-        # For rollbacks, just delete new blocks and then reparse what’s left.
-        if block_index:
-            cursor.execute('''DELETE FROM blocks WHERE block_index > ?''', (block_index,))
-            cursor.execute('''DELETE FROM transactions WHERE block_index > ?''', (block_index,))
-
-        # Delete all of the results of parsing.
-        cursor.execute('''DROP TABLE IF EXISTS debits''')
-        cursor.execute('''DROP TABLE IF EXISTS credits''')
-        cursor.execute('''DROP TABLE IF EXISTS balances''')
-        cursor.execute('''DROP TABLE IF EXISTS sends''')
-        cursor.execute('''DROP TABLE IF EXISTS orders''')
-        cursor.execute('''DROP TABLE IF EXISTS order_matches''')
-        cursor.execute('''DROP TABLE IF EXISTS btcpays''')
-        cursor.execute('''DROP TABLE IF EXISTS issuances''')
-        cursor.execute('''DROP TABLE IF EXISTS broadcasts''')
-        cursor.execute('''DROP TABLE IF EXISTS bets''')
-        cursor.execute('''DROP TABLE IF EXISTS bet_matches''')
-        cursor.execute('''DROP TABLE IF EXISTS dividends''')
-        cursor.execute('''DROP TABLE IF EXISTS burns''')
-        cursor.execute('''DROP TABLE IF EXISTS cancels''')
-        cursor.execute('''DROP TABLE IF EXISTS callbacks''')
-        cursor.execute('''DROP TABLE IF EXISTS order_expirations''')
-        cursor.execute('''DROP TABLE IF EXISTS bet_expirations''')
-        cursor.execute('''DROP TABLE IF EXISTS order_match_expirations''')
-        cursor.execute('''DROP TABLE IF EXISTS bet_match_expirations''')
-        cursor.execute('''DROP TABLE IF EXISTS messages''')
-
-        # Reparse all blocks, transactions.
-        if quiet:
-            log = logging.getLogger('')
-            log.setLevel(logging.WARNING)
-        initialise(db)
-        cursor.execute('''SELECT * FROM blocks ORDER BY block_index''')
-        for block in cursor.fetchall():
-            logging.info('Block (re-parse): {}'.format(str(block['block_index'])))
-            parse_block(db, block['block_index'], block['block_time'])
+        undo(db, block_index)
+
+        # Messages before those of block_index are unchanged. (An unfinished
+        # reparse is continued from here, or from where it got to.)
+        cursor.execute('''SELECT MAX(message_index) AS message_index FROM messages''')
+        message_index = cursor.fetchall()[0]['message_index']
+        if message_index == None: message_index = -1
+        if progress:
+            last_block_index = min(progress['last_block_index'], block_index - 1)
+            if progress['message_index'] != None: message_index = min(progress['message_index'], message_index)
+            else: message_index = None
+            cursor.execute('''UPDATE reparses SET last_block_index = ?, version_minor = ?, message_index = ?''',
+                           (last_block_index, config.DB_VERSION_MINOR, message_index))
+        else:
+            last_block_index = block_index - 1
+            cursor.execute('''INSERT INTO reparses VALUES(NULL, ?, ?, ?)''', (last_block_index, config.DB_VERSION_MINOR, message_index))
+
+    cursor.close()
+    parse_blocks(db, last_block_index, quiet, chunk_size)
+
+def parse_blocks (db, last_block_index, quiet, chunk_size):
+    """Parse the blocks after last_block_index, a chunk at a time, noting
+    progress in the reparses table; and then finish the reparse.
+    """
+    cursor = db.cursor()
+
+    if quiet:
+        log = logging.getLogger('')
+        log.setLevel(logging.WARNING)
+    try:
+        while True:
+            cursor.execute('''SELECT * FROM blocks WHERE block_index > ? ORDER BY block_index LIMIT ?''', (last_block_index, chunk_size))
+            chunk = cursor.fetchall()
+            if not chunk: break
+            with db:
+                for block in chunk:
+                    logging.info('Block (re-parse): {}'.format(str(block['block_index'])))
+                    parse_block(db, block['block_index'], block['block_time'])
+                last_block_index = chunk[-1]['block_index']
+                cursor.execute('''UPDATE reparses SET last_block_index = ?''', (last_block_index,))
+    finally:
         if quiet:
             log.setLevel(logging.INFO)
 
+    progress = util.get_reparse(db)
+    with db:
+        # Record the rollback, for readers of the message feed. A full reparse
+        # may change any message.
+        if progress['message_index'] != None:
+            message_index = progress['message_index']
+        elif progress['block_index']:
+            cursor.execute('''SELECT MAX(message_index) AS message_index FROM messages''')
+            message_index = cursor.fetchall()[0]['message_index']
+            if message_index == None: message_index = -1
+        else:
+            message_index = -1
+        cursor.execute('''INSERT INTO rollbacks(block_index, message_index) VALUES(:block_index, :message_index)''',
+                       {'block_index': progress['block_index'], 'message_index': message_index})
+
         # Update minor version number.
         minor_version = cursor.execute('PRAGMA user_version = {}'.format(int(config.DB_VERSION_MINOR))) # Syntax?!
         logging.info('Status: Database minor version number updated.')
 
+        cursor.execute('''DELETE FROM reparses''')
+
     cursor.close()
+
+    # Debits, credits and balances may have been rebuilt in other storage.
+    util.table_infos.clear()
     return
 
 def reorg (db):
@@ -635,6 +1094,27 @@ def reorg (db):
     reorg_cursor.close()
     return block_index
 
+def fetch_block (block_index):
+    """Get a block from Bitcoind, with the details of each of its
+    transactions. (Run in the background by `follow()`: it does not touch the
+    database.)
+    """
+    block_hash = bitcoin.rpc('getblockhash', [block_index])
+    block = bitcoin.rpc('getblock', [block_hash])
+    txs = bitcoin.rpc_batch('getrawtransaction', [[tx_hash, 1] for tx_hash in block['tx']])
+    return block_hash, block['time'], [(tx_hash, get_tx_info(tx)) for tx_hash, tx in zip(block['tx'], txs)]
+
+def update_metrics (db, block_index, block_count, seconds):
+    metrics.observe('counterpartyd_block_parse_seconds', seconds)
+    metrics.set_value('counterpartyd_block_index', block_index)
+    metrics.set_value('counterpartyd_bitcoind_block_count', block_count)
+    metrics.set_value('counterpartyd_blocks_behind', block_count - block_index)
+    cache_info = pubkeyhash_to_address.cache_info()
+    metrics.set_value('counterpartyd_cache_hits_total', cache_info.hits, cache='addresses')
+    metrics.set_value('counterpartyd_cache_misses_total', cache_info.misses, cache='addresses')
+    metrics.set_value('counterpartyd_cache_hits_total', db.status(apsw.SQLITE_DBSTATUS_CACHE_HIT)[0], cache='sqlite_pages')
+    metrics.set_value('counterpartyd_cache_misses_total', db.status(apsw.SQLITE_DBSTATUS_CACHE_MISS)[0], cache='sqlite_pages')
+
 def follow (db):
     # TODO: This is not thread-safe!
     follow_cursor = db.cursor()
@@ -646,6 +1126,13 @@ def follow (db):
     if minor_version != config.DB_VERSION_MINOR:
         logging.info('Status: Database and client minor version number mismatch ({} ≠ {}).'.format(minor_version, config.DB_VERSION_MINOR))
         reparse(db, quiet=False)
+        util.notify_messages()
+
+    # Finish an interrupted reparse (or rollback).
+    progress = util.get_reparse(db)
+    if progress:
+        reparse(db, block_index=progress['block_index'], quiet=False)
+        util.notify_messages()
 
     # Initialise.
     initialise(db)
@@ -665,16 +1152,18 @@ def follow (db):
         except Exception:   # TODO
             tx_index = 0
 
-        # Get new blocks.
+        # Get new blocks. They are fetched in the background, but parsed here, in order.
         block_count = bitcoin.rpc('getblockcount', [])
+        fetches = {}
         while block_index <= block_count:
+            for next_block_index in range(block_index, min(block_index + PREFETCH_BLOCKS, block_count + 1)):
+                if next_block_index not in fetches:
+                    fetches[next_block_index] = bitcoin.get_rpc_executor().submit(fetch_block, next_block_index)
             logging.info('Block: {}'.format(str(block_index)))
-            block_hash = bitcoin.rpc('getblockhash', [block_index])
-            block = bitcoin.rpc('getblock', [block_hash])
-            block_time = block['time']
-            tx_hash_list = block['tx']
+            block_hash, block_time, tx_info_list = fetches.pop(block_index).result()
 
             # Get and parse transactions in this block (atomically).
+            start = time.time()
             with db:
                 # List the block.
                 follow_cursor.execute('''INSERT INTO blocks(
@@ -687,7 +1176,7 @@ def follow (db):
                               )
 
                 # List the transactions in the block.
-                for tx_hash in tx_hash_list:
+                for tx_hash, tx_info in tx_info_list:
                     # Skip duplicate transaction entries.
                     follow_cursor.execute('''SELECT * FROM transactions WHERE tx_hash=?''', (tx_hash,))
                     blocks = follow_cursor.fetchall()
@@ -695,9 +1184,8 @@ def follow (db):
                         tx_index += 1
                         continue
                     # Get the important details about each transaction.
-                    tx = bitcoin.rpc('getrawtransaction', [tx_hash, 1])
                     logging.debug('Status: examining transaction {}'.format(tx_hash))
-                    source, destination, btc_amount, fee, data = get_tx_info(tx)
+                    source, destination, btc_amount, fee, data = tx_info
                     if source and (data or destination == config.UNSPENDABLE):
                         follow_cursor.execute('''INSERT INTO transactions(
                                             tx_index,
@@ -723,15 +1211,22 @@ def follow (db):
 
                 # Parse the transactions in the block.
                 parse_block(db, block_index, block_time)
+            util.notify_messages()
+            update_metrics(db, block_index, block_count, time.time() - start)
 
             # Increment block index.
             block_count = bitcoin.rpc('getblockcount', [])
             block_index +=1
 
+        # Blocks fetched beyond a shorter chain are dropped.
+        for fetch in fetches.values(): fetch.cancel()
+
         while block_index > block_count: # DUPE
             # Handle blockchain reorganisations, as necessary, atomically.
             with db:
-                block_index = reorg(db)
+                new_block_index = reorg(db)
+            if new_block_index != block_index: util.notify_messages()   # Rolled back.
+            block_index = new_block_index
 
             block_count = bitcoin.rpc('getblockcount', [])
             time.sleep(2)
@@ -739,7 +1234,30 @@ def follow (db):
     follow_cursor.close()
 
 
-def get_potentials (db):
+def initialise_potentials_worker (settings):
+    # Each worker has its own configuration and its own session with Bitcoind.
+    for name, value in settings.items():
+        setattr(config, name, value)
+    bitcoin.request_sessions = threading.local()
+
+def scan_potentials (block_range):
+    """Return, for each block in the (inclusive) range, its hash and time and
+    the hashes and raw hex of its potential transactions.
+    """
+    first_block_index, last_block_index = block_range
+    scanned = []
+    for block_index in range(first_block_index, last_block_index + 1):
+        block_hash = bitcoin.rpc('getblockhash', [block_index])
+        block = bitcoin.rpc('getblock', [block_hash])
+        txs = bitcoin.rpc_batch('getrawtransaction', [[tx_hash, 1] for tx_hash in block['tx']])
+        potentials = [(tx_hash, tx['hex']) for tx_hash, tx in zip(block['tx'], txs) if check_potential(tx)]
+        scanned.append((block_index, block_hash, block['time'], potentials))
+    return scanned
+
+def get_potentials (db, processes=None):
+    """Scan the blockchain for potential transactions. Ranges of blocks are
+    scanned by a pool of processes, and the results stored in block order.
+    """
     # TODO: This is not thread-safe!
     cursor = db.cursor()
 
@@ -764,38 +1282,43 @@ def get_potentials (db):
 
     # Get new blocks.
     block_count = bitcoin.rpc('getblockcount', [])
-    while block_index <= block_count - 12:  # For reorgs.
-        logging.info('Block: {}'.format(str(block_index)))
-        block_hash = bitcoin.rpc('getblockhash', [block_index])
-        block = bitcoin.rpc('getblock', [block_hash])
-        block_time = block['time']
-        tx_hash_list = block['tx']
+    last_block_index = block_count - 12     # For reorgs.
+    tasks = [(first_block_index, min(first_block_index + POTENTIALS_CHUNK_SIZE, last_block_index + 1) - 1)
+             for first_block_index in range(block_index, last_block_index + 1, POTENTIALS_CHUNK_SIZE)]
 
-        # Get potentials in this block (atomically).
-        with db:
-            # List the transactions in the block.
-            for tx_hash in tx_hash_list:
-                # Get the important details about each potential transaction.
-                tx = bitcoin.rpc('getrawtransaction', [tx_hash, 1])
-                if check_potential(tx):
-                    logging.info('Potential: {} ({})'.format(potential_index, tx_hash))
-                    cursor.execute('''INSERT INTO potentials(
-                                        potential_index,
-                                        tx_hash,
-                                        block_index,
-                                        block_hash,
-                                        block_time,
-                                        raw) VALUES(?,?,?,?,?,?)''',
-                                        (potential_index,
-                                         tx_hash,
-                                         block_index,
-                                         block_hash,
-                                         block_time,
-                                         str(tx))
-                                  )
-                    potential_index += 1
-
-        block_index += 1
+    settings = {name: value for name, value in vars(config).items() if name.isupper()}
+    pool = multiprocessing.Pool(processes=processes, initializer=initialise_potentials_worker, initargs=(settings,))
+    try:
+        for scanned in pool.imap(scan_potentials, tasks):
+            # Store the potentials in these blocks (atomically).
+            with db:
+                for block_index, block_hash, block_time, potentials in scanned:
+                    logging.info('Block: {}'.format(str(block_index)))
+                    for tx_hash, raw in potentials:
+                        logging.info('Potential: {} ({})'.format(potential_index, tx_hash))
+                        cursor.execute('''INSERT INTO potentials(
+                                            potential_index,
+                                            tx_hash,
+                                            block_index,
+                                            block_hash,
+                                            block_time,
+                                            raw) VALUES(?,?,?,?,?,?)''',
+                                            (potential_index,
+                                             tx_hash,
+                                             block_index,
+                                             block_hash,
+                                             block_time,
+                                             raw)
+                                      )
+                        potential_index += 1
+    except BaseException:
+        # Don’t wait for the tasks still queued to be scanned.
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
     cursor.close()
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -130,8 +130,12 @@ def parse (db, tx, message):
         # Calculate total funds held in escrow and total fee to be paid if
         # the bet match is settled.
         total_escrow = bet_match['forward_amount'] + bet_match['backward_amount']
-        fee_fraction = D(bet_match['fee_fraction_int']) / D(1e8)
-        fee = round(total_escrow * fee_fraction)
+        fee = None
+        if type(total_escrow) == type(bet_match['fee_fraction_int']) == int:
+            fee = util.exact_round(total_escrow * bet_match['fee_fraction_int'], 10 ** 8)
+        if fee == None:
+            fee_fraction = D(bet_match['fee_fraction_int']) / D(1e8)
+            fee = round(total_escrow * fee_fraction)
 
         # Get known bet match type IDs.
         cfd_type_id = util.BET_TYPE_ID['BullCFD'] + util.BET_TYPE_ID['BearCFD']
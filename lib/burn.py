@@ -71,6 +71,7 @@ def parse (db, tx, message=None):
 
         # Credit source address with earned XCP.
         util.credit(db, tx['block_index'], tx['source'], 'XCP', earned, event=tx['tx_hash'])
+        util.increment_supply(db, 'XCP', 'burned', earned)
     else:
         burned = 0
         earned = 0
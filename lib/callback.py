@@ -95,6 +95,7 @@ def parse (db, tx, message):
         assert call_price * callback_total == int(call_price * callback_total)
         util.debit(db, tx['block_index'], tx['source'], 'XCP', int(call_price * callback_total))
         util.credit(db, tx['block_index'], tx['source'], asset, callback_total)
+        util.increment_supply(db, asset, 'called_back', callback_total)
 
         # Holders.
         for output in outputs:
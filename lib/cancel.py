@@ -17,16 +17,24 @@ ID = 70
 def validate (db, offer_hash, source=None):
     problems = []
 
-    for offer in util.get_orders(db, validity='valid') + util.get_bets(db, validity='valid'):
-        if offer_hash == offer['tx_hash']:
-            if source == offer['source']:
-                return source, offer, problems
+    # Look the offer up by its (unique) hash.
+    cursor = db.cursor()
+    offers = []
+    for table in ('orders', 'bets'):
+        cursor.execute('''SELECT * FROM {} \
+                          WHERE (tx_hash = ? AND validity = ?)'''.format(table), (offer_hash, 'valid'))
+        offers += cursor.fetchall()
+    cursor.close()
+
+    for offer in offers:
+        if source == offer['source']:
+            return source, offer, problems
+        else:
+            if bitcoin.rpc('validateaddress', [offer['source']])['ismine'] or config.PREFIX == config.UNITTEST_PREFIX:
+                source = offer['source']
             else:
-                if bitcoin.rpc('validateaddress', [offer['source']])['ismine'] or config.PREFIX == config.UNITTEST_PREFIX:
-                    source = offer['source']
-                else:
-                    problems.append('offer was not made by one of your addresses')
-                return source, offer, problems
+                problems.append('offer was not made by one of your addresses')
+            return source, offer, problems
 
     problems.append('no valid offer with that hash')
     return None, None, problems
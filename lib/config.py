@@ -11,7 +11,7 @@ CLIENT_VERSION_MAJOR = 6
 CLIENT_VERSION_MINOR = 1
 CLIENT_VERSION = float(str(CLIENT_VERSION_MAJOR) + '.' + str(CLIENT_VERSION_MINOR))
 DB_VERSION_MAJOR = 8        # Major version changes the blocks or transactions table.
-DB_VERSION_MINOR = 0        # Minor version changes just the parsing.
+DB_VERSION_MINOR = 3        # Minor version changes just the parsing.
 DB_VERSION = float(str(DB_VERSION_MAJOR) + '.' + str(DB_VERSION_MINOR))
 
 # Bitcoin protocol
@@ -30,6 +30,17 @@ MAX_EXPIRATION = 4 * 2016   # Two months
 
 # SQLite3
 MAX_INT = 2**63 - 1
+COMPACT = False     # Intern addresses and assets in debits, credits and balances (for new databases).
+REPARSE_CHUNK_SIZE = 1000   # Blocks reparsed per transaction.
+UNDO_BLOCKS = 1000          # Last blocks whose changes are logged for undoing (see `blocks.reparse_from()`).
+BUSY_TIMEOUT = 10000        # Longest wait (in milliseconds) for a lock on the database.
+
+# API
+API_BATCH_LIMIT = 100   # Calls per JSON‐RPC batch request.
+API_FEED_LIMIT = 1000   # Messages per response from the message feed.
+API_FEED_TIMEOUT = 60   # Longest wait (in seconds) for new messages.
+API_FEED_WAITERS = 20   # Requests waiting at once for new messages.
+API_THREADS = 10        # Threads serving the API, besides those for waiters.
 
 # Order fees
 FEE_FRACTION_REQUIRED_DEFAULT = .0095  # 0.95%
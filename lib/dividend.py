@@ -76,6 +76,7 @@ def parse (db, tx, message):
     if validity == 'valid':
         # Debit.
         util.debit(db, tx['block_index'], tx['source'], 'XCP', amount)
+        util.increment_supply(db, asset, 'dividends', amount)
 
         # Credit.
         issuances = util.get_issuances(db, validity='valid', asset=asset)
@@ -23,6 +23,8 @@ class BitcoindError (Exception):
     pass
 class BitcoindRPCError (BitcoindError):
     pass
+class BitcoindUnavailableError (BitcoindRPCError):
+    pass
 class ZeroMQError (Exception):
     pass
 
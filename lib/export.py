@@ -0,0 +1,124 @@
+"""
+Export the message journal to segment files, and optionally prune it.
+
+Each segment holds the messages of (about) SEGMENT_BLOCKS blocks, as gzipped
+JSON lines, and follows on from the one before. Segments are only ever
+appended to: every export adds a new gzip member to the end of the current
+segment, which readers of gzip files (`zcat`, `gzip.open()`) see as one
+stream. Progress is kept in a state file in the
+export directory.
+"""
+
+import os
+import gzip
+import json
+import heapq
+import logging
+
+from . import (config, exceptions, util)
+
+SEGMENT_BLOCKS = 10000
+REORG_DEPTH = 10    # Messages of the last blocks may yet be rolled back (see `blocks.reorg()`).
+STATE_FILE = 'messages.json'
+
+def get_segment (block_index):
+    """Return the first block of the segment of block_index."""
+    return block_index - block_index % SEGMENT_BLOCKS
+
+def get_segment_path (directory, segment):
+    return os.path.join(directory, 'messages.{}-{}.jsonl.gz'.format(segment, segment + SEGMENT_BLOCKS - 1))
+
+def get_state (directory):
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {'message_index': -1, 'rollback_index': 0, 'segment': 0}
+
+def set_state (directory, state):
+    # Replace the state file atomically.
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(path + '.tmp', path)
+
+def export (db, directory, prune=False):
+    """Append the messages not yet exported to directory (other than those of
+    the last REORG_DEPTH blocks), and return the number written. If prune is
+    set, then delete exported messages from the database.
+    """
+    os.makedirs(directory, exist_ok=True)
+    state = get_state(directory)
+    cursor = db.cursor()
+
+    # Messages already exported must not have been rolled back since.
+    cursor.execute('''SELECT * FROM rollbacks WHERE (rollback_index > ? AND message_index < ?)''',
+                   (state['rollback_index'], state['message_index']))
+    if cursor.fetchall():
+        raise exceptions.DatabaseError('Exported messages have since been rolled back; export to an empty directory.')
+    cursor.execute('''SELECT MAX(rollback_index) AS rollback_index FROM rollbacks''')
+    rollback_index = cursor.fetchall()[0]['rollback_index'] or 0
+
+    # Export up to the first message of the last REORG_DEPTH blocks. (Messages
+    # are not strictly in block order.)
+    last_block_index = util.last_block(db)['block_index'] - REORG_DEPTH
+    cursor.execute('''SELECT MIN(message_index) AS message_index FROM messages WHERE block_index > ?''', (last_block_index,))
+    end_message_index = cursor.fetchall()[0]['message_index']
+    if end_message_index == None: end_message_index = config.MAX_INT
+    cursor.execute('''SELECT * FROM messages WHERE (message_index > ? AND message_index < ?) ORDER BY message_index''',
+                   (state['message_index'], end_message_index))
+    messages = cursor.fetchall()
+
+    # Write each segment’s messages as one gzip member. The block_index of a
+    # message doesn’t always increase with its message_index (e.g. for
+    # updates), so a message goes into the segment of its block or that of the
+    # message before it, whichever is later.
+    segment = state.get('segment', 0)
+    segments = []
+    for message in messages:
+        segment = max(segment, get_segment(message['block_index']))
+        path = get_segment_path(directory, segment)
+        if not segments or segments[-1][0] != path:
+            segments.append((path, []))
+        segments[-1][1].append(json.dumps(message, sort_keys=True) + '\n')
+    for path, lines in segments:
+        with gzip.open(path, 'ab') as segment_file:
+            segment_file.write(''.join(lines).encode('utf-8'))
+
+    if messages:
+        state['message_index'] = messages[-1]['message_index']
+    state['rollback_index'] = rollback_index
+    state['segment'] = segment
+    set_state(directory, state)
+    logging.info('Status: Exported {} messages (up to message {}) to {} segments.'.format(len(messages), state['message_index'], len(segments)))
+
+    if prune:
+        # Keep the last message, from which message indexes continue.
+        with db:
+            cursor.execute('''DELETE FROM messages WHERE (message_index <= ? AND \
+                              message_index < (SELECT MAX(message_index) FROM messages))''', (state['message_index'],))
+        logging.info('Status: Pruned messages up to message {}.'.format(state['message_index']))
+
+    cursor.close()
+    return len(messages)
+
+def read_segment (path):
+    with gzip.open(path, 'rb') as segment_file:
+        for line in segment_file:
+            yield json.loads(line.decode('utf-8'))
+
+def read (directory):
+    """Yield the exported messages, in order. (Messages written again after an
+    interrupted export are skipped.) Segments are merged by message index, for
+    those written before they followed on from each other.
+    """
+    paths = [path for path in os.listdir(directory) if path.startswith('messages.') and path.endswith('.jsonl.gz')]
+    segments = [read_segment(os.path.join(directory, path))
+                for path in sorted(paths, key=lambda path: int(path.split('.')[1].split('-')[0]))]
+    message_index = -1
+    for message in heapq.merge(*segments, key=lambda message: message['message_index']):
+        if message['message_index'] <= message_index: continue
+        message_index = message['message_index']
+        yield message
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
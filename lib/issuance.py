@@ -134,6 +134,7 @@ def parse (db, tx, message):
                 fee = config.ISSUANCE_FEE
             if fee:
                 util.debit(db, tx['block_index'], tx['source'], 'XCP', fee)
+                util.increment_supply(db, 'XCP', 'destroyed', fee)
 
     # Lock?
     if description and description.lower() == 'lock':
@@ -166,6 +167,7 @@ def parse (db, tx, message):
     # Credit.
     if validity == 'valid' and amount:
         util.credit(db, tx['block_index'], tx['source'], asset, amount)
+        util.increment_supply(db, asset, 'issued', amount)
 
     issuance_parse_cursor.close()
 
@@ -0,0 +1,76 @@
+"""
+An in‐process registry of counters, gauges and histograms, served at
+`/metrics` (see `api.APIServer`) in the Prometheus text exposition format.
+"""
+
+import threading
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)   # Seconds.
+
+METRICS = {
+    'counterpartyd_block_index': ('gauge', 'The index of the last block parsed.'),
+    'counterpartyd_bitcoind_block_count': ('gauge', 'The number of blocks in Bitcoind’s chain, when last asked.'),
+    'counterpartyd_blocks_behind': ('gauge', 'The number of blocks yet to be parsed.'),
+    'counterpartyd_block_parse_seconds': ('histogram', 'The time taken to parse each block, once fetched.'),
+    'counterpartyd_bitcoind_rpc_seconds': ('histogram', 'The time taken by each request to Bitcoind.'),
+    'counterpartyd_bitcoind_rpc_errors_total': ('counter', 'Requests to Bitcoind that failed to connect or timed out.'),
+    'counterpartyd_api_request_seconds': ('histogram', 'The time taken by each call to an API method.'),
+    'counterpartyd_api_errors_total': ('counter', 'Calls to API methods that raised an exception.'),
+    'counterpartyd_cache_hits_total': ('counter', 'Lookups answered from a cache.'),
+    'counterpartyd_cache_misses_total': ('counter', 'Lookups not answered from a cache.'),
+    'counterpartyd_database_bytes': ('gauge', 'The size of the database file.'),
+}
+
+lock = threading.Lock()
+values = {}         # Counters and gauges, by name and labels.
+histograms = {}     # Bucket counts, sum and count, by name and labels.
+
+def inc (name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        values[key] = values.get(key, 0) + amount
+
+def set_value (name, value, **labels):
+    with lock:
+        values[(name, tuple(sorted(labels.items())))] = value
+
+def observe (name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        if key not in histograms:
+            histograms[key] = [[0] * (len(BUCKETS) + 1), 0, 0]
+        histogram = histograms[key]
+        histogram[0][sum(value > bound for bound in BUCKETS)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def format_labels (labels):
+    if not labels: return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels) + '}'
+
+def render ():
+    """Return every metric in the text exposition format."""
+    lines = []
+    with lock:
+        for name, (metric_type, help_text) in sorted(METRICS.items()):
+            if metric_type == 'histogram':
+                series = sorted((labels, histogram) for (series_name, labels), histogram in histograms.items() if series_name == name)
+            else:
+                series = sorted((labels, value) for (series_name, labels), value in values.items() if series_name == name)
+            if not series: continue
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in series:
+                if metric_type == 'histogram':
+                    buckets, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(BUCKETS + ('+Inf',), buckets):
+                        cumulative += bucket_count
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+                else:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -66,9 +66,6 @@ def parse (db, tx, message):
 
     price = 0
     if validity == 'valid':
-        try: price = D(get_amount) / D(give_amount)
-        except: pass
-
         # Overorder
         order_parse_cursor.execute('''SELECT * FROM balances \
                                       WHERE (address = ? AND asset = ?)''', (tx['source'], give_asset))
@@ -76,8 +73,15 @@ def parse (db, tx, message):
         if give_asset != 'BTC':
             if not balances:  give_amount = 0
             elif balances[0]['amount'] < give_amount:
+                original_give_amount = give_amount
                 give_amount = min(balances[0]['amount'], give_amount)
-                get_amount = int(price * D(give_amount))
+                amount = util.exact_floor(get_amount * give_amount, original_give_amount,
+                                          util.decimal_exact(get_amount, original_give_amount))
+                if amount == None:
+                    try: price = D(get_amount) / D(original_give_amount)
+                    except: pass
+                    amount = int(price * D(give_amount))
+                get_amount = amount
 
         problems = validate(db, tx['source'], give_asset, give_amount, get_asset, get_amount, expiration, fee_required, tx['block_index'])
         if problems: validity = 'invalid: ' + ';'.join(problems)
@@ -113,6 +117,64 @@ def parse (db, tx, message):
 
     order_parse_cursor.close()
 
+def sort_by_price (orders):
+    """Sort orders by price (get_amount / give_amount), stably, as a Decimal
+    key would. Correctly rounded float keys sort them the same way, except
+    where two prices are so close that rounding might matter.
+    """
+    if all(type(order['get_amount']) == type(order['give_amount']) == int and order['get_amount'] >= 0 and order['give_amount'] > 0
+           for order in orders):
+        keyed = sorted(((order['get_amount'] / order['give_amount'], order) for order in orders), key=lambda x: x[0])
+        for (key0, order0), (key1, order1) in zip(keyed, keyed[1:]):
+            if key1 - key0 <= key1 * 1e-14 and util.exact_compare(order0['get_amount'], order0['give_amount'],
+                                                                   order1['get_amount'], order1['give_amount']) not in (-1, 0):
+                break
+        else:
+            return [order for key, order in keyed]
+    return sorted(orders, key=lambda x: D(x['get_amount']) / D(x['give_amount']))
+
+def get_match_amounts_decimal (block_index, tx0, tx1, tx0_give_remaining, tx1_give_remaining):
+    tx0_price = util.price(tx0['get_amount'], tx0['give_amount'])
+    tx1_price = util.price(tx1['get_amount'], tx1['give_amount'])
+    tx1_inverse_price = util.price(tx1['give_amount'], tx1['get_amount'])
+
+    # NOTE: Old protocol.
+    if block_index < 286000: tx1_inverse_price = D(1) / tx1_price
+
+    if tx0_price <= tx1_inverse_price:
+        forward_amount = int(min(tx0_give_remaining, D(tx1_give_remaining) / tx0_price))
+        backward_amount = round(forward_amount * tx0_price)
+        return forward_amount, backward_amount
+    return None
+
+def get_match_amounts (block_index, tx0, tx1, tx0_give_remaining, tx1_give_remaining):
+    """Return the amounts that tx0 and tx1 trade (forward and backward), if
+    their prices agree, computed with integers where that gives the same
+    result as `get_match_amounts_decimal()` (see `util.exact_compare()`).
+    """
+    tx0_get, tx0_give, tx1_get, tx1_give = tx0['get_amount'], tx0['give_amount'], tx1['get_amount'], tx1['give_amount']
+    if not (type(tx0_get) == type(tx0_give) == type(tx1_get) == type(tx1_give) == type(tx0_give_remaining) == type(tx1_give_remaining) == int
+            and min(tx0_get, tx0_give, tx1_get, tx1_give) > 0 and min(tx0_give_remaining, tx1_give_remaining) >= 0):
+        return get_match_amounts_decimal(block_index, tx0, tx1, tx0_give_remaining, tx1_give_remaining)
+
+    # tx0’s price must be no greater than the inverse of tx1’s. (Under the old
+    # protocol, that inverse is rounded twice, so exactly equal prices might
+    # not compare as equal, unless both are exact.)
+    exact = util.decimal_exact(tx0_get, tx0_give)
+    comparison = util.exact_compare(tx0_get, tx0_give, tx1_give, tx1_get)
+    if comparison == None or (comparison == 0 and block_index < 286000 and not (exact and util.decimal_exact(tx1_get, tx1_give))):
+        return get_match_amounts_decimal(block_index, tx0, tx1, tx0_give_remaining, tx1_give_remaining)
+    if comparison > 0: return None
+
+    # Where either amount can’t be computed exactly, fall back on Decimal for it alone.
+    forward_amount = util.exact_min_floor(tx0_give_remaining, tx1_give_remaining * tx0_give, tx0_get, exact)
+    if forward_amount == None:
+        forward_amount = int(min(tx0_give_remaining, D(tx1_give_remaining) / util.price(tx0_get, tx0_give)))
+    backward_amount = util.exact_round(forward_amount * tx0_get, tx0_give, exact)
+    if backward_amount == None:
+        backward_amount = round(forward_amount * util.price(tx0_get, tx0_give))
+    return forward_amount, backward_amount
+
 def match (db, tx):
     cursor = db.cursor()
 
@@ -131,7 +193,7 @@ def match (db, tx):
     order_matches = cursor.fetchall()
     if tx['block_index'] > 284500:  # For backwards‐compatibility (no sorting before this block).
         order_matches = sorted(order_matches, key=lambda x: x['tx_index'])                              # Sort by tx index second.
-        order_matches = sorted(order_matches, key=lambda x: D(x['get_amount']) / D(x['give_amount']))   # Sort by price first.
+        order_matches = sort_by_price(order_matches)                                                    # Sort by price first.
 
     # Get fee remaining.
     tx1_fee_remaining = tx1['fee_remaining']
@@ -148,16 +210,9 @@ def match (db, tx):
 
         # If the prices agree, make the trade. The found order sets the price,
         # and they trade as much as they can.
-        tx0_price = util.price(tx0['get_amount'], tx0['give_amount'])
-        tx1_price = util.price(tx1['get_amount'], tx1['give_amount'])
-        tx1_inverse_price = util.price(tx1['give_amount'], tx1['get_amount'])
-
-        # NOTE: Old protocol.
-        if tx['block_index'] < 286000: tx1_inverse_price = D(1) / tx1_price
-
-        if tx0_price <= tx1_inverse_price:
-            forward_amount = int(min(tx0_give_remaining, D(tx1_give_remaining) / tx0_price))
-            backward_amount = round(forward_amount * tx0_price)
+        amounts = get_match_amounts(tx['block_index'], tx0, tx1, tx0_give_remaining, tx1_give_remaining)
+        if amounts:
+            forward_amount, backward_amount = amounts
 
             if not forward_amount: continue
             if tx1['block_index'] >= 286500:    # Protocol change.
@@ -166,11 +221,13 @@ def match (db, tx):
             # Check and update fee remainings.
             if tx1['block_index'] >= 286500: # Deduct fee_required from fee_remaining, if possible (else don’t match).
                 if tx1['get_asset'] == 'BTC':
-                    fee = int(D(tx1['fee_required']) * D(forward_amount) / D(tx1_get_remaining))
+                    fee = util.exact_floor(tx1['fee_required'] * forward_amount, tx1_get_remaining)
+                    if fee == None: fee = int(D(tx1['fee_required']) * D(forward_amount) / D(tx1_get_remaining))
                     if tx0_fee_remaining < fee: continue
                     else: tx0_fee_remaining -= fee
                 elif tx1['give_asset'] == 'BTC':
-                    fee = int(D(tx0['fee_required']) * D(backward_amount) / D(tx0_get_remaining))
+                    fee = util.exact_floor(tx0['fee_required'] * backward_amount, tx0_get_remaining)
+                    if fee == None: fee = int(D(tx0['fee_required']) * D(backward_amount) / D(tx0_get_remaining))
                     if tx1_fee_remaining < fee: continue
                     else: tx1_fee_remaining -= fee 
             else:   # Don’t deduct.
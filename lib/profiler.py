@@ -0,0 +1,117 @@
+"""
+Opt‐in instrumentation of parsing: wall time, SQL statements executed (counted
+by `util.exectracer()`) and rows changed, by message type, by function and by
+block; and cProfile output for a range of blocks.
+"""
+
+import os
+import time
+import logging
+import threading
+import collections
+import contextlib
+import cProfile
+
+from . import config
+
+WINDOW = 1000       # Samples kept for each rolling histogram.
+BLOCK_WINDOW = 100  # Recent blocks kept.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)    # Seconds.
+
+enabled = False
+profile_range = None    # (first_block, last_block), for cProfile.
+profile = None
+
+counters = threading.local()    # Statements executed by each thread.
+stats_lock = threading.Lock()
+stats = {'message_types': {}, 'functions': {}}
+recent_blocks = collections.deque(maxlen=BLOCK_WINDOW)
+
+def enable (first_block=None, last_block=None):
+    """Record parse statistics and, if a block range is given, profile the
+    parsing of those blocks.
+    """
+    global enabled, profile_range
+    enabled = True
+    if first_block != None: profile_range = (first_block, last_block)
+
+def count_statement ():
+    counters.statements = getattr(counters, 'statements', 0) + 1
+
+def record (scope, name, seconds, statements, rows):
+    with stats_lock:
+        if name not in stats[scope]:
+            stats[scope][name] = {'count': 0, 'seconds': 0, 'statements': 0, 'rows': 0, 'samples': collections.deque(maxlen=WINDOW)}
+        entry = stats[scope][name]
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['statements'] += statements
+        entry['rows'] += rows
+        entry['samples'].append(seconds)
+
+@contextlib.contextmanager
+def measure (db, scope, name):
+    """Record the time taken, statements executed and rows changed by the
+    block of code, under name, in scope.
+    """
+    if not enabled:
+        yield
+        return
+    start, statements, rows = time.perf_counter(), getattr(counters, 'statements', 0), db.totalchanges()
+    yield
+    record(scope, name, time.perf_counter() - start, getattr(counters, 'statements', 0) - statements, db.totalchanges() - rows)
+
+@contextlib.contextmanager
+def measure_block (db, block_index):
+    """Measure the parsing of a block, and profile it if it is in range."""
+    global profile
+    if not enabled:
+        yield
+        return
+    in_range = profile_range and profile_range[0] <= block_index <= profile_range[1]
+    if in_range:
+        if not profile: profile = cProfile.Profile()
+        profile.enable()
+    start, statements, rows = time.perf_counter(), getattr(counters, 'statements', 0), db.totalchanges()
+    try:
+        yield
+    finally:
+        if in_range: profile.disable()
+    seconds, statements, rows = time.perf_counter() - start, getattr(counters, 'statements', 0) - statements, db.totalchanges() - rows
+    if in_range and block_index == profile_range[1]: dump_profile()
+
+    record('functions', 'parse_block', seconds, statements, rows)
+    with stats_lock:
+        recent_blocks.append({'block_index': block_index, 'seconds': seconds, 'statements': statements, 'rows': rows})
+
+def dump_profile ():
+    global profile
+    path = os.path.join(config.DATA_DIR, 'parse.{}-{}.prof'.format(*profile_range))
+    profile.dump_stats(path)
+    profile = None
+    logging.info('Status: Wrote profile of blocks {} to {} to {}.'.format(profile_range[0], profile_range[1], path))
+
+def get_parse_stats ():
+    """Return, for each message type and each instrumented function, the number
+    of calls, the total time taken, statements executed and rows changed, and a
+    cumulative histogram of the times of the last WINDOW calls; and the totals
+    for each of the last BLOCK_WINDOW blocks parsed.
+    """
+    result = {'enabled': enabled, 'message_types': {}, 'functions': {}}
+    with stats_lock:
+        for scope in ('message_types', 'functions'):
+            for name, entry in sorted(stats[scope].items()):
+                buckets = [0] * (len(BUCKETS) + 1)
+                for seconds in entry['samples']:
+                    buckets[sum(seconds > bound for bound in BUCKETS)] += 1
+                cumulative = 0
+                histogram = []
+                for bound, count in zip(BUCKETS + (None,), buckets):
+                    cumulative += count
+                    histogram.append({'le': bound, 'count': cumulative})
+                result[scope][name] = {'count': entry['count'], 'seconds': entry['seconds'], 'statements': entry['statements'],
+                                       'rows': entry['rows'], 'histogram': histogram}
+        result['blocks'] = list(recent_blocks)
+    return result
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
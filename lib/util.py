@@ -9,11 +9,16 @@ import logging
 import operator
 from operator import itemgetter
 import apsw
+import binascii
 import collections
+import threading
+import weakref
+import functools
+import concurrent.futures
 import inspect
 import requests
 
-from . import (config, exceptions)
+from . import (config, exceptions, profiler)
 
 b26_digits = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
@@ -49,6 +54,62 @@ def price (numerator, denominator):
     denominator = D(denominator)
     return D(numerator / denominator)
 
+# Prices and amounts are computed exactly, with integers, wherever that gives
+# the same result as Decimal (with its default precision of 28 significant
+# digits): that is, wherever the Decimal operands are exact, and so is the
+# result; or wherever the exact result is further from a rounding boundary
+# than the handful of Decimal roundings in each expression (each off by at most
+# half a part in 10^27) could move it. Elsewhere, the functions below return
+# None, and callers fall back on Decimal.
+EXACT_MARGIN = 10 ** 26
+
+def decimal_exact (numerator, denominator):
+    """Whether a quotient of non‐negative integers is exact as a Decimal
+    (conservatively: whether it has at most ten decimal places, and at most
+    eighteen digits before the point).
+    """
+    return numerator < denominator * 10 ** 18 and numerator * 10 ** 10 % denominator == 0
+
+def exact_compare (numerator0, denominator0, numerator1, denominator1):
+    """Compare two quotients of positive integers, returning -1, 0 or 1."""
+    left, right = numerator0 * denominator1, numerator1 * denominator0
+    if left == right: return 0
+    if abs(left - right) * EXACT_MARGIN <= max(left, right): return None
+    return 1 if left > right else -1
+
+def exact_floor (numerator, denominator, exact=False):
+    """Truncate a quotient of non‐negative integers, as `int()` does a Decimal.
+    If exact is set, then the Decimal was computed from exact operands.
+    """
+    if denominator <= 0 or numerator < 0: return None
+    quotient, remainder = divmod(numerator, denominator)
+    if exact and not remainder and quotient < 10 ** 28: return quotient
+    if remainder * EXACT_MARGIN < numerator or (denominator - remainder) * EXACT_MARGIN <= numerator: return None
+    return quotient
+
+def exact_round (numerator, denominator, exact=False):
+    """Round a quotient of non‐negative integers, as `round()` does a Decimal
+    (half to even). If exact is set, then the Decimal was computed from exact
+    operands.
+    """
+    if denominator <= 0 or numerator < 0: return None
+    quotient, remainder = divmod(numerator, denominator)
+    if exact and decimal_exact(numerator, denominator):
+        return quotient + (2 * remainder > denominator or (2 * remainder == denominator and quotient % 2))
+    if abs(2 * remainder - denominator) * EXACT_MARGIN <= 2 * numerator: return None
+    return quotient + (2 * remainder > denominator)
+
+def exact_min_floor (amount, numerator, denominator, exact=False):
+    """Compute `int(min(amount, quotient))` for non‐negative integers, where
+    quotient is numerator / denominator, as a Decimal. If exact is set, then
+    the Decimal was computed from exact operands.
+    """
+    if denominator <= 0 or numerator < 0: return None
+    if exact and not numerator % denominator and numerator // denominator < 10 ** 28: return min(amount, numerator // denominator)
+    if (numerator - amount * denominator) * EXACT_MARGIN >= numerator: return amount
+    if (amount * denominator - numerator) * EXACT_MARGIN > numerator: return exact_floor(numerator, denominator)
+    return None
+
 def log (db, command, category, bindings):
 
     # Slow?!
@@ -169,41 +230,115 @@ def log (db, command, category, bindings):
         elif category == 'bet_match_expirations':
             logging.info('Expired Bet Match: {}'.format(bindings['bet_match_id']))
         
+ROW_FACTORY_CACHE_SIZE = 256   # Sets of column names.
+
+@functools.lru_cache(maxsize=ROW_FACTORY_CACHE_SIZE)
+def get_row_factory (names):
+    """Return a function which makes a dict of a row with the given column
+    names, compiled once for them.
+    """
+    return eval('lambda row: {' + ', '.join('{!r}: row[{}]'.format(name, index) for index, name in enumerate(names)) + '}')
+
+# The description of the last statement whose rows were traced, and its row
+# factory. (apsw returns the same description object for each row of a
+# statement.)
+last_row_factory = (None, None)
+
 def rowtracer(cursor, sql):
     """Converts fetched SQL data into dict-style"""
-    dictionary = {}
-    for index, (name, type_) in enumerate(cursor.getdescription()):
-        dictionary[name] = sql[index]
-    return dictionary
-
-def exectracer(cursor, sql, bindings):
+    global last_row_factory
+    description, row_factory = last_row_factory
+    if cursor.getdescription() is not description:
+        description = cursor.getdescription()
+        row_factory = get_row_factory(tuple(name for name, type_ in description))
+        last_row_factory = (description, row_factory)
+    return row_factory(sql)
+
+CLASSIFICATION_CACHE_SIZE = 1024    # SQL texts classified by `classify()`.
+
+@functools.lru_cache(maxsize=CLASSIFICATION_CACHE_SIZE)
+def classify (sql):
+    """Return the command and category of a statement that changes the
+    database, and whether the change is journalled, or None for a statement
+    that is neither journalled nor logged.
+    """
     # This means that all changes to database must use a very simple syntax.
         # TODO: Need sanity checks here.
     sql = sql.lower()
 
     # Parse SQL.
     array = sql.split('(')[0].split(' ')
-    if 'insert' in sql:
+    if array[0] == 'create':    # Triggers contain inserts and updates.
+        return None
+    elif 'insert' in sql:
         command, category = array[0], array[2]
     elif 'update' in sql:
         command, category = array[0], array[1]
     else:
-        return True
-
-    db = cursor.getconnection()
-    dictionary = {'command': command, 'category': category, 'bindings': bindings}
+        return None
 
     # Skip blocks, transactions.
-    if 'blocks' in sql or 'transactions' in sql or 'potentials' in sql: return True
+    if 'blocks' in sql or 'transactions' in sql or 'potentials' in sql: return None
+
+    return command, category, category not in ('balances', 'messages', 'supplies', 'rollbacks', 'reparses', 'undolog_state')
+
+# Statements executed for nearly every message, by name (see `execute()`), and
+# their classifications, by SQL text, for `exectracer()`.
+statements = {}
+classifications = {}
+
+class Connection (apsw.Connection):
+    """A database connection, which keeps the cursors of its named statements
+    by name. (They refer to the connection, so a registry of them apart from
+    it would keep it open.)
+    """
+    def __init__ (self, *args, **kwargs):
+        apsw.Connection.__init__(self, *args, **kwargs)
+        self.cursors = {}
+
+def register (name, sql):
+    """Name a statement, and classify it once for the journal."""
+    statements[name] = sql
+    classifications[sql] = classify(sql)
+
+def execute (db, name, bindings=()):
+    """Execute the named statement, with the same SQL text each time (so that
+    apsw’s statement cache always hits), on a cursor of its own, which is
+    reused until `release_cursors()`; and return the rows fetched.
+    """
+    try:
+        cursor = db.cursors[name]
+    except KeyError:
+        cursor = db.cursors[name] = db.cursor()
+    cursor.execute(statements[name], bindings)
+    return cursor.fetchall()
+
+def release_cursors (db):
+    for cursor in db.cursors.values():
+        cursor.close()
+    db.cursors.clear()
+
+register('get_last_message', '''SELECT * FROM messages WHERE message_index = (SELECT MAX(message_index) from messages)''')
+register('insert_message', 'insert into messages values(:message_index, :block_index, :command, :category, :bindings)')
+
+def exectracer(cursor, sql, bindings):
+    if profiler.enabled: profiler.count_statement()
+
+    try:
+        classification = classifications[sql]
+    except KeyError:
+        classification = classify(sql)
+    if not classification: return True
+    command, category, journalled = classification
+
+    db = cursor.getconnection()
 
     # Record alteration in database.
-    if not category in ('balances', 'messages'):
-        cursor = db.cursor()
+    if journalled:
 
         # Get last message index.
-        cursor.execute('''SELECT * FROM messages WHERE message_index = (SELECT MAX(message_index) from messages)''')
         try:
-            message_index = cursor.fetchall()[0]['message_index'] + 1
+            message_index = execute(db, 'get_last_message')[0]['message_index'] + 1
         except IndexError:
             message_index = 0
 
@@ -218,24 +353,25 @@ def exectracer(cursor, sql, bindings):
                 block_index = last_block(db)['block_index'] + 1   # TODO: Double‐check that this is correct.
 
         bindings_string = json.dumps(collections.OrderedDict(sorted(bindings.items())))
-        cursor.execute('insert into messages values(:message_index, :block_index, :command, :category, :bindings)',
-                       (message_index, block_index, command, category, bindings_string))
-
-        message_index += 1
-        cursor.close()
+        execute(db, 'insert_message', (message_index, block_index, command, category, bindings_string))
 
     # Log.
     log(db, command, category, bindings)
 
     return True
 
-def connect_to_db(flags=None):
+def unhex (hex_string):
+    if hex_string == None: return None
+    return binascii.unhexlify(hex_string)
+
+def connect_to_db(flags=None, database=None):
     """Connects to the SQLite database, returning a db Connection object"""
+    if database == None: database = config.DATABASE
 
     if flags == None:
-        db = apsw.Connection(config.DATABASE)
+        db = Connection(database)
     elif flags == 'SQLITE_OPEN_READONLY':
-        db = apsw.Connection(config.DATABASE, flags=0x00000001)
+        db = Connection(database, flags=0x00000001)
     else: raise Exception # TODO
 
     cursor = db.cursor()
@@ -246,6 +382,13 @@ def connect_to_db(flags=None):
     # For integrity, security.
     cursor.execute('''PRAGMA foreign_keys = ON''')
 
+    # So that readers (e.g. API requests, each in a transaction of its own)
+    # see a snapshot without blocking the parser’s commits; and so that any
+    # lock which is held is waited for, rather than failed on.
+    if flags == None:
+        cursor.execute('''PRAGMA journal_mode = WAL''')
+    db.setbusytimeout(config.BUSY_TIMEOUT)
+
     """
     cursor.execute('''PRAGMA foreign_key_check''')
     if rows:
@@ -270,6 +413,9 @@ def connect_to_db(flags=None):
 
     cursor.close()
 
+    # For compact storage.
+    db.createscalarfunction('unhex', unhex, 1)
+
     db.setrowtrace(rowtracer)
     db.setexectrace(exectracer)
 
@@ -329,6 +475,17 @@ def last_block (db):
     cursor.close()
     return last_block
 
+def get_reparse (db):
+    """Return the progress of an unfinished reparse (see `blocks.reparse()`),
+    if there is one.
+    """
+    cursor = db.cursor()
+    cursor.execute('''SELECT * FROM sqlite_master WHERE (type = ? AND name = ?)''', ('table', 'reparses'))
+    reparses = cursor.fetchall() and cursor.execute('''SELECT * FROM reparses''').fetchall()
+    cursor.close()
+    if reparses: return reparses[0]
+    return None
+
 def get_asset_id (asset):
     # Special cases.
     if asset == 'BTC': return 0
@@ -379,16 +536,19 @@ def get_asset_name (asset_id):
     return asset_name
 
 
+register('get_balance', '''SELECT * FROM balances WHERE (address = ? AND asset = ?)''')
+register('insert_balance', 'insert into balances values(:address, :asset, :amount)')
+register('update_balance', 'update balances set amount = :amount where (address = :address and asset = :asset)')
+register('insert_debit', 'insert into debits values(:block_index, :address, :asset, :amount, :action, :event)')
+register('insert_credit', 'insert into credits values(:block_index, :address, :asset, :amount, :action, :event)')
+
 def debit (db, block_index, address, asset, amount, action=None, event=None):
-    debit_cursor = db.cursor()
     assert asset != 'BTC' # Never BTC.
     assert type(amount) == int
     if asset == 'BTC':
         raise exceptions.BalanceError('Cannot debit bitcoins from a Counterparty address!')
 
-    debit_cursor.execute('''SELECT * FROM balances \
-                            WHERE (address = ? AND asset = ?)''', (address, asset))
-    balances = debit_cursor.fetchall()
+    balances = execute(db, 'get_balance', (address, asset))
     if not len(balances) == 1: old_balance = 0
     else: old_balance = balances[0]['amount']
 
@@ -403,8 +563,7 @@ def debit (db, block_index, address, asset, amount, action=None, event=None):
         'address': address,
         'asset': asset
     }
-    sql='update balances set amount = :amount where (address = :address and asset = :asset)'
-    debit_cursor.execute(sql, bindings)
+    execute(db, 'update_balance', bindings)
 
     # Record debit.
     bindings = {
@@ -415,19 +574,13 @@ def debit (db, block_index, address, asset, amount, action=None, event=None):
         'action': action,
         'event': event
     }
-    sql='insert into debits values(:block_index, :address, :asset, :amount, :action, :event)'
-    debit_cursor.execute(sql, bindings)
-
-    debit_cursor.close()
+    execute(db, 'insert_debit', bindings)
 
 def credit (db, block_index, address, asset, amount, action=None, event=None):
-    credit_cursor = db.cursor()
     assert asset != 'BTC' # Never BTC.
     assert type(amount) == int
 
-    credit_cursor.execute('''SELECT * FROM balances \
-                             WHERE (address = ? AND asset = ?)''', (address, asset))
-    balances = credit_cursor.fetchall()
+    balances = execute(db, 'get_balance', (address, asset))
     if len(balances) == 0:
         assert balances == []
 
@@ -437,8 +590,7 @@ def credit (db, block_index, address, asset, amount, action=None, event=None):
             'asset': asset,
             'amount': amount,
         }
-        sql='insert into balances values(:address, :asset, :amount)'
-        credit_cursor.execute(sql, bindings)
+        execute(db, 'insert_balance', bindings)
     elif len(balances) > 1:
         raise Exception
     else:
@@ -452,8 +604,7 @@ def credit (db, block_index, address, asset, amount, action=None, event=None):
             'address': address,
             'asset': asset
         }
-        sql='update balances set amount = :amount where (address = :address and asset = :asset)'
-        credit_cursor.execute(sql, bindings)
+        execute(db, 'update_balance', bindings)
 
     # Record credit.
     bindings = {
@@ -464,9 +615,7 @@ def credit (db, block_index, address, asset, amount, action=None, event=None):
         'action': action,
         'event': event
     }
-    sql='insert into credits values(:block_index, :address, :asset, :amount, :action, :event)'
-    credit_cursor.execute(sql, bindings)
-    credit_cursor.close()
+    execute(db, 'insert_credit', bindings)
 
 def devise (db, quantity, asset, dest, divisible=None):
 
@@ -539,13 +688,10 @@ DO_FILTER_OPERATORS = {
     '>=': operator.ge,
 }
 
-def do_filter(results, filters, filterop):
-    """Filters results based on a filter data structure (as used by the API)"""
-    if not len(results) or not filters: #empty results, or not filtering
-        return results
-    if isinstance(filters, dict): #single filter entry, convert to a one entry list
-        filters = [filters,]
-    #validate filter(s)
+def validate_filters(filters, filterop, fields):
+    """Check filters against the fields of the object type, whether or not
+    there are any results to filter.
+    """
     required_fields = ['field', 'op', 'value']
     for filter in filters:
         for field in required_fields: #should have all fields
@@ -557,11 +703,21 @@ def do_filter(results, filters, filterop):
             raise Exception("A specified filter op is invalid or not recognized: '%s'" % filter['op'])
         if filter['field'] == 'block_index':
             raise Exception("For performance reasons, please use the start_block and end_block API arguments to do block_index filtering")
-        if filter['field'] not in results[0]:
+        if filter['field'] not in fields:
             raise Exception("A specified filter field is invalid or not recognized for the given object type: '%s'" % filter['field'])
         if type(filter['value']) not in (str, int, float, bool):
             raise Exception("Value specified for filter field '%s' is not one of the supported value types (str, int, float, bool)" % (
                 filter['field']))
+
+def do_filter(results, filters, filterop):
+    """Filters results based on a filter data structure (as used by the API)"""
+    if not len(results) or not filters: #empty results, or not filtering
+        return results
+    if isinstance(filters, dict): #single filter entry, convert to a one entry list
+        filters = [filters,]
+    #validate filter(s)
+    validate_filters(filters, filterop, results[0])
+    for filter in filters:
         if results[0][filter['field']] != None and filter['value'] != None and type(filter['value']) != type(results[0][filter['field']]):
             # field is None when it does not matter.
             raise Exception("Value specified for filter field '%s' does not match the data type of that field (value: %s, field: %s) and neither is None" % (
@@ -623,22 +779,130 @@ def get_limit_to_blocks(start_block, end_block, col_names=['block_index',]):
                 col_names[0], end_block, col_names[1], end_block)
     return block_limit_clause
 
+# Fields with an index (see `blocks.initialise()`) on which equality filters
+# are worth handing to SQLite.
+INDEXED_FIELDS = {
+    'debits': ('address', 'asset'),
+    'credits': ('address', 'asset'),
+    'balances': ('address', 'asset'),
+    'sends': ('source', 'destination'),
+    'orders': ('source',),
+    'order_matches': ('tx0_hash', 'tx1_hash'),
+    'btcpays': ('source', 'destination'),
+    'issuances': ('issuer',),
+    'broadcasts': ('source',),
+    'bets': ('source',),
+    'bet_matches': ('tx0_hash', 'tx1_hash'),
+    'dividends': ('source',),
+    'burns': ('source',),
+    'cancels': ('source',),
+    'callbacks': ('source',),
+    'bet_expirations': ('source',),
+    'order_expirations': ('source',),
+}
+
+table_infos = weakref.WeakKeyDictionary()   # Columns and insertion orders, by connection and table.
 
-def xcp_supply (db):
+def get_table_info (db, table):
+    """Return the columns of table, and an ORDER BY clause which keeps its rows
+    in the order in which they were inserted (unless table is a view onto
+    compact storage, which has no rowid). Cached per connection, until the
+    storage may have changed (see blocks.parse_blocks()).
+    """
+    infos = table_infos.setdefault(db, {})
+    if table not in infos:
+        cursor = db.cursor()
+        columns = [column['name'] for column in cursor.execute('''PRAGMA table_info({})'''.format(table))]
+        cursor.execute('''SELECT * FROM sqlite_master WHERE (type = ? AND name = ?)''', ('table', table))
+        is_table = bool(cursor.fetchall())
+        cursor.close()
+        infos[table] = (columns, ''' ORDER BY rowid''' if is_table else '')
+    return infos[table]
+
+def get_insertion_order (db, table):
+    return get_table_info(db, table)[1]
+
+def select_rows (db, table, filters, filterop, start_block, end_block, col_names=['block_index',], address=None):
+    """Return the rows of table which may pass do_filter(). Equality filters
+    on indexed fields, and address (for the matches tables), narrow the query
+    down; the rest of the filtering is left to do_filter().
+    """
+    columns, insertion_order = get_table_info(db, table)
+    if filters: validate_filters(filters, filterop, columns)
+
+    conditions, bindings = [], []
+    block_limit_clause = get_limit_to_blocks(start_block, end_block, col_names=col_names)
+    if block_limit_clause:
+        conditions.append('({})'.format(block_limit_clause.replace(' WHERE ', '', 1)))
+
+    indexed = [filter for filter in filters if filter.get('op') == '=='
+               and filter.get('field') in INDEXED_FIELDS.get(table, ())
+               and type(filter.get('value')) in (str, int)]
+    if filterop == 'and':
+        for filter in indexed:
+            conditions.append('{} = ?'.format(filter['field']))
+            bindings.append(filter['value'])
+    elif filterop == 'or':
+        # Validity is ANDed even then (see do_filter()).
+        others = [filter for filter in filters if filter.get('field') != 'validity']
+        if others and all(filter in indexed for filter in others):
+            conditions.append('({})'.format(' OR '.join('{} = ?'.format(filter['field']) for filter in others)))
+            bindings += [filter['value'] for filter in others]
+    if address:
+        conditions.append('(tx0_address = ? OR tx1_address = ?)')
+        bindings += [address, address]
+
+    sql = '''SELECT * FROM {}'''.format(table)
+    if conditions: sql += ''' WHERE ''' + ' AND '.join(conditions)
+    sql += insertion_order
     cursor = db.cursor()
+    cursor.execute(sql, bindings)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
 
-    # Add burns.
-    cursor.execute('''SELECT * FROM burns \
-                      WHERE validity = ?''', ('valid',))
-    burn_total = sum([burn['earned'] for burn in cursor.fetchall()])
+SUPPLY_FIELDS = ('issued', 'burned', 'destroyed', 'dividends', 'called_back')
 
-    # Subtract issuance fees.
-    cursor.execute('''SELECT * FROM issuances\
-                      WHERE validity = ?''', ('valid',))
-    fee_total = sum([issuance['fee_paid'] for issuance in cursor.fetchall()])
+register('get_supply', '''SELECT * FROM supplies WHERE asset = ?''')
+register('insert_supply', 'insert into supplies values(:asset, :issued, :burned, :destroyed, :dividends, :called_back)')
+for field in SUPPLY_FIELDS:
+    register('increment_' + field, 'update supplies set {0} = {0} + :amount where asset = :asset'.format(field))
 
+def increment_supply (db, asset, field, amount):
+    """Add amount to one of the running totals kept for asset (see
+    SUPPLY_FIELDS): these are derived from the parsed messages, so they are
+    rolled back along with everything else.
+    """
+    assert field in SUPPLY_FIELDS
+    assert type(amount) == int
+
+    if not execute(db, 'get_supply', (asset,)):
+        bindings = {field_: 0 for field_ in SUPPLY_FIELDS}
+        bindings['asset'] = asset
+        bindings[field] = amount
+        execute(db, 'insert_supply', bindings)
+    else:
+        bindings = {
+            'amount': amount,
+            'asset': asset
+        }
+        execute(db, 'increment_' + field, bindings)
+
+def get_supply (db, asset):
+    cursor = db.cursor()
+    cursor.execute('''SELECT * FROM supplies WHERE asset = ?''', (asset,))
+    supplies = cursor.fetchall()
     cursor.close()
-    return burn_total - fee_total
+    if supplies: return supplies[0]
+    supply = {field: 0 for field in SUPPLY_FIELDS}
+    supply['asset'] = asset
+    return supply
+
+def xcp_supply (db):
+    # Burns, less issuance fees.
+    supply = get_supply(db, 'XCP')
+    return supply['burned'] - supply['destroyed']
 
 def get_debits (db, address=None, asset=None, filters=None, order_by=None, order_dir='asc', start_block=None, end_block=None, filterop='and'):
     """This does not include BTC."""
@@ -646,11 +910,8 @@ def get_debits (db, address=None, asset=None, filters=None, order_by=None, order
     if filters and not isinstance(filters, list): filters = [filters,]
     if address: filters.append({'field': 'address', 'op': '==', 'value': address})
     if asset: filters.append({'field': 'asset', 'op': '==', 'value': asset})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM debits%s'''
-        % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'debits', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_credits (db, address=None, asset=None, filters=None, order_by=None, order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -659,11 +920,8 @@ def get_credits (db, address=None, asset=None, filters=None, order_by=None, orde
     if filters and not isinstance(filters, list): filters = [filters,]
     if address: filters.append({'field': 'address', 'op': '==', 'value': address})
     if asset: filters.append({'field': 'asset', 'op': '==', 'value': asset})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM credits%s'''
-        % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'credits', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_balances (db, address=None, asset=None, filters=None, order_by=None, order_dir='asc', filterop='and'):
@@ -672,10 +930,8 @@ def get_balances (db, address=None, asset=None, filters=None, order_by=None, ord
     if filters and not isinstance(filters, list): filters = [filters,]
     if address: filters.append({'field': 'address', 'op': '==', 'value': address})
     if asset: filters.append({'field': 'asset', 'op': '==', 'value': asset})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM balances''')
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'balances', filters, filterop, None, None)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_sends (db, validity=None, source=None, destination=None, filters=None, order_by='tx_index', order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -684,18 +940,15 @@ def get_sends (db, validity=None, source=None, destination=None, filters=None, o
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
     if destination: filters.append({'field': 'destination', 'op': '==', 'value': destination})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM sends%s'''
-        % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'sends', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_orders (db, validity=None, source=None, show_empty=True, show_expired=True, filters=None, order_by=None, order_dir='asc', start_block=None, end_block=None, filterop='and'):
     def filter_expired(e):
         #Ignore BTC orders one block early. (This is why we need show_expired.)
         #function returns True if the element is NOT expired
-        time_left = e['expire_index'] - last_block(db)['block_index']
+        time_left = e['expire_index'] - block_index
         if e['give_asset'] == 'BTC': time_left -= 1
         return False if time_left < 0 else True
 
@@ -704,12 +957,11 @@ def get_orders (db, validity=None, source=None, show_empty=True, show_expired=Tr
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
     if not show_empty: filters.append({'field': 'give_remaining', 'op': '!=', 'value': 0})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM orders%s'''
-        % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
-    if not show_expired: results = [e for e in results if filter_expired(e)]
+    rows = select_rows(db, 'orders', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
+    if not show_expired:
+        block_index = last_block(db)['block_index']
+        results = [e for e in results if filter_expired(e)]
     return do_order_by(results, order_by, order_dir)
 
 def get_order_matches (db, validity=None, is_mine=False, address=None, tx0_hash=None, tx1_hash=None, filters=None, order_by='tx1_index', order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -726,12 +978,9 @@ def get_order_matches (db, validity=None, is_mine=False, address=None, tx0_hash=
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if tx0_hash: filters.append({'field': 'tx0_hash', 'op': '==', 'value': tx0_hash})
     if tx1_hash: filters.append({'field': 'tx1_hash', 'op': '==', 'value': tx1_hash})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM order_matches%s'''
-        % get_limit_to_blocks(start_block, end_block,
-            col_names=['tx0_block_index', 'tx1_block_index']))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'order_matches', filters, filterop, start_block, end_block,
+            col_names=['tx0_block_index', 'tx1_block_index'], address=address)
+    results = do_filter(rows, filters, filterop)
     if is_mine: results = [e for e in results if filter_is_mine(e)]
     if address: results = [e for e in results if e['tx0_address'] == address or e['tx1_address'] == address]
     return do_order_by(results, order_by, order_dir)
@@ -740,11 +989,8 @@ def get_btcpays (db, validity=None, filters=None, order_by='tx_index', order_dir
     if filters is None: filters = list()
     if filters and not isinstance(filters, list): filters = [filters,]
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM btcpays%s'''
-        % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'btcpays', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_issuances (db, validity=None, asset=None, issuer=None, filters=None, order_by='tx_index', order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -755,11 +1001,8 @@ def get_issuances (db, validity=None, asset=None, issuer=None, filters=None, ord
     if issuer: filters.append({'field': 'issuer', 'op': '==', 'value': issuer})
     # TODO: callable, call_date (range?), call_price (range?)
     # TODO: description search
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM issuances%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'issuances', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_broadcasts (db, validity=None, source=None, filters=None, order_by='tx_index', order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -767,11 +1010,8 @@ def get_broadcasts (db, validity=None, source=None, filters=None, order_by='tx_i
     if filters and not isinstance(filters, list): filters = [filters,]
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM broadcasts%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'broadcasts', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_bets (db, validity=None, source=None, show_empty=True, filters=None, order_by=None, order_dir='desc', start_block=None, end_block=None, filterop='and'):
@@ -780,11 +1020,8 @@ def get_bets (db, validity=None, source=None, show_empty=True, filters=None, ord
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
     if not show_empty: filters.append({'field': 'wager_remaining', 'op': '==', 'value': 0})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM bets%s'''
-        % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'bets', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_bet_matches (db, validity=None, address=None, tx0_hash=None, tx1_hash=None, filters=None, order_by='tx1_index', order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -793,12 +1030,9 @@ def get_bet_matches (db, validity=None, address=None, tx0_hash=None, tx1_hash=No
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if tx0_hash: filters.append({'field': 'tx0_hash', 'op': '==', 'value': tx0_hash})
     if tx1_hash: filters.append({'field': 'tx1_hash', 'op': '==', 'value': tx1_hash})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM bet_matches%s'''
-         % get_limit_to_blocks(start_block, end_block,
-             col_names=['tx0_block_index', 'tx1_block_index']))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'bet_matches', filters, filterop, start_block, end_block,
+            col_names=['tx0_block_index', 'tx1_block_index'], address=address)
+    results = do_filter(rows, filters, filterop)
     if address: results = [e for e in results if e['tx0_address'] == address or e['tx1_address'] == address]
     return do_order_by(results, order_by, order_dir)
 
@@ -808,11 +1042,8 @@ def get_dividends (db, validity=None, source=None, asset=None, filters=None, ord
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
     if asset: filters.append({'field': 'asset', 'op': '==', 'value': asset})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM dividends%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'dividends', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_burns (db, validity=True, source=None, filters=None, order_by='tx_index', order_dir='asc', start_block=None, end_block=None, filterop='and'):
@@ -820,11 +1051,8 @@ def get_burns (db, validity=True, source=None, filters=None, order_by='tx_index'
     if filters and not isinstance(filters, list): filters = [filters,]
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM burns%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'burns', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_cancels (db, validity=True, source=None, filters=None, order_by=None, order_dir=None, start_block=None, end_block=None, filterop='and'):
@@ -832,11 +1060,8 @@ def get_cancels (db, validity=True, source=None, filters=None, order_by=None, or
     if filters and not isinstance(filters, list): filters = [filters,]
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM cancels%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'cancels', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_callbacks (db, validity=True, source=None, filters=None, order_by=None, order_dir=None, start_block=None, end_block=None, filterop='and'):
@@ -844,122 +1069,205 @@ def get_callbacks (db, validity=True, source=None, filters=None, order_by=None,
     if filters and not isinstance(filters, list): filters = [filters,]
     if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM callbacks%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'callbacks', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_bet_expirations (db, source=None, filters=None, order_by=None, order_dir=None, start_block=None, end_block=None, filterop='and'):
     if filters is None: filters = list()
     if filters and not isinstance(filters, list): filters = [filters,]
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM bet_expirations%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'bet_expirations', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_order_expirations (db, source=None, filters=None, order_by=None, order_dir=None, start_block=None, end_block=None, filterop='and'):
     if filters is None: filters = list()
     if filters and not isinstance(filters, list): filters = [filters,]
     if source: filters.append({'field': 'source', 'op': '==', 'value': source})
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM order_expirations%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'order_expirations', filters, filterop, start_block, end_block)
+    results = do_filter(rows, filters, filterop)
     return do_order_by(results, order_by, order_dir)
 
 def get_bet_match_expirations (db, address=None, filters=None, order_by=None, order_dir=None, start_block=None, end_block=None, filterop='and'):
     if filters is None: filters = list()
     if filters and not isinstance(filters, list): filters = [filters,]
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM bet_match_expirations%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'bet_match_expirations', filters, filterop, start_block, end_block, address=address)
+    results = do_filter(rows, filters, filterop)
     if address: results = [e for e in results if e['tx0_address'] == address or e['tx1_address'] == address]
     return do_order_by(results, order_by, order_dir)
 
 def get_order_match_expirations (db, address=None, filters=None, order_by=None, order_dir=None, start_block=None, end_block=None, filterop='and'):
     if filters is None: filters = list()
     if filters and not isinstance(filters, list): filters = [filters,]
-    cursor = db.cursor()
-    cursor.execute('''SELECT * FROM order_match_expirations%s'''
-         % get_limit_to_blocks(start_block, end_block))
-    results = do_filter(cursor.fetchall(), filters, filterop)
-    cursor.close()
+    rows = select_rows(db, 'order_match_expirations', filters, filterop, start_block, end_block, address=address)
+    results = do_filter(rows, filters, filterop)
     if address: results = [e for e in results if e['tx0_address'] == address or e['tx1_address'] == address]
     return do_order_by(results, order_by, order_dir)
 
-def get_address (db, address, start_block=None, end_block=None):
+# The sections of an address: for each, the table behind it, the fields which
+# hold the address, whether a row is listed once for each of those fields which
+# does (as with filterop == 'or') or just once, the validity required, the field
+# to order by, and the fields to limit to blocks by. Both get_address() and
+# get_addresses() read sections as defined here.
+ADDRESS_SECTION_DEFINITIONS = collections.OrderedDict((
+    ('balances', ('balances', ('address',), False, None, None, None)),
+    ('debits', ('debits', ('address',), False, None, 'block_index', ['block_index'])),
+    ('credits', ('credits', ('address',), False, None, 'block_index', ['block_index'])),
+    ('burns', ('burns', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('sends', ('sends', ('source', 'destination'), True, 'valid', 'block_index', ['block_index'])),
+    ('orders', ('orders', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('order_matches', ('order_matches', ('tx0_address', 'tx1_address'), False, 'valid', 'tx0_block_index', ['tx0_block_index', 'tx1_block_index'])),
+    ('btcpays', ('btcpays', ('source', 'destination'), True, 'valid', 'block_index', ['block_index'])),
+    ('issuances', ('issuances', ('issuer',), False, 'valid', 'block_index', ['block_index'])),
+    ('broadcasts', ('broadcasts', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('bets', ('bets', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('bet_matches', ('bet_matches', ('tx0_address', 'tx1_address'), False, 'valid', 'tx0_block_index', ['tx0_block_index', 'tx1_block_index'])),
+    ('dividends', ('dividends', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('cancels', ('cancels', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('callbacks', ('callbacks', ('source',), False, 'valid', 'block_index', ['block_index'])),
+    ('bet_expirations', ('bet_expirations', ('source',), False, None, 'block_index', ['block_index'])),
+    ('order_expirations', ('order_expirations', ('source',), False, None, 'block_index', ['block_index'])),
+    ('bet_match_expirations', ('bet_match_expirations', ('tx0_address', 'tx1_address'), False, None, 'block_index', ['block_index'])),
+    ('order_match_expirations', ('order_match_expirations', ('tx0_address', 'tx1_address'), False, None, 'block_index', ['block_index'])),
+))
+ADDRESS_SECTIONS = tuple(ADDRESS_SECTION_DEFINITIONS)
+READ_THREADS = 4    # For reading the sections of an address concurrently.
+
+read_executor = None
+read_connections = threading.local()
+
+# For waking up readers of the message feed (see `api`) when messages have been
+# journalled or rolled back.
+messages_condition = threading.Condition()
+messages_generation = 0
+
+def notify_messages ():
+    global messages_generation
+    with messages_condition:
+        messages_generation += 1
+        messages_condition.notify_all()
+
+def get_read_connection (database):
+    """Return a read‐only connection to database, one per thread."""
+    if getattr(read_connections, 'database', None) != database:
+        read_connections.db = connect_to_db(flags='SQLITE_OPEN_READONLY', database=database)
+        read_connections.database = database
+    return read_connections.db
+
+def read_address_section (db, section, address, start_block, end_block):
+    """Return one section of address (see ADDRESS_SECTION_DEFINITIONS)."""
+    table, fields, each_field, validity, order_by, col_names = ADDRESS_SECTION_DEFINITIONS[section]
+    filters = []
+    if validity: filters.append({'field': 'validity', 'op': '==', 'value': validity})
+    if each_field or len(fields) == 1:
+        filters += [{'field': field, 'op': '==', 'value': address} for field in fields]
+        filterop = 'or' if each_field else 'and'
+        match_address = None
+    else:
+        filterop = 'and'
+        match_address = address
+    if not col_names: start_block, end_block = None, None
+    rows = select_rows(db, table, filters, filterop, start_block, end_block,
+                       col_names=col_names or ['block_index'], address=match_address)
+    results = do_filter(rows, filters, filterop)
+    return do_order_by(results, order_by, 'asc')
+
+def get_address_sections (address, start_block, end_block):
+    """Return the functions which read each section of an address."""
+    return {section: functools.partial(read_address_section, section=section, address=address,
+                                       start_block=start_block, end_block=end_block)
+            for section in ADDRESS_SECTIONS}
+
+def get_address (db, address, start_block=None, end_block=None, sections=None):
+    """Return everything about address (or just the sections asked for).
+
+    The sections are read concurrently, each on a read‐only connection of its
+    own, unless db is in the middle of a transaction (whose changes those
+    connections would not see) or not on disk.
+    """
+    global read_executor
     from . import bitcoin   # HACK
     if not bitcoin.base58_decode(address, config.ADDRESSVERSION):
         raise exceptions.InvalidAddressError('Not a valid Bitcoin address:',
                                              address)
-    address_dict = {}
-    address_dict['balances'] = get_balances(db, address=address)
-    
-    address_dict['debits'] = get_debits(db, address=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['credits'] = get_credits(db, address=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['burns'] = get_burns(db, validity='valid', source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['sends'] = get_sends(db, validity='valid', source=address, destination=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block, filterop='or')
-    #^ with filterop == 'or', we get all sends where this address was the source OR destination 
-    
-    address_dict['orders'] = get_orders(db, validity='valid', source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['order_matches'] = get_order_matches(db, validity='valid', address=address,
-        order_by='tx0_block_index', order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['btcpays'] = get_btcpays(db,
-        filters=[{'field': 'source', 'op': '==', 'value': address}, {'field': 'destination', 'op': '==', 'value': address}],
-        filterop='or', validity='valid', order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['issuances'] = get_issuances(db, validity='valid', issuer=address,
-        order_by='block_index', order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['broadcasts'] = get_broadcasts(db, validity='valid', source=address,
-        order_by='block_index', order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['bets'] = get_bets(db, validity='valid', source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['bet_matches'] = get_bet_matches(db, validity='valid', address=address,
-        order_by='tx0_block_index', order_dir='asc', start_block=start_block, end_block=end_block)
-    
-    address_dict['dividends'] = get_dividends(db, validity='valid', source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['cancels'] = get_cancels(db, validity='valid', source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['callbacks'] = get_callbacks(db, validity='valid', source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['bet_expirations'] = get_bet_expirations(db, source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['order_expirations'] = get_order_expirations(db, source=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['bet_match_expirations'] = get_bet_match_expirations(db, address=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
-    address_dict['order_match_expirations'] = get_order_match_expirations(db, address=address, order_by='block_index',
-        order_dir='asc', start_block=start_block, end_block=end_block)
-
+    if sections is None: sections = ADDRESS_SECTIONS
+    for section in sections:
+        if section not in ADDRESS_SECTIONS:
+            raise ValueError("Invalid section: '%s'. Must be one of: %s" % (section, ', '.join(ADDRESS_SECTIONS)))
+    readers = get_address_sections(address, start_block, end_block)
+
+    address_dict = collections.OrderedDict()
+    if len(sections) == 1 or not db.getautocommit() or not db.filename:
+        for section in sections:
+            address_dict[section] = readers[section](db)
+        return address_dict
+
+    if not read_executor:
+        read_executor = concurrent.futures.ThreadPoolExecutor(max_workers=READ_THREADS)
+    database = db.filename
+    futures = [(section, read_executor.submit(lambda reader: reader(get_read_connection(database)), readers[section]))
+               for section in sections]
+    for section, future in futures:
+        address_dict[section] = future.result()
     return address_dict
-    
+
+ADDRESSES_CHUNK_SIZE = 400  # Keeps queries under SQLite’s limit on host parameters.
+
+def get_addresses (db, addresses, start_block=None, end_block=None, sections=None):
+    """Return, for each of addresses, what get_address() would, with one pass
+    over each table per chunk of addresses.
+    """
+    from . import bitcoin   # HACK
+    addresses = list(collections.OrderedDict.fromkeys(addresses))
+    for address in addresses:
+        if not bitcoin.base58_decode(address, config.ADDRESSVERSION):
+            raise exceptions.InvalidAddressError('Not a valid Bitcoin address:',
+                                                 address)
+    if sections is None: sections = ADDRESS_SECTIONS
+    for section in sections:
+        if section not in ADDRESS_SECTIONS:
+            raise ValueError("Invalid section: '%s'. Must be one of: %s" % (section, ', '.join(ADDRESS_SECTIONS)))
+
+    addresses_dict = collections.OrderedDict()
+    for address in addresses:
+        addresses_dict[address] = collections.OrderedDict((section, []) for section in sections)
+
+    cursor = db.cursor()
+    for section in sections:
+        table, fields, each_field, validity, order_by, col_names = ADDRESS_SECTION_DEFINITIONS[section]
+        insertion_order = get_insertion_order(db, table)
+        for i in range(0, len(addresses), ADDRESSES_CHUNK_SIZE):
+            chunk = addresses[i:i + ADDRESSES_CHUNK_SIZE]
+            conditions, bindings = [], []
+            placeholders = ','.join('?' * len(chunk))
+            conditions.append('({})'.format(' OR '.join('{} IN ({})'.format(field, placeholders) for field in fields)))
+            bindings += chunk * len(fields)
+            if validity:
+                conditions.append('validity = ?')
+                bindings.append(validity)
+            if col_names:
+                block_limit_clause = get_limit_to_blocks(start_block, end_block, col_names=col_names)
+                if block_limit_clause:
+                    conditions.append('({})'.format(block_limit_clause.replace(' WHERE ', '', 1)))
+            cursor.execute('''SELECT * FROM {} WHERE {}{}'''.format(table, ' AND '.join(conditions), insertion_order), bindings)
+
+            # As in read_address_section(), a row of a section with each_field
+            # set is listed once for each of its fields which holds the address,
+            # in the order of those fields. Other rows are listed once.
+            chunk_rows = {address: [[] for field in fields] for address in chunk}
+            for row in cursor.fetchall():
+                if each_field:
+                    for j, field in enumerate(fields):
+                        if row[field] in chunk_rows: chunk_rows[row[field]][j].append(row)
+                else:
+                    for address in set(row[field] for field in fields):
+                        if address in chunk_rows: chunk_rows[address][0].append(row)
+            for address in chunk:
+                rows = [row for field_rows in chunk_rows[address] for row in field_rows]
+                addresses_dict[address][section] = do_order_by(rows, order_by, 'asc')
+    cursor.close()
+
+    return addresses_dict
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
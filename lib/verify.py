@@ -0,0 +1,176 @@
+"""
+Check the results of parsing for internal consistency.
+
+Balances are recomputed from credits and debits, order and bet remainings from
+their matches, and supplies from burns and issuances. The work is
+partitioned across a pool of processes, each with its own read‐only
+connection to the database.
+"""
+
+import logging
+import multiprocessing
+
+from . import (config, util)
+
+CHUNK_SIZE = 1000   # Addresses or offers per task.
+
+worker_db = None
+
+def initialise_worker (database):
+    global worker_db
+    config.DATABASE = database
+    worker_db = util.connect_to_db(flags='SQLITE_OPEN_READONLY')
+
+def run (task):
+    check, args = task[0], task[1:]
+    return check(worker_db, *args)
+
+def problem (table, key, field, expected, actual):
+    return {'table': table, 'key': key, 'field': field, 'expected': expected, 'actual': actual}
+
+def get_ranges (db, sql):
+    """Split the (sorted) values returned by sql into inclusive ranges of at
+    most CHUNK_SIZE values each.
+    """
+    cursor = db.cursor()
+    values = [list(row.values())[0] for row in cursor.execute(sql)]
+    values = [value for value in values if value != None]
+    cursor.close()
+    return [(values[i], values[min(i + CHUNK_SIZE, len(values)) - 1]) for i in range(0, len(values), CHUNK_SIZE)]
+
+def check_balances (db, first_address, last_address):
+    cursor = db.cursor()
+    expected, actual = {}, {}
+    for table, sign in (('credits', 1), ('debits', -1)):
+        cursor.execute('''SELECT address, asset, SUM(amount) AS amount FROM {} \
+                          WHERE (address >= ? AND address <= ?) \
+                          GROUP BY address, asset'''.format(table), (first_address, last_address))
+        for row in cursor.fetchall():
+            key = (row['address'], row['asset'])
+            expected[key] = expected.get(key, 0) + sign * row['amount']
+    cursor.execute('''SELECT * FROM balances \
+                      WHERE (address >= ? AND address <= ?)''', (first_address, last_address))
+    for balance in cursor.fetchall():
+        key = (balance['address'], balance['asset'])
+        actual[key] = actual.get(key, 0) + balance['amount']
+    cursor.close()
+
+    problems = []
+    for key in sorted(set(expected) | set(actual)):
+        if expected.get(key, 0) != actual.get(key, 0):
+            problems.append(problem('balances', '{} {}'.format(*key), 'amount', expected.get(key, 0), actual.get(key, 0)))
+    return problems
+
+def check_orders (db, first_index, last_index):
+    cursor = db.cursor()
+    cursor.execute('''SELECT * FROM orders \
+                      WHERE (tx_index >= ? AND tx_index <= ? AND give_amount IS NOT NULL)''', (first_index, last_index))
+    orders = {order['tx_index']: order for order in cursor.fetchall()}
+    give_remaining = {tx_index: order['give_amount'] for tx_index, order in orders.items()}
+    get_remaining = {tx_index: order['get_amount'] for tx_index, order in orders.items()}
+
+    # Amounts from order matches which expired while the order itself was still
+    # open are returned to it (see `order.expire()`).
+    cursor.execute('''SELECT order_matches.*, order_match_expirations.block_index AS expiration_block_index \
+                      FROM order_matches LEFT JOIN order_match_expirations \
+                      ON order_matches.id = order_match_expirations.order_match_id \
+                      WHERE ((tx0_index >= ? AND tx0_index <= ?) OR (tx1_index >= ? AND tx1_index <= ?))''',
+                   (first_index, last_index, first_index, last_index))
+    for order_match in cursor.fetchall():
+        for tx_index, give, get in ((order_match['tx0_index'], 'forward_amount', 'backward_amount'),
+                                    (order_match['tx1_index'], 'backward_amount', 'forward_amount')):
+            if tx_index not in orders: continue
+            expiration_block_index = order_match['expiration_block_index']
+            if expiration_block_index != None and orders[tx_index]['expire_index'] >= expiration_block_index:
+                continue
+            give_remaining[tx_index] -= order_match[give]
+            get_remaining[tx_index] -= order_match[get]
+    cursor.close()
+
+    problems = []
+    for tx_index in sorted(orders):
+        order = orders[tx_index]
+        if give_remaining[tx_index] != order['give_remaining']:
+            problems.append(problem('orders', order['tx_hash'], 'give_remaining', give_remaining[tx_index], order['give_remaining']))
+        if get_remaining[tx_index] != order['get_remaining']:
+            problems.append(problem('orders', order['tx_hash'], 'get_remaining', get_remaining[tx_index], order['get_remaining']))
+    return problems
+
+def check_bets (db, first_index, last_index):
+    cursor = db.cursor()
+    cursor.execute('''SELECT * FROM bets \
+                      WHERE (tx_index >= ? AND tx_index <= ? AND wager_amount IS NOT NULL)''', (first_index, last_index))
+    bets = {bet['tx_index']: bet for bet in cursor.fetchall()}
+    wager_remaining = {tx_index: bet['wager_amount'] for tx_index, bet in bets.items()}
+    counterwager_remaining = {tx_index: bet['counterwager_amount'] for tx_index, bet in bets.items()}
+
+    cursor.execute('''SELECT * FROM bet_matches \
+                      WHERE ((tx0_index >= ? AND tx0_index <= ?) OR (tx1_index >= ? AND tx1_index <= ?))''',
+                   (first_index, last_index, first_index, last_index))
+    for bet_match in cursor.fetchall():
+        for tx_index, wager, counterwager in ((bet_match['tx0_index'], 'forward_amount', 'backward_amount'),
+                                              (bet_match['tx1_index'], 'backward_amount', 'forward_amount')):
+            if tx_index not in bets: continue
+            wager_remaining[tx_index] -= bet_match[wager]
+            counterwager_remaining[tx_index] -= bet_match[counterwager]
+    cursor.close()
+
+    problems = []
+    for tx_index in sorted(bets):
+        bet = bets[tx_index]
+        if wager_remaining[tx_index] != bet['wager_remaining']:
+            problems.append(problem('bets', bet['tx_hash'], 'wager_remaining', wager_remaining[tx_index], bet['wager_remaining']))
+        if counterwager_remaining[tx_index] != bet['counterwager_remaining']:
+            problems.append(problem('bets', bet['tx_hash'], 'counterwager_remaining', counterwager_remaining[tx_index], bet['counterwager_remaining']))
+    return problems
+
+def check_supply (db):
+    cursor = db.cursor()
+    problems = []
+
+    # Burns are credited with the burn transaction as event.
+    cursor.execute('''SELECT SUM(credits.amount) AS amount FROM credits JOIN burns \
+                      ON credits.event = burns.tx_hash \
+                      WHERE (burns.validity = ? AND credits.asset = ?)''', ('valid', 'XCP'))
+    burned = cursor.fetchall()[0]['amount'] or 0
+    cursor.execute('''SELECT SUM(fee_paid) AS fee_paid FROM issuances \
+                      WHERE validity = ?''', ('valid',))
+    fees = cursor.fetchall()[0]['fee_paid'] or 0
+    supply = util.xcp_supply(db)
+    if supply != burned - fees:
+        problems.append(problem('supplies', 'XCP', 'supply', burned - fees, supply))
+
+    cursor.execute('''SELECT asset, SUM(amount) AS amount FROM issuances \
+                      WHERE validity = ? GROUP BY asset''', ('valid',))
+    for issued in cursor.fetchall():
+        supply = util.get_supply(db, issued['asset'])
+        if supply['issued'] != issued['amount']:
+            problems.append(problem('supplies', issued['asset'], 'issued', issued['amount'], supply['issued']))
+    cursor.close()
+
+    return problems
+
+def verify (db, processes=None):
+    """Return a list of the inconsistencies found in the database."""
+    logging.info('Status: Verifying database.')
+
+    tasks = [(check_supply,)]
+    address_sql = '''SELECT address FROM balances UNION SELECT address FROM credits \
+                     UNION SELECT address FROM debits ORDER BY address'''
+    tasks += [(check_balances,) + chunk for chunk in get_ranges(db, address_sql)]
+    tasks += [(check_orders,) + chunk for chunk in get_ranges(db, '''SELECT tx_index FROM orders ORDER BY tx_index''')]
+    tasks += [(check_bets,) + chunk for chunk in get_ranges(db, '''SELECT tx_index FROM bets ORDER BY tx_index''')]
+
+    pool = multiprocessing.Pool(processes=processes, initializer=initialise_worker, initargs=(config.DATABASE,))
+    try:
+        problems = []
+        for result in pool.imap(run, tasks):
+            problems += result
+    finally:
+        pool.close()
+        pool.join()
+
+    logging.info('Status: Verified {} tasks; found {} inconsistencies.'.format(len(tasks), len(problems)))
+    return problems
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
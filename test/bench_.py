@@ -0,0 +1,406 @@
+#! /usr/bin/python3
+
+"""
+Benchmarks, for comparing the speed of changes. Run directly:
+
+    bench_.py micro     Time the encoding and decoding of addresses and transactions, and the
+                        matching of orders and bets.
+    bench_.py parse     Parse a synthetic chain, generated from a seed, and print the parse
+                        rate and the time taken by each type of message, as JSON.
+    bench_.py follow    Follow a synthetic chain, served by a fake Bitcoind (with the given
+                        latencies), and print the rate at which blocks are ingested, as JSON.
+    bench_.py potentials
+                        Scan a synthetic chain, served by a fake Bitcoind, for potentials.
+"""
+
+import os
+import sys
+import io
+import binascii
+import hashlib
+import random
+import timeit
+import time
+import json
+import argparse
+import contextlib
+import decimal
+D = decimal.Decimal
+import threading
+
+CURR_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(CURR_DIR, '..')))
+
+from lib import (config, util, exceptions, bitcoin, blocks)
+from lib import (send, order, btcpay, issuance, broadcast, bet, dividend, burn, callback)
+import counterpartyd
+import fake_bitcoind
+
+counterpartyd.set_options(database_file=CURR_DIR+'/counterpartyd.bench.db', testnet=True, testcoin=False, unittest=True)
+
+def bench (name, function, calls, number=10):
+    """Print the mean time for each of calls calls made by function."""
+    seconds = min(timeit.repeat(function, number=number, repeat=3))
+    print('{:<40}{:>10.2f} µs'.format(name, seconds / (number * calls) * 1e6))
+
+def bench_base58 ():
+    random.seed(0)
+    pubkeyhashes = [binascii.hexlify(bytes(random.randrange(256) for i in range(20))).decode('utf-8') for i in range(1000)]
+    addresses = [bitcoin.base58_check_encode(pubkeyhash, config.ADDRESSVERSION) for pubkeyhash in pubkeyhashes]
+    scriptpubkeys = [{'asm': 'OP_DUP OP_HASH160 {} OP_EQUALVERIFY OP_CHECKSIG'.format(pubkeyhash)} for pubkeyhash in pubkeyhashes]
+
+    bench('base58_check_encode', lambda: [bitcoin.base58_check_encode(pubkeyhash, config.ADDRESSVERSION) for pubkeyhash in pubkeyhashes], len(pubkeyhashes))
+    bench('base58_decode', lambda: [bitcoin.base58_decode(address, config.ADDRESSVERSION) for address in addresses], len(addresses))
+
+    def get_addresses_uncached ():
+        blocks.pubkeyhash_to_address.cache_clear()
+        return [blocks.get_address(scriptpubkey) for scriptpubkey in scriptpubkeys]
+    bench('get_address (uncached)', get_addresses_uncached, len(scriptpubkeys))
+    bench('get_address (cached)', lambda: [blocks.get_address(scriptpubkey) for scriptpubkey in scriptpubkeys], len(scriptpubkeys))
+
+def bench_get_tx_info ():
+    random.seed(0)
+    pubkeyhashes = [binascii.hexlify(bytes(random.randrange(256) for i in range(20))).decode('utf-8') for i in range(2000)]
+    # Ordinary transactions, with a payment and change.
+    txs = [{'vin': [], 'vout': [{'value': 0.1, 'scriptPubKey': {'asm': 'OP_DUP OP_HASH160 {} OP_EQUALVERIFY OP_CHECKSIG'.format(pubkeyhash)}}
+                                for pubkeyhash in pubkeyhashes[i:i + 2]]}
+           for i in range(0, len(pubkeyhashes), 2)]
+
+    def get_tx_infos ():
+        blocks.pubkeyhash_to_address.cache_clear()
+        return [blocks.get_tx_info(tx) for tx in txs]
+    bench('get_tx_info (not Counterparty)', get_tx_infos, len(txs))
+    bench('check_potential (not Counterparty)', lambda: [blocks.check_potential(tx) for tx in txs], len(txs))
+
+def bench_match ():
+    random.seed(0)
+    orders = [{'get_amount': random.randint(1, 10) * config.UNIT, 'give_amount': random.randint(1, 10) * config.UNIT} for i in range(2000)]
+    pairs = [(orders[i], {'get_amount': orders[i + 1]['give_amount'], 'give_amount': round(orders[i + 1]['get_amount'] * random.uniform(0.9, 1.1))})
+             for i in range(0, len(orders), 2)]
+    bets = [({'wager_amount': tx0['give_amount'], 'counterwager_amount': tx0['get_amount'], 'wager_remaining': tx0['give_amount']},
+             {'wager_amount': tx1['get_amount'], 'counterwager_amount': tx1['give_amount']}) for tx0, tx1 in pairs]
+
+    for block_index in (284000, 290000):
+        bench('order.get_match_amounts ({})'.format(block_index),
+              lambda: [order.get_match_amounts(block_index, tx0, tx1, tx0['give_amount'], tx1['give_amount']) for tx0, tx1 in pairs], len(pairs))
+        bench('order.get_match_amounts_decimal ({})'.format(block_index),
+              lambda: [order.get_match_amounts_decimal(block_index, tx0, tx1, tx0['give_amount'], tx1['give_amount']) for tx0, tx1 in pairs], len(pairs))
+        bench('bet.get_match_amounts ({})'.format(block_index),
+              lambda: [bet.get_match_amounts(block_index, tx0, tx1, tx1['wager_amount']) for tx0, tx1 in bets], len(bets))
+        bench('bet.get_match_amounts_decimal ({})'.format(block_index),
+              lambda: [bet.get_match_amounts_decimal(block_index, tx0, tx1, tx1['wager_amount']) for tx0, tx1 in bets], len(bets))
+    orders = [dict(order, tx_index=i) for i, order in enumerate(orders[:50])]
+    bench('order.sort_by_price (50 orders)', lambda: order.sort_by_price(orders), 1, number=1000)
+    bench('sorted, by Decimal price (50 orders)', lambda: sorted(orders, key=lambda x: D(x['get_amount']) / D(x['give_amount'])), 1, number=1000)
+
+def bench_credit ():
+    db = new_database()
+    random.seed(0)
+    addresses = [bitcoin.base58_check_encode(binascii.hexlify(bytes(random.randrange(256) for i in range(20))).decode('utf-8'), config.ADDRESSVERSION)
+                 for i in range(100)]
+    def credit_and_debit ():
+        with db:
+            for address in addresses:
+                util.credit(db, 1, address, 'XCP', config.UNIT)
+                util.debit(db, 1, address, 'XCP', config.UNIT)
+        util.release_cursors(db)
+    bench('util.credit and util.debit', credit_and_debit, len(addresses))
+    db.close()
+
+def bench_get_credits ():
+    db = new_database()
+    random.seed(0)
+    addresses = [bitcoin.base58_check_encode(binascii.hexlify(bytes(random.randrange(256) for i in range(20))).decode('utf-8'), config.ADDRESSVERSION)
+                 for i in range(1000)]
+    db.setexectrace(None)   # Don’t journal the credits.
+    with db:
+        db.cursor().executemany('''INSERT INTO credits VALUES (?, ?, ?, ?, ?, ?)''',
+                                [(i // 100, random.choice(addresses), 'XCP', random.randint(1, config.UNIT), 'send', None) for i in range(100000)])
+    bench('util.get_credits (per row)', lambda: util.get_credits(db), 100000, number=1)
+    db.close()
+
+DEFAULT_MIX = {'burn': 1, 'send': 4, 'order': 4, 'btcpay': 2, 'issuance': 1, 'broadcast': 1, 'bet': 2, 'dividend': 1, 'callback': 1}
+FEEDS = 3   # The first addresses broadcast; the rest bet on them.
+# Orders and bets of most of a balance, which debits earlier in the same block
+# can leave short, for the overorder and overbet paths. None by default: an
+# overbet can be cut to nothing (with odds of 0/0), or leave too little for its
+# fee, which `bet.parse()` fails on.
+MESSAGE_TYPES = sorted(DEFAULT_MIX) + ['overbet', 'overorder']
+
+def compose_message (db, rng, message_type, addresses, block_time):
+    """Compose a message of message_type from random (but mostly valid)
+    parameters, given the state of the database.
+    """
+    cursor = db.cursor()
+    holdings = [balance for balance in util.get_balances(db) if balance['amount'] > 0]
+    xcp_holdings = [balance for balance in holdings if balance['asset'] == 'XCP']
+
+    if message_type == 'burn':
+        return burn.compose(db, rng.choice(addresses), rng.randint(1, 10) * config.UNIT // 20)
+
+    elif message_type == 'send':
+        holding = rng.choice(holdings)
+        return send.compose(db, holding['address'], rng.choice(addresses), holding['asset'], rng.randint(1, max(1, holding['amount'] // 10)))
+
+    elif message_type == 'order':
+        # Near 1:1 prices, so that orders match.
+        holding = rng.choice(xcp_holdings)
+        give_amount = rng.randint(1, 10) * config.UNIT // 100
+        get_amount = round(give_amount * rng.uniform(0.9, 1.1))
+        if rng.random() < 0.5:
+            return order.compose(db, holding['address'], 'XCP', give_amount, 'BTC', get_amount, 10, 0, config.MIN_FEE)
+        else:
+            return order.compose(db, rng.choice(addresses), 'BTC', give_amount, 'XCP', get_amount, 10, 0, config.MIN_FEE)
+
+    elif message_type == 'btcpay':
+        cursor.execute('''SELECT * FROM order_matches WHERE validity = ? ORDER BY tx1_index''', ('pending',))
+        order_match = rng.choice(cursor.fetchall())
+        return btcpay.compose(db, order_match['tx0_hash'] + order_match['tx1_hash'])
+
+    elif message_type == 'overorder':
+        holding = rng.choice(xcp_holdings)
+        give_amount = int(holding['amount'] * rng.uniform(0.5, 0.9))
+        get_amount = round(give_amount * rng.uniform(0.9, 1.1))
+        return order.compose(db, holding['address'], 'XCP', give_amount, 'BTC', get_amount, 10, 0, config.MIN_FEE)
+
+    elif message_type == 'issuance':
+        asset = rng.choice('BCDEFGHIJKLMNOPQRSTUVWXYZ') + ''.join(rng.choice(util.b26_digits) for i in range(7))
+        callable_ = rng.random() < 0.5
+        return issuance.compose(db, rng.choice(addresses), None, asset, rng.randint(1, 1000) * config.UNIT, True,
+                                callable_, block_time if callable_ else 0, 1.0 if callable_ else 0, 'Synthetic')
+
+    elif message_type == 'broadcast':
+        return broadcast.compose(db, rng.choice(addresses[:FEEDS]), block_time + rng.randint(0, 99),
+                                 rng.uniform(90, 110), 0.01, 'Synthetic')
+
+    elif message_type == 'bet':
+        feed = rng.choice(util.get_broadcasts(db, validity='valid', order_by='tx_index', order_dir='asc'))
+        bet_type = rng.randint(0, 3)
+        target_value = 0 if bet_type in (0, 1) else rng.uniform(90, 110)
+        return bet.compose(db, rng.choice(xcp_holdings)['address'], feed['source'], bet_type, feed['timestamp'] + 100,
+                           rng.randint(1, 10) * config.UNIT // 100, rng.randint(1, 10) * config.UNIT // 100, target_value, 5040, 10)
+
+    elif message_type == 'overbet':
+        feed = rng.choice(util.get_broadcasts(db, validity='valid', order_by='tx_index', order_dir='asc'))
+        holding = rng.choice(xcp_holdings)
+        wager_amount = int(holding['amount'] * rng.uniform(0.5, 0.9))
+        return bet.compose(db, holding['address'], feed['source'], rng.randint(0, 1), feed['timestamp'] + 100,
+                           wager_amount, round(wager_amount * rng.uniform(0.9, 1.1)), 0, 5040, 10)
+
+    elif message_type == 'dividend':
+        asset = rng.choice(util.get_issuances(db, validity='valid'))
+        return dividend.compose(db, asset['issuer'], rng.randint(1, 10) * 1000, asset['asset'])
+
+    elif message_type == 'callback':
+        asset = rng.choice([issuance for issuance in util.get_issuances(db, validity='valid') if issuance['callable']])
+        # `callback.validate()` divides by the balance of each holder (but the issuer).
+        if any(balance['amount'] == 0 and balance['address'] != asset['issuer'] for balance in util.get_balances(db, asset=asset['asset'])):
+            raise exceptions.CallbackError(['a holder’s balance is zero'])
+        return callback.compose(db, asset['issuer'], 0.1, asset['asset'])
+
+def generate_block (db, rng, block_index, block_time, addresses, transactions, mix, tx_index):
+    """List a block of random transactions, and return the index of the next
+    transaction.
+    """
+    cursor = db.cursor()
+    cursor.execute('''INSERT INTO blocks(block_index, block_hash, block_time) VALUES(?,?,?)''',
+                   (block_index, hashlib.sha256(bytes(str(block_index), 'utf-8')).hexdigest(), block_time))
+    message_types = sorted(mix)
+    for i in range(transactions):
+        # Messages which cannot be composed yet (a BTCPay, before any order has
+        # matched, say) are replaced by others.
+        for attempt in range(10):
+            message_type = rng.choices(message_types, weights=[mix[message_type] for message_type in message_types])[0]
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    source, destination, btc_amount, fee, data = compose_message(db, rng, message_type, addresses, block_time)
+                break
+            except (exceptions.MessageError, exceptions.AssetError, IndexError):
+                continue
+        else:
+            continue
+
+        if data: data = data[len(config.PREFIX):]
+        else: data = b''
+        if destination and btc_amount == None: btc_amount = config.REGULAR_DUST_SIZE
+        cursor.execute('''INSERT INTO transactions(tx_index, tx_hash, block_index, block_time, source, destination, btc_amount, fee, data)
+                          VALUES(?,?,?,?,?,?,?,?,?)''',
+                       (tx_index, hashlib.sha256(bytes(str(tx_index), 'utf-8')).hexdigest(), block_index, block_time,
+                        source, destination, btc_amount, fee, data))
+        tx_index += 1
+    cursor.close()
+    return tx_index
+
+def percentile (values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def generate_chain (db, seed, block_count, transactions, mix):
+    """Generate and parse a synthetic chain, and return the number of
+    transactions and the time taken by `blocks.parse_block()`.
+    """
+    rng = random.Random(seed)
+    addresses = [bitcoin.base58_check_encode(hashlib.sha256(bytes('{} {}'.format(seed, i), 'utf-8')).hexdigest()[:40], config.ADDRESSVERSION)
+                 for i in range(50)]
+    tx_index, seconds = 0, 0
+    for block_index in range(config.BLOCK_FIRST, config.BLOCK_FIRST + block_count):
+        block_time = block_index * 600
+        with db:
+            tx_index = generate_block(db, rng, block_index, block_time, addresses, transactions, mix, tx_index)
+            start = time.perf_counter()
+            blocks.parse_block(db, block_index, block_time)
+            seconds += time.perf_counter() - start
+    return tx_index, seconds
+
+def remove_database ():
+    # (With its write‐ahead log, which would otherwise be replayed into the next one.)
+    for suffix in ('', '-wal', '-shm'):
+        try: os.remove(config.DATABASE + suffix)
+        except: pass
+
+def new_database ():
+    remove_database()
+    db = util.connect_to_db()
+    blocks.initialise(db)
+    return db
+
+def bench_parse (seed, block_count, transactions, mix):
+    db = new_database()
+
+    # Time the parsing of each transaction, by message type.
+    latencies = {}
+    parse_tx = blocks.parse_tx
+    def timed_parse_tx (db, tx):
+        start = time.perf_counter()
+        parse_tx(db, tx)
+        latencies.setdefault(blocks.get_message_type(tx), []).append(time.perf_counter() - start)
+    blocks.parse_tx = timed_parse_tx
+    try:
+        tx_index, seconds = generate_chain(db, seed, block_count, transactions, mix)
+    finally:
+        blocks.parse_tx = parse_tx
+
+    messages_hash = util.last_block(db)['messages_hash']
+    db.close()
+    remove_database()
+
+    results = {
+        'seed': seed,
+        'blocks': block_count,
+        'transactions': tx_index,
+        'seconds': seconds,
+        'blocks_per_second': block_count / seconds,
+        'transactions_per_second': tx_index / seconds,
+        'messages_hash': messages_hash,     # The same for the same chain.
+        'message_types': {},
+    }
+    for message_type, values in sorted(latencies.items()):
+        values.sort()
+        results['message_types'][message_type] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.5) * 1000,
+            'p90_ms': percentile(values, 0.9) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+    return results
+
+def bench_ingest (action, seed, block_count, transactions, mix, latency=0, call_latency={}, processes=None):
+    """Serve a synthetic chain from a fake Bitcoind, and time following it
+    (or scanning it for potentials), from a new database.
+    """
+    db = new_database()
+    tx_index, seconds = generate_chain(db, seed, block_count, transactions, mix)
+    messages_hash = util.last_block(db)['messages_hash']
+    fixture = fake_bitcoind.get_fixture(db)
+    db.close()
+    server = fake_bitcoind.start(fixture, latency=latency, call_latency=call_latency)
+
+    db = new_database()
+    last_block_index = config.BLOCK_FIRST + block_count - 1
+    start = time.perf_counter()
+    if action == 'follow':
+        # `follow()` never returns: wait for it to parse the last block, and
+        # only then (when it is well past initialising the database) poll for
+        # that to be committed, from another connection. Errors in its thread
+        # are raised here.
+        errors = []
+        def follow ():
+            try: blocks.follow(util.connect_to_db())
+            except BaseException as e: errors.append(e)
+        parsed = threading.Event()
+        parse_block = blocks.parse_block
+        def watched_parse_block (db, block_index, block_time):
+            parse_block(db, block_index, block_time)
+            if block_index == last_block_index: parsed.set()
+        blocks.parse_block = watched_parse_block
+        thread = threading.Thread(target=follow, daemon=True)
+        thread.start()
+        try:
+            while not parsed.wait(0.01):
+                if errors: raise errors[0]
+            while util.last_block(db)['block_index'] != last_block_index:
+                if errors: raise errors[0]
+                time.sleep(0.01)
+        finally:
+            blocks.parse_block = parse_block
+        seconds = time.perf_counter() - start
+        assert util.last_block(db)['messages_hash'] == messages_hash
+    else:
+        blocks.get_potentials(db, processes=processes)
+        seconds = time.perf_counter() - start
+        last_block_index -= 12      # Not scanned, for reorgs.
+        cursor = db.cursor()
+        cursor.execute('''SELECT COUNT(*) AS count FROM potentials''')
+        assert cursor.fetchall()[0]['count'] == sum(len(block['tx']) for block in fixture['blocks'] if block['block_index'] <= last_block_index)
+        cursor.close()
+    server.shutdown()
+    db.close()
+    remove_database()
+
+    block_count = last_block_index - config.BLOCK_FIRST + 1
+    return {
+        'seed': seed,
+        'blocks': block_count,
+        'transactions': tx_index,
+        'seconds': seconds,
+        'blocks_per_second': block_count / seconds,
+        'latency': latency,
+        'call_latency': call_latency,
+        'messages_hash': messages_hash,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Counterparty benchmarks')
+    parser.add_argument('action', nargs='?', choices=('micro', 'parse', 'follow', 'potentials'), default='micro')
+    parser.add_argument('--seed', type=int, default=0, help='the seed for the synthetic chain')
+    parser.add_argument('--blocks', type=int, default=200, help='the number of blocks in the synthetic chain')
+    parser.add_argument('--transactions', type=int, default=20, help='the number of transactions per block')
+    parser.add_argument('--mix', help='the relative frequencies of message types, for example ‘send=4,order=4,btcpay=2’, of {} (default: {})'.format(', '.join(MESSAGE_TYPES),
+                        ','.join('{}={}'.format(message_type, weight) for message_type, weight in sorted(DEFAULT_MIX.items()))))
+    parser.add_argument('--latency', type=float, default=0, help='the delay before the fake Bitcoind answers each request, in seconds')
+    parser.add_argument('--call-latency', help='the delay for each call to a method, for example ‘getrawtransaction=0.005’')
+    parser.add_argument('--processes', type=int, help='the number of processes with which to scan for potentials')
+    args = parser.parse_args()
+
+    mix = DEFAULT_MIX
+    if args.mix:
+        mix = {message_type: float(weight) for message_type, weight in (pair.split('=') for pair in args.mix.split(','))}
+        unknown = set(mix) - set(MESSAGE_TYPES)
+        if unknown: parser.error('unknown message types: {}'.format(', '.join(sorted(unknown))))
+
+    if args.action == 'micro':
+        bench_base58()
+        bench_get_tx_info()
+        bench_match()
+        bench_credit()
+        bench_get_credits()
+    elif args.action == 'parse':
+        print(json.dumps(bench_parse(args.seed, args.blocks, args.transactions, mix), indent=4, sort_keys=True))
+    else:
+        call_latency = {}
+        if args.call_latency:
+            call_latency = {method: float(seconds) for method, seconds in (pair.split('=') for pair in args.call_latency.split(','))}
+        print(json.dumps(bench_ingest(args.action, args.seed, args.blocks, args.transactions, mix,
+                                      args.latency, call_latency, args.processes), indent=4, sort_keys=True))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -3,33 +3,39 @@
 import os
 import sys
 import hashlib
+import shutil
 import binascii
 import time
 import apsw
 import decimal
 D = decimal.Decimal
 import difflib
+import random
 import json
 import inspect
 import requests
 from requests.auth import HTTPBasicAuth
 import logging
+import gc
+import weakref
 
 CURR_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(CURR_DIR, '..')))
 
-from lib import (config, api, util, exceptions, bitcoin, blocks)
+from lib import (config, api, util, exceptions, bitcoin, blocks, verify, export, profiler)
 from lib import (send, order, btcpay, issuance, broadcast, bet, dividend, burn, cancel, callback)
 import counterpartyd
+import bench_   # (Which sets the options for itself.)
 
 # config.BLOCK_FIRST = 0
 # config.BURN_START = 0
 # config.BURN_END = 9999999
 counterpartyd.set_options(database_file=CURR_DIR+'/counterpartyd.unittest.db', testnet=True, testcoin=False, unittest=True)
 
-# Connect to database.
-try: os.remove(config.DATABASE)
-except: pass
+# Connect to database (and remove any write‐ahead log left with it).
+for suffix in ('', '-wal', '-shm'):
+    try: os.remove(config.DATABASE + suffix)
+    except: pass
 db = util.connect_to_db()
 cursor = db.cursor()
 
@@ -333,6 +339,222 @@ def test_get_address():
     for field in get_address:
         output_new['get_address_' + field] = get_address[field]
 
+def test_get_address_sections():
+    get_address = util.get_address(db, source_default)
+    sections = util.get_address(db, source_default, sections=['balances', 'sends', 'order_matches'])
+    assert list(sections.keys()) == ['balances', 'sends', 'order_matches']
+    for section in sections:
+        assert sections[section] == get_address[section]
+    cursor.execute('''END''')   # Read concurrently, on other connections.
+    assert util.get_address(db, source_default) == get_address
+    cursor.execute('''BEGIN''')
+
+def test_get_addresses():
+    get_addresses = util.get_addresses(db, [source_default, destination_default, source_default])
+    assert list(get_addresses.keys()) == [source_default, destination_default]
+    for address in get_addresses:
+        assert get_addresses[address] == util.get_address(db, address)
+
+def test_snapshot_reads():
+    # A reader’s transaction doesn’t make the writer’s commits fail (see util.connect_to_db()).
+    reader = util.connect_to_db(flags='SQLITE_OPEN_READONLY')
+    reader_cursor = reader.cursor()
+    reader_cursor.execute('''BEGIN''')
+    balances = reader_cursor.execute('''SELECT * FROM balances''').fetchall()
+
+    user_version = cursor.execute('''PRAGMA user_version''').fetchall()[0]['user_version']
+    cursor.execute('''END''')
+    cursor.execute('''BEGIN''')
+    cursor.execute('''PRAGMA user_version = {}'''.format(user_version))
+    cursor.execute('''END''')
+    cursor.execute('''BEGIN''')
+
+    assert reader_cursor.execute('''SELECT * FROM balances''').fetchall() == balances
+    reader_cursor.execute('''END''')
+    reader.close()
+
+def test_compact():
+    # Copy debits, credits and balances into a database with compact storage.
+    database, config.DATABASE = config.DATABASE, CURR_DIR + '/counterpartyd.compact.unittest.db'
+    for suffix in ('', '-wal', '-shm'):
+        try: os.remove(config.DATABASE + suffix)
+        except: pass
+    config.COMPACT = True
+    compact_db = util.connect_to_db()
+    compact_db.setexectrace(None)   # Don’t journal (or log) the copies.
+    blocks.initialise(compact_db)
+    config.DATABASE, config.COMPACT = database, False
+
+    compact_cursor = compact_db.cursor()
+    for table in ('debits', 'credits', 'balances'):
+        rows = cursor.execute('''SELECT * FROM {}'''.format(table)).fetchall()
+        for row in rows:
+            compact_cursor.execute('''INSERT INTO {} VALUES({})'''.format(table, ','.join('?' * len(row))), tuple(row.values()))
+        assert compact_cursor.execute('''SELECT * FROM {}'''.format(table)).fetchall() == rows
+    assert compact_cursor.execute('''SELECT * FROM sqlite_master WHERE (type = ? AND name = ?)''', ('view', 'balances')).fetchall()
+    assert util.get_balances(compact_db, address=source_default) == util.get_balances(db, address=source_default)
+    compact_cursor.close()
+    compact_db.close()
+
+def test_verify():
+    assert not verify.verify(db, processes=2)
+
+def test_export():
+    directory = CURR_DIR + '/export.unittest'
+    try: shutil.rmtree(directory)
+    except: pass
+    messages = cursor.execute('''SELECT * FROM messages WHERE message_index < \
+                                 (SELECT MIN(message_index) FROM messages WHERE block_index > ?) ORDER BY message_index''',
+                              (util.last_block(db)['block_index'] - export.REORG_DEPTH,)).fetchall()
+    assert export.export(db, directory) == len(messages)
+    assert export.export(db, directory) == 0
+    assert list(export.read(directory)) == messages
+
+    # With a segment per block, some messages (e.g. updates) belong to blocks
+    # before that of the message before them.
+    segment_blocks = export.SEGMENT_BLOCKS
+    export.SEGMENT_BLOCKS = 1
+    try:
+        shutil.rmtree(directory)
+        export.export(db, directory)
+        assert list(export.read(directory)) == messages
+    finally:
+        export.SEGMENT_BLOCKS = segment_blocks
+
+    # Prune (and then undo it).
+    export.export(db, directory, prune=True)
+    assert cursor.execute('''SELECT MIN(message_index) AS message_index FROM messages''').fetchall()[0]['message_index'] == messages[-1]['message_index'] + 1
+    cursor.execute('''ROLLBACK''')
+    cursor.execute('''BEGIN''')
+
+def test_query_plans():
+    def plan(sql, bindings):
+        rows = cursor.execute('''EXPLAIN QUERY PLAN ''' + sql, bindings).fetchall()
+        return ' '.join(row['detail'] for row in rows)
+
+    queries = (
+        ('''SELECT * FROM order_matches WHERE id = ?''', ('',), 'sqlite_autoindex_order_matches_1'),
+        ('''SELECT * FROM orders WHERE (tx_hash=? AND source=? AND validity=?)''', ('', '', 'valid'), 'sqlite_autoindex_orders_1'),
+        ('''SELECT * FROM bets WHERE (tx_hash=? AND source=? AND validity=?)''', ('', '', 'valid'), 'sqlite_autoindex_bets_1'),
+        ('''SELECT * FROM balances WHERE (address = ? AND asset = ?)''', ('', 'XCP'), 'balances_address_asset_idx'),
+        ('''SELECT * FROM debits WHERE address = ? AND asset = ? ORDER BY rowid''', ('', 'XCP'), 'debits_address_asset_idx'),
+        ('''SELECT * FROM credits WHERE address = ? ORDER BY rowid''', ('',), 'credits_address_asset_idx'),
+        ('''SELECT * FROM orders WHERE (give_asset=? AND get_asset=? AND validity=?) ORDER BY tx_index''', ('', '', 'valid'), 'give_get_valid_idx'),
+        ('''SELECT * FROM orders WHERE (validity = ? AND expire_index < ?)''', ('valid', 0), 'orders_expire_idx'),
+        ('''SELECT * FROM orders WHERE source = ? ORDER BY rowid''', ('',), 'orders_source_idx'),
+        ('''SELECT * FROM order_matches WHERE (tx0_address = ? OR tx1_address = ?) ORDER BY rowid''', ('', ''), 'order_matches_tx1_address_idx'),
+        ('''SELECT * FROM bets WHERE (feed_address=? AND validity=? AND bet_type=?) ORDER BY tx_index''', ('', 'valid', 0), 'feed_valid_bettype_idx'),
+        ('''SELECT * FROM bets WHERE source = ? ORDER BY rowid''', ('',), 'bets_source_idx'),
+        ('''SELECT * FROM sends WHERE (source = ? OR destination = ?) AND validity = ? ORDER BY rowid''', ('', '', 'valid'), 'sends_destination_idx'),
+        ('''SELECT * FROM issuances WHERE (validity = ? AND asset = ?) ORDER BY tx_index''', ('valid', ''), 'valid_asset_idx'),
+        ('''SELECT * FROM issuances WHERE issuer = ? ORDER BY rowid''', ('',), 'issuances_issuer_idx'),
+        ('''SELECT * FROM cancels WHERE offer_hash = ?''', ('',), 'cancels_offer_hash_idx'),
+        ('''SELECT * FROM messages WHERE block_index = ? ORDER BY message_index ASC''', (0,), 'messages_block_index_idx'),
+    )
+    for sql, bindings, index in queries:
+        assert index in plan(sql, bindings), sql
+
+def test_select_rows():
+    # Invalid filters are rejected even when the query selects no rows.
+    filters = [{'field': 'source', 'op': '==', 'value': 'nonexistent'}, {'field': 'nonexistent', 'op': '==', 'value': 0}]
+    try:
+        util.get_sends(db, filters=filters)
+        raised = False
+    except Exception as e:
+        raised = 'filter field is invalid' in str(e)
+    assert raised
+
+    columns, insertion_order = util.get_table_info(db, 'sends')
+    assert 'source' in columns and insertion_order == ''' ORDER BY rowid'''
+    assert util.get_table_info(db, 'sends') is util.table_infos[db]['sends']
+
+def test_rpc_stats():
+    stats = bitcoin.get_rpc_stats()
+    decode = stats['methods']['decoderawtransaction']
+    assert decode['count'] > 0
+    assert decode['histogram'][-1] == {'le': None, 'count': decode['count']}
+    assert not stats['circuit_open']
+
+def test_rpc_breaker():
+    # The call which trips the breaker fails as those after it do.
+    class Session (object):
+        def post (self, *args, **kwargs):
+            raise requests.exceptions.ConnectionError()
+    session = getattr(bitcoin.request_sessions, 'session', None)
+    tries, backoff = bitcoin.RPC_TRIES, bitcoin.RPC_BACKOFF
+    bitcoin.request_sessions.session = Session()
+    bitcoin.RPC_TRIES, bitcoin.RPC_BACKOFF = 2, 0
+    try:
+        for i in range(2):
+            try:
+                bitcoin.rpc('getblockcount', [])
+                raised = False
+            except exceptions.BitcoindUnavailableError:
+                raised = True
+            assert raised and bitcoin.get_rpc_stats()['circuit_open']
+    finally:
+        bitcoin.request_sessions.session = session
+        bitcoin.RPC_TRIES, bitcoin.RPC_BACKOFF = tries, backoff
+        bitcoin.breaker_open_until, bitcoin.breaker_tripped = 0, False
+
+def test_rpc_batch_error():
+    # A batch rejected as a whole.
+    class Response (object):
+        status_code, reason = 500, 'Internal Server Error'
+        def json (self):
+            return {'result': None, 'error': {'code': -32700, 'message': 'Parse error'}, 'id': None}
+    connect = bitcoin.connect
+    bitcoin.connect = lambda host, payload, headers: Response()
+    try:
+        bitcoin.rpc_batch('getblockhash', [[0], [1]])
+        raised = False
+    except exceptions.BitcoindRPCError as e:
+        raised = 'Parse error' in str(e)
+    finally:
+        bitcoin.connect = connect
+    assert raised
+
+def test_parse_stats():
+    profiler.enable()
+    cursor = db.cursor()
+    with profiler.measure(db, 'functions', 'test'):
+        cursor.execute('''SELECT * FROM balances''')
+        cursor.execute('''SELECT * FROM credits''')
+    cursor.close()
+    profiler.enabled = False
+
+    stats = profiler.get_parse_stats()['functions']['test']
+    assert stats['count'] == 1 and stats['statements'] == 2 and stats['rows'] == 0
+    assert stats['histogram'][-1] == {'le': None, 'count': 1}
+
+def test_statements():
+    assert util.classify('insert into sends values(:tx_index, :tx_hash)') == ('insert', 'sends', True)
+    assert util.classify('update balances set amount = :amount where (address = :address and asset = :asset)') == ('update', 'balances', False)
+    assert util.classify('''SELECT * FROM sends''') == None
+
+    balances = util.execute(db, 'get_balance', (source_default, 'XCP'))
+    cursor = db.cursors['get_balance']
+    assert util.execute(db, 'get_balance', (source_default, 'XCP')) == balances and len(balances) == 1
+    assert db.cursors['get_balance'] is cursor
+    util.release_cursors(db)
+    assert not db.cursors
+
+    # Registered cursors don’t keep a connection open.
+    read_db = util.connect_to_db(flags='SQLITE_OPEN_READONLY')
+    util.execute(read_db, 'get_balance', (source_default, 'XCP'))
+    read_db_ref = weakref.ref(read_db)
+    del read_db
+    gc.collect()
+    assert read_db_ref() == None
+
+def test_rowtracer():
+    cursor = db.cursor()
+    cursor.execute('''SELECT 1 AS a, 2 AS b UNION ALL SELECT 3, 4''')
+    assert cursor.fetchall() == [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]
+    cursor.execute('''SELECT 1 AS "it's", 2 AS b, 3 AS b''')
+    assert cursor.fetchall() == [{"it's": 1, 'b': 3}]
+    cursor.close()
+
 def test_json_rpc():
 
     api_server = api.APIServer()
@@ -361,6 +583,16 @@ def test_json_rpc():
         assert response['jsonrpc'] == '2.0'
         assert response['id'] == 0
 
+    # Message feed.
+    feed = requests.get(url + 'messages', params={'message_index': -1, 'timeout': 0}, auth=auth).json()
+    assert feed['rollback'] == None
+    assert [message['message_index'] for message in feed['messages']] == list(range(len(feed['messages'])))
+
+    # Metrics.
+    metrics = requests.get('http://localhost:' + str(config.RPC_PORT) + '/metrics', auth=auth).text
+    assert 'counterpartyd_api_request_seconds_count{method="get_balances"} 1' in metrics.splitlines()
+    assert 'counterpartyd_database_bytes {}'.format(os.path.getsize(config.DATABASE)) in metrics.splitlines()
+
 def test_stop():
     logging.info('STOP TEST')
 
@@ -421,6 +653,139 @@ def test_base58_decode():
     assert binascii.hexlify(pubkeyhash).decode('utf-8') == '010966776006953D5567439E5E39F86A0D273BEE'.lower()
     assert len(pubkeyhash) == 20
 
+def test_exact_arithmetic():
+    """Integer matching must agree with Decimal matching everywhere."""
+    rng = random.Random(0)
+    def amount ():
+        return rng.choice([rng.randint(1, 1000), rng.randint(1, 2**63 - 1), rng.randint(1, 100) * 10 ** rng.randint(0, 16), config.UNIT])
+    for i in range(10000):
+        tx0 = {'give_amount': amount(), 'get_amount': amount()}
+        if i % 3 == 0:  # Exactly inverse prices.
+            k = rng.randint(1, 1000)
+            tx1 = {'give_amount': tx0['get_amount'] * k, 'get_amount': tx0['give_amount'] * k}
+        elif i % 3 == 1:    # Nearly inverse prices.
+            tx1 = {'give_amount': tx0['get_amount'] * 10 ** 9 + rng.randint(-3, 3), 'get_amount': tx0['give_amount'] * 10 ** 9 + rng.randint(-3, 3)}
+        else:
+            tx1 = {'give_amount': amount(), 'get_amount': amount()}
+        tx0_remaining, tx1_remaining = rng.choice([tx0['give_amount'], amount()]), rng.choice([tx1['give_amount'], amount()])
+        bet0 = {'wager_amount': tx0['give_amount'], 'counterwager_amount': tx0['get_amount'], 'wager_remaining': tx0_remaining}
+        bet1 = {'wager_amount': tx1['give_amount'], 'counterwager_amount': tx1['get_amount']}
+        for block_index in (284000, 286100, 290000):
+            assert order.get_match_amounts(block_index, tx0, tx1, tx0_remaining, tx1_remaining) == order.get_match_amounts_decimal(block_index, tx0, tx1, tx0_remaining, tx1_remaining)
+            assert bet.get_match_amounts(block_index, bet0, bet1, tx1_remaining) == bet.get_match_amounts_decimal(block_index, bet0, bet1, tx1_remaining)
+
+    for i in range(100):
+        orders = [{'tx_index': j, 'give_amount': amount(), 'get_amount': amount()} for j in range(20)]
+        orders += [{'tx_index': 20 + j, 'give_amount': orders[j]['give_amount'] * 3, 'get_amount': orders[j]['get_amount'] * 3 + rng.randint(0, 1)} for j in range(10)]
+        assert order.sort_by_price(orders) == sorted(orders, key=lambda x: D(x['get_amount']) / D(x['give_amount']))
+
+def test_exact_arithmetic_chain():
+    """Parsing a synthetic chain with integer arithmetic gives the same
+    messages as with Decimal, before and after the protocol changes to
+    matching.
+    """
+    database, config.DATABASE = config.DATABASE, bench_.CURR_DIR + '/counterpartyd.bench.db'
+    block_first = config.BLOCK_FIRST
+    mix = dict(bench_.DEFAULT_MIX, overorder=3, overbet=3)
+    exact_functions = {name: getattr(util, name) for name in ('exact_compare', 'exact_floor', 'exact_round', 'exact_min_floor')}
+    get_match_amounts = order.get_match_amounts, bet.get_match_amounts
+    try:
+        for first_block_index in (block_first, 290000):
+            config.BLOCK_FIRST = first_block_index
+            bench_db = bench_.new_database()
+            bench_.generate_chain(bench_db, 1, 60, 20, mix)
+            messages_hash = util.last_block(bench_db)['messages_hash']
+
+            # Reparse, falling back on Decimal everywhere.
+            for name in exact_functions:
+                setattr(util, name, lambda *args, **kwargs: None)
+            order.get_match_amounts, bet.get_match_amounts = order.get_match_amounts_decimal, bet.get_match_amounts_decimal
+            try:
+                blocks.reparse(bench_db, quiet=True)
+            finally:
+                for name, function in exact_functions.items():
+                    setattr(util, name, function)
+                order.get_match_amounts, bet.get_match_amounts = get_match_amounts
+            assert util.last_block(bench_db)['messages_hash'] == messages_hash
+            bench_db.close()
+    finally:
+        config.BLOCK_FIRST = block_first
+        bench_.remove_database()
+        config.DATABASE = database
+
+def test_reparse():
+    blocks.reparse(db, quiet=True, chunk_size=5)
+    messages_hash = util.last_block(db)['messages_hash']
+    balances = util.get_balances(db)
+
+    # Interrupt a reparse, and then resume it.
+    parse_block = blocks.parse_block
+    def interrupted_parse_block (db, block_index, block_time):
+        if block_index == config.BURN_START + 12: raise KeyboardInterrupt
+        parse_block(db, block_index, block_time)
+    blocks.parse_block = interrupted_parse_block
+    try:
+        blocks.reparse(db, quiet=True, chunk_size=5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        blocks.parse_block = parse_block
+    assert util.get_reparse(db)['last_block_index'] == config.BURN_START + 9
+
+    blocks.reparse(db, quiet=True, chunk_size=5)
+    assert util.get_reparse(db) == None
+    assert util.last_block(db)['messages_hash'] == messages_hash
+    assert util.get_balances(db) == balances
+
+def test_reparse_from():
+    messages_hash = util.last_block(db)['messages_hash']
+    balances = util.get_balances(db)
+
+    blocks.reparse_from(db, config.BURN_START + 10, quiet=True, chunk_size=5)
+    assert util.get_reparse(db) == None
+    assert util.last_block(db)['messages_hash'] == messages_hash
+    assert util.get_balances(db) == balances
+
+def test_messages_hash():
+    cursor = db.cursor()
+    def last_message_index ():
+        return cursor.execute('''SELECT MAX(message_index) AS message_index FROM messages''').fetchall()[0]['message_index']
+
+    # Note the messages recorded while parsing each block.
+    message_indexes = {}
+    parse_block = blocks.parse_block
+    def recording_parse_block (db, block_index, block_time):
+        first_message_index = last_message_index()
+        parse_block(db, block_index, block_time)
+        message_indexes[block_index] = (first_message_index, last_message_index())
+    blocks.parse_block = recording_parse_block
+    try:
+        blocks.reparse_from(db, config.BURN_START + 10, quiet=True, chunk_size=5)
+    finally:
+        blocks.parse_block = parse_block
+
+    # The hash of each block chains its messages onto the hash of the block before it.
+    checked = 0
+    for block_index in sorted(message_indexes):
+        previous_block, block = cursor.execute('''SELECT * FROM blocks WHERE block_index IN (?, ?) ORDER BY block_index''', (block_index - 1, block_index)).fetchall()
+        assert previous_block['messages_hash']
+        hasher = hashlib.sha256(previous_block['messages_hash'].encode('utf-8'))
+        messages = cursor.execute('''SELECT * FROM messages WHERE (message_index > ? AND message_index <= ?) ORDER BY message_index''', message_indexes[block_index]).fetchall()
+        for message in messages:
+            hasher.update('{}|{}|{}\n'.format(message['command'], message['category'], message['bindings']).encode('utf-8'))
+        assert block['messages_hash'] == hasher.hexdigest()
+        if messages and block_index - 1 in message_indexes: checked += 1
+    assert checked
+
+    # get_block_info returns the stored hash.
+    cursor.execute('''END''')   # Commit, for the API server’s connection.
+    url = 'http://localhost:' + str(config.RPC_PORT) + '/jsonrpc/'
+    payload = {'method': 'get_block_info', 'params': {'block_index': block_index}, 'jsonrpc': '2.0', 'id': 0}
+    response = requests.post(url, data=json.dumps(payload), headers={'content-type': 'application/json'}, auth=HTTPBasicAuth(config.RPC_USER, config.RPC_PASSWORD)).json()
+    assert response['result']['messages_hash'] == block['messages_hash']
+    cursor.execute('''BEGIN''')
+    cursor.close()
+
 
 """
 follow()